@@ -0,0 +1,63 @@
+'''
+Compares the time it takes to enumerate the missed runs of a job with the iterative croniter path
+(get_next_run per run) and the compiled single pass (get_runs_between).
+
+usage (from repo root):
+python -m benchmarks.crontab_bench [--days 1 7 60] [--repeat 3]
+'''
+import argparse
+from datetime import datetime, timedelta
+import time
+from cb_server.crontab import CronTab
+
+SCHEDULES = {
+    'minutely': '* * * * *',
+    'every_15m': '0,15,30,45 * * * *',
+    'work_hours': '0 9-17 * * 1-5',
+    'daily': '0 8 * * *',
+    'monthly': '0 0 1 * *',
+}
+
+START = datetime(2024, 1, 1, 0, 0, 30)
+
+def iterative_runs(cron: CronTab, start: datetime, end: datetime):
+    # the way process_job used to walk the missed events
+    runs = []
+    next_run = cron.get_next_run(start)
+    while next_run < end:
+        runs.append(next_run)
+        next_run = cron.get_next_run(next_run)
+    return runs
+
+def measure(func, repeat: int) -> float:
+    '''returns the best time (ms) out of 'repeat' runs'''
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def run(days: int, repeat: int):
+    end = START + timedelta(days=days)
+    for name, line in SCHEDULES.items():
+        cron = CronTab()
+        cron.from_line(line)
+        n_runs = len(cron.get_runs_between(START, end))
+        before = measure(lambda: iterative_runs(cron, START, end), repeat)
+        after = measure(lambda: cron.get_runs_between(START, end), repeat)
+        print(f'{days:>5} {name:>12} {n_runs:>8} {before:>14.3f} {after:>14.3f} {before / after:>8.1f}x')
+
+def main():
+    parser = argparse.ArgumentParser(description='cron schedule expansion benchmark')
+    parser.add_argument('--days', type=int, nargs='+', default=[1, 7, 60], help='catch up window sizes (days)')
+    parser.add_argument('--repeat', type=int, default=3, help='repetitions per measurement (the best one is kept)')
+    args = parser.parse_args()
+
+    print(f'{"days":>5} {"schedule":>12} {"runs":>8} {"iterative (ms)":>14} {"compiled (ms)":>14} {"speedup":>9}')
+    for days in args.days:
+        run(days, args.repeat)
+
+if __name__ == '__main__':
+    main()
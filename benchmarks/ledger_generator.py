@@ -0,0 +1,80 @@
+'''
+Builds a synthetic ledger database through Repo: users with an initial balance, a history of transfers between them
+spread over a year, and daily transfer jobs. The same seed builds the same ledger (except for the generated ids).
+
+usage (from repo root):
+python -m benchmarks.ledger_generator <database path> [--users 1000] [--transactions 100] [--jobs 100] [--seed 0]
+'''
+import argparse
+from collections import namedtuple
+import random
+import time
+from cb_server.cb_repo import Repo, RepoConfig
+
+INITIAL_BALANCE = 100000000 # minor units
+HISTORY_START = 1700000000
+HISTORY_TIME = 365 * 24 * 60 * 60 # seconds
+# the history rows are committed in batches, a transaction per transfer would take most of the time
+COMMIT_EVERY = 5000 # transfers
+MAX_TRANSFER_VALUE = 10000 # minor units
+JOB_CRON = '0 4 * * *'
+MAX_JOB_VALUE = 100 # minor units
+
+# transactions_per_user: the history rows of a user on average (a transfer is a row of each of its two users)
+LedgerConfig = namedtuple('LedgerConfig', ['users', 'transactions_per_user', 'jobs', 'seed'],
+                          defaults=[1000, 100, 100, 0])
+
+def get_userid(i: int) -> str:
+    return f'user{i}'
+
+def generate_ledger(db_path: str, config: LedgerConfig=LedgerConfig(), repo_config: RepoConfig=None) -> Repo:
+    """Creates the database and returns its repo (the caller closes it)"""
+    if config.users < 2:
+        raise ValueError(f"A ledger needs at least 2 users, got {config.users}")
+
+    rng = random.Random(config.seed)
+    repo = Repo(db_path, create=True, config=repo_config)
+    users = [get_userid(i) for i in range(config.users)]
+    with repo.pool.connection() as conn:
+        for userid in users:
+            repo.add_user(userid, INITIAL_BALANCE, conn=conn)
+        conn.commit()
+
+        # the history is imported the way tools/import_user.py imports it, the balances don't change
+        n_transfers = config.users * config.transactions_per_user // 2
+        for i in range(n_transfers):
+            from_userid, to_userid = rng.sample(users, 2)
+            timestamp = HISTORY_START + i * HISTORY_TIME // n_transfers
+            value = rng.randint(1, MAX_TRANSFER_VALUE)
+            description = f'synthetic transfer {i}'
+            repo.force_add_transaction(from_userid, -value, timestamp, description, conn=conn)
+            repo.force_add_transaction(to_userid, value, timestamp, description, conn=conn)
+            if (i + 1) % COMMIT_EVERY == 0:
+                conn.commit()
+        conn.commit()
+
+        for i in range(config.jobs):
+            repo.add_job(users[i % config.users], JOB_CRON, users[(i + 1) % config.users],
+                rng.randint(1, MAX_JOB_VALUE), f'synthetic job {i}', handle_missed_events=True, conn=conn)
+        conn.commit()
+    return repo
+
+def main():
+    parser = argparse.ArgumentParser(description='synthetic ledger generator')
+    parser.add_argument('db_path', help='the database to create')
+    defaults = LedgerConfig()
+    parser.add_argument('--users', type=int, default=defaults.users, help='number of users')
+    parser.add_argument('--transactions', type=int, default=defaults.transactions_per_user,
+        help='history transactions per user')
+    parser.add_argument('--jobs', type=int, default=defaults.jobs, help='number of scheduled transfer jobs')
+    parser.add_argument('--seed', type=int, default=defaults.seed, help='random seed')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    repo = generate_ledger(args.db_path, LedgerConfig(args.users, args.transactions, args.jobs, args.seed))
+    repo.close()
+    print(f'generated {args.users} users ({args.transactions} transactions each) and {args.jobs} jobs in ' +
+        f'{time.perf_counter() - start:.1f} seconds')
+
+if __name__ == '__main__':
+    main()
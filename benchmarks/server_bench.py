@@ -0,0 +1,155 @@
+'''
+Compares the two server modes, waitress (a fixed pool of request threads) and aiohttp (an asyncio loop with a
+database executor), under concurrent clients: the throughput and the latency percentiles of a mix of balance reads
+and transfers. Optional slow exporters stream a long transactions history as JSON lines while the clients run,
+each one holds a waitress thread for as long as its export is streamed.
+
+usage (from repo root):
+python -m benchmarks.server_bench [--clients 1 16 64] [--requests 2000] [--threads 8] [--exporters 0 8]
+'''
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+import uuid
+import aiohttp
+from aiohttp import web
+from waitress.server import create_server
+from cb_server import cb_async_server
+from cb_server import cb_server
+from cb_server.cb_repo import Repo
+
+INITIAL_BALANCE = 1000000
+N_USERS = 20
+EXPORTER_USERID = 'exporter'
+# the share of transfers in the clients requests, the rest are balance reads
+TRANSFERS_RATIO = 0.2
+# an exporter reads a chunk and then sleeps, a slow client on a slow link
+EXPORT_CHUNK_SIZE = 16 * 1024
+EXPORT_READ_DELAY = 0.01 # seconds
+
+def create_database(db_path: str, history: int) -> Repo:
+    repo = Repo(db_path, create=True)
+    for i in range(N_USERS):
+        repo.add_user(f'user{i}', INITIAL_BALANCE)
+    repo.add_user(EXPORTER_USERID, 0)
+    # the export history is only read, so it's inserted directly
+    conn = sqlite3.connect(db_path)
+    conn.executemany('INSERT INTO transactions (userid, value, timestamp, description, id) VALUES (?, ?, ?, ?, ?)',
+        ((EXPORTER_USERID, 100, 1700000000 + i, f'history {i}', str(uuid.uuid4())) for i in range(history)))
+    conn.commit()
+    conn.close()
+    return repo
+
+class WaitressServer:
+    def __init__(self, repo: Repo, threads: int):
+        cb_server.repo = repo
+        cb_server.app.logger.setLevel(logging.WARNING)
+        # the queue depth warnings are expected here, a full pool is what is measured
+        logging.getLogger('waitress.queue').setLevel(logging.ERROR)
+        self.server = create_server(cb_server.app, host='127.0.0.1', port=0, threads=threads)
+        self.url = f'http://127.0.0.1:{self.server.effective_port}'
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        # let the threads finish the tasks (and see their clients are gone) before the sockets are closed
+        self.server.task_dispatcher.shutdown()
+        self.server.close()
+
+class AiohttpServer:
+    def __init__(self, repo: Repo, threads: int):
+        self.loop = asyncio.new_event_loop()
+        self.runner = web.AppRunner(cb_async_server.create_app(repo, threads), access_log=None)
+        self.loop.run_until_complete(self.runner.setup())
+        self.loop.run_until_complete(web.TCPSite(self.runner, '127.0.0.1', 0).start())
+        self.url = f'http://127.0.0.1:{self.runner.addresses[0][1]}'
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+async def export(session: aiohttp.ClientSession, url: str, stop: asyncio.Event):
+    while not stop.is_set():
+        async with session.get(f'{url}/user/{EXPORTER_USERID}/transactions', params={'format': 'jsonl'}) as resp:
+            while not stop.is_set():
+                if len(await resp.content.read(EXPORT_CHUNK_SIZE)) == 0:
+                    break
+                await asyncio.sleep(EXPORT_READ_DELAY)
+
+async def client(session: aiohttp.ClientSession, url: str, n_requests: int, latencies: list, errors: list):
+    for _ in range(n_requests):
+        from_user, to_user = random.sample(range(N_USERS), 2)
+        start = time.perf_counter()
+        if random.random() < TRANSFERS_RATIO:
+            request = session.post(f'{url}/user/user{from_user}/transfer',
+                json={'to': f'user{to_user}', 'value': '0.01', 'description': 'bench'})
+        else:
+            request = session.get(f'{url}/user/user{from_user}/balance')
+        async with request as resp:
+            await resp.read()
+            if resp.status >= 300:
+                errors.append(resp.status)
+        latencies.append(time.perf_counter() - start)
+
+async def run_clients(url: str, n_clients: int, n_requests: int, n_exporters: int):
+    '''returns (requests per second, p50, p99 latency in ms, errors)'''
+    connector = aiohttp.TCPConnector(limit=n_clients + n_exporters)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        stop = asyncio.Event()
+        exporters = [asyncio.create_task(export(session, url, stop)) for _ in range(n_exporters)]
+        # let the exports start before the clients
+        await asyncio.sleep(0.2 if n_exporters > 0 else 0)
+
+        latencies, errors = [], []
+        start = time.perf_counter()
+        await asyncio.gather(*[client(session, url, n_requests // n_clients, latencies, errors)
+            for _ in range(n_clients)])
+        elapsed = time.perf_counter() - start
+
+        stop.set()
+        await asyncio.gather(*exporters)
+
+    quantiles = statistics.quantiles(latencies, n=100)
+    return len(latencies) / elapsed, quantiles[49] * 1000, quantiles[98] * 1000, len(errors)
+
+def main():
+    parser = argparse.ArgumentParser(description='server modes benchmark')
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 16, 64], help='concurrent clients')
+    parser.add_argument('--requests', type=int, default=2000, help='requests per run')
+    parser.add_argument('--threads', type=int, default=8, help='waitress threads / aiohttp database threads')
+    parser.add_argument('--exporters', type=int, nargs='+', default=[0, 8],
+        help='slow clients streaming the transactions history during the run')
+    parser.add_argument('--history', type=int, default=200000, help='transactions in the exported history')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        repo = create_database(os.path.join(temp_dir, 'bench.db'), args.history)
+        try:
+            print(f'{"server":>8} {"exporters":>9} {"clients":>7} {"req/s":>8} {"p50 ms":>8} {"p99 ms":>8} {"errors":>7}')
+            for name, server_class in [('waitress', WaitressServer), ('aiohttp', AiohttpServer)]:
+                server = server_class(repo, args.threads)
+                try:
+                    for n_exporters in args.exporters:
+                        for n_clients in args.clients:
+                            rate, p50, p99, errors = asyncio.run(
+                                run_clients(server.url, n_clients, args.requests, n_exporters))
+                            print(f'{name:>8} {n_exporters:>9} {n_clients:>7} {rate:>8.0f} {p50:>8.1f} {p99:>8.1f} '
+                                f'{errors:>7}')
+                finally:
+                    server.close()
+        finally:
+            repo.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,279 @@
+'''
+The server benchmark suite. It builds a synthetic ledger (see benchmarks.ledger_generator) and runs scripted workloads
+against the flask app, in process (the flask test client) and over loopback HTTP (waitress): balance reads,
+transfers and history queries (last_n and date ranges), then it catches up the missed runs of the jobs.
+The results (throughput, p50/p95/p99 latencies and the database size) are written as JSON, a stored baseline
+(the JSON of an earlier run) is compared with them and the suite fails on a regression.
+
+usage (from repo root):
+python -m benchmarks.server_suite [--users 1000] [--transactions 100] [--jobs 100] [--requests 1000] [--clients 1]
+    [--output results.json] [--baseline benchmarks/baseline.json] [--tolerance 0.3]
+'''
+import argparse
+from collections import namedtuple
+from datetime import datetime, timedelta
+import http.client
+import json
+import logging
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, List
+from benchmarks.ledger_generator import HISTORY_START, HISTORY_TIME, LedgerConfig, generate_ledger, get_userid
+from benchmarks.server_bench import WaitressServer
+from cb_server import cb_server
+from cb_server.cb_repo import JOBS_TABLE, LAST_RUN_KEY, TRANACTIONS_TABLE, Repo
+
+RESULTS_VERSION = 1
+# the requests before the measured ones, to warm up the caches and the connections
+WARMUP_REQUESTS = 50
+LAST_N = 50
+HISTORY_RANGE = timedelta(days=7)
+TRANSFER_VALUE = '0.01'
+# how far back the jobs last run is moved before they are caught up (the daily jobs miss a run a day)
+CATCH_UP_DAYS = 30
+DEFAULT_TOLERANCE = 0.3
+# metric -> whether a higher value is better, p99 is reported but too noisy to compare
+COMPARED_METRICS = {'throughput': True, 'p50_ms': False, 'p95_ms': False}
+
+Request = namedtuple('Request', ['method', 'path', 'body'], defaults=[None])
+
+def balance_requests(rng: random.Random, n_users: int, n_requests: int) -> List[Request]:
+    return [Request('GET', f'/user/{get_userid(rng.randrange(n_users))}/balance') for _ in range(n_requests)]
+
+def transfer_requests(rng: random.Random, n_users: int, n_requests: int) -> List[Request]:
+    requests = []
+    for _ in range(n_requests):
+        from_user, to_user = rng.sample(range(n_users), 2)
+        requests.append(Request('POST', f'/user/{get_userid(from_user)}/transfer',
+            {'to': get_userid(to_user), 'value': TRANSFER_VALUE, 'description': 'bench'}))
+    return requests
+
+def history_last_n_requests(rng: random.Random, n_users: int, n_requests: int) -> List[Request]:
+    return [Request('GET', f'/user/{get_userid(rng.randrange(n_users))}/transactions?last_n={LAST_N}')
+        for _ in range(n_requests)]
+
+def history_range_requests(rng: random.Random, n_users: int, n_requests: int) -> List[Request]:
+    requests = []
+    for _ in range(n_requests):
+        # a window of the generated history
+        from_time = datetime.fromtimestamp(HISTORY_START + rng.randrange(HISTORY_TIME -
+            int(HISTORY_RANGE.total_seconds())))
+        to_time = from_time + HISTORY_RANGE
+        requests.append(Request('GET', f'/user/{get_userid(rng.randrange(n_users))}/transactions' +
+            f'?from_time={from_time.isoformat()}&to_time={to_time.isoformat()}'))
+    return requests
+
+# name -> (rng, number of users, number of requests) -> the requests
+WORKLOADS: Dict[str, Callable[[random.Random, int, int], List[Request]]] = {
+    'balance': balance_requests,
+    'transfer': transfer_requests,
+    'history_last_n': history_last_n_requests,
+    'history_range': history_range_requests,
+}
+
+class InProcessClient:
+    """Calls the flask app directly, without a server"""
+    def request(self, request: Request) -> int:
+        return self.client.open(request.path, method=request.method, json=request.body).status_code
+
+    def close(self):
+        pass
+
+    def __init__(self):
+        self.client = cb_server.app.test_client()
+
+class HttpClient:
+    """A keep-alive HTTP connection to the server"""
+    def request(self, request: Request) -> int:
+        body = json.dumps(request.body) if request.body is not None else None
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        self.conn.request(request.method, request.path, body=body, headers=headers)
+        response = self.conn.getresponse()
+        response.read()
+        return response.status
+
+    def close(self):
+        self.conn.close()
+
+    def __init__(self, url: str):
+        host, port = url.split('//', 1)[1].split(':')
+        self.conn = http.client.HTTPConnection(host, int(port))
+
+def summarize(latencies: List[float], elapsed: float, errors: int) -> dict:
+    quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    return {'operations': len(latencies), 'throughput': len(latencies) / elapsed, 'p50_ms': quantiles[49] * 1000,
+        'p95_ms': quantiles[94] * 1000, 'p99_ms': quantiles[98] * 1000, 'errors': errors}
+
+def run_requests(create_client: Callable, requests: List[Request], n_clients: int) -> dict:
+    """Runs the requests from 'n_clients' concurrent clients, each sends its share one after the other"""
+    latencies = []
+    errors = []
+    def client_worker(share: List[Request]):
+        client = create_client()
+        try:
+            for request in share:
+                start = time.perf_counter()
+                status = client.request(request)
+                latencies.append(time.perf_counter() - start)
+                if status >= 400:
+                    errors.append(status)
+        finally:
+            client.close()
+
+    threads = [threading.Thread(target=client_worker, args=(requests[i::n_clients],)) for i in range(n_clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(latencies, time.perf_counter() - start, len(errors))
+
+def run_workloads(transport: str, create_client: Callable, config: LedgerConfig, n_requests: int,
+        n_clients: int) -> Dict[str, dict]:
+    results = {}
+    for name, workload in WORKLOADS.items():
+        # the same requests on every run (and transport)
+        rng = random.Random(f'{config.seed}-{name}')
+        requests = workload(rng, config.users, WARMUP_REQUESTS + n_requests)
+        run_requests(create_client, requests[:WARMUP_REQUESTS], n_clients)
+        results[f'{transport}.{name}'] = run_requests(create_client, requests[WARMUP_REQUESTS:], n_clients)
+    return results
+
+def run_jobs_catch_up(repo: Repo) -> dict:
+    """Moves the last run of all the jobs back and runs them, each job catches up its missed runs"""
+    with repo.pool.connection() as conn:
+        last_run = int((datetime.now() - timedelta(days=CATCH_UP_DAYS)).timestamp())
+        conn.execute(f'UPDATE {JOBS_TABLE} SET {LAST_RUN_KEY}=?', (last_run,))
+        conn.commit()
+        job_ids = [row[0] for row in conn.execute(f'SELECT id FROM {JOBS_TABLE} ORDER BY id').fetchall()]
+        n_transactions = conn.execute(f'SELECT COUNT(*) FROM {TRANACTIONS_TABLE}').fetchone()[0]
+        conn.commit()
+
+        latencies = []
+        start = time.perf_counter()
+        for job_id in job_ids:
+            job_start = time.perf_counter()
+            repo.process_job(repo.get_job(job_id, conn=conn), conn=conn)
+            latencies.append(time.perf_counter() - job_start)
+        elapsed = time.perf_counter() - start
+
+        # a run is a transfer (two transactions)
+        runs = (conn.execute(f'SELECT COUNT(*) FROM {TRANACTIONS_TABLE}').fetchone()[0] - n_transactions) // 2
+        conn.commit()
+    result = summarize(latencies, elapsed, 0)
+    result['runs'] = runs
+    result['runs_per_second'] = runs / elapsed
+    return result
+
+def get_database_size(repo: Repo) -> int:
+    """The size (bytes) of the database file, after the WAL is checkpointed into it"""
+    with repo.pool.connection() as conn:
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    return sum(os.path.getsize(path) for path in [repo.db_path, repo.db_path + '-wal'] if os.path.exists(path))
+
+def run_suite(config: LedgerConfig, n_requests: int, n_clients: int) -> dict:
+    with tempfile.TemporaryDirectory() as temp_dir:
+        start = time.perf_counter()
+        repo = generate_ledger(os.path.join(temp_dir, 'bench.db'), config)
+        generate_time = time.perf_counter() - start
+        try:
+            database = {'generate_seconds': generate_time, 'size_bytes': get_database_size(repo)}
+
+            cb_server.repo = repo
+            cb_server.app.logger.setLevel(logging.WARNING)
+            workloads = run_workloads('inprocess', InProcessClient, config, n_requests, n_clients)
+            server = WaitressServer(repo, threads=max(n_clients, 4))
+            try:
+                workloads.update(run_workloads('http', lambda: HttpClient(server.url), config, n_requests, n_clients))
+            finally:
+                server.close()
+            workloads['jobs.catch_up'] = run_jobs_catch_up(repo)
+
+            database['final_size_bytes'] = get_database_size(repo)
+        finally:
+            repo.close()
+
+    return {
+        'version': RESULTS_VERSION,
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'config': {**config._asdict(), 'requests': n_requests, 'clients': n_clients},
+        'environment': {'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(), 'cpus': os.cpu_count()},
+        'database': database,
+        'workloads': workloads,
+    }
+
+def compare(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    """Prints the change of every compared metric, returns the regressions (changes worse than the tolerance)"""
+    if results['config'] != baseline['config']:
+        print(f'warning: the baseline ran with another config ({baseline["config"]}), the comparison is not meaningful')
+
+    regressions = []
+    print(f'{"workload":>24} {"metric":>12} {"baseline":>10} {"current":>10} {"change":>8}')
+    def check(name: str, metric: str, base: float, current: float, higher_is_better: bool):
+        change = (current - base) / base if base else 0.0
+        worse = -change if higher_is_better else change
+        flag = ' REGRESSION' if worse > tolerance else ''
+        print(f'{name:>24} {metric:>12} {base:>10.2f} {current:>10.2f} {change * 100:>+7.1f}%{flag}')
+        if flag:
+            regressions.append(f'{name} {metric}: {base:.2f} -> {current:.2f}')
+
+    for name, result in results['workloads'].items():
+        base = baseline['workloads'].get(name)
+        if base is None:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            check(name, metric, base[metric], result[metric], higher_is_better)
+    check('database', 'size_kb', baseline['database']['size_bytes'] / 1024, results['database']['size_bytes'] / 1024,
+        False)
+    return regressions
+
+def print_results(results: dict):
+    database = results['database']
+    print(f'database: {database["size_bytes"] / 1024 / 1024:.1f} MB (generated in {database["generate_seconds"]:.1f}' +
+        f' seconds), {database["final_size_bytes"] / 1024 / 1024:.1f} MB after the workloads')
+    print(f'{"workload":>24} {"ops":>7} {"ops/s":>9} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"errors":>7}')
+    for name, result in results['workloads'].items():
+        print(f'{name:>24} {result["operations"]:>7} {result["throughput"]:>9.0f} {result["p50_ms"]:>8.2f} ' +
+            f'{result["p95_ms"]:>8.2f} {result["p99_ms"]:>8.2f} {result["errors"]:>7}')
+
+def main():
+    parser = argparse.ArgumentParser(description='server benchmark suite')
+    defaults = LedgerConfig()
+    parser.add_argument('--users', type=int, default=defaults.users, help='number of users')
+    parser.add_argument('--transactions', type=int, default=defaults.transactions_per_user,
+        help='history transactions per user')
+    parser.add_argument('--jobs', type=int, default=defaults.jobs, help='number of scheduled transfer jobs')
+    parser.add_argument('--seed', type=int, default=defaults.seed, help='random seed of the ledger and the requests')
+    parser.add_argument('--requests', type=int, default=1000, help='measured requests per workload')
+    parser.add_argument('--clients', type=int, default=1, help='concurrent clients')
+    parser.add_argument('--output', help='write the results JSON to this file (e.g. to store a new baseline)')
+    parser.add_argument('--baseline', help='compare the results with this results JSON, exits with 1 on a regression')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+        help='the relative change of a metric that is a regression')
+    args = parser.parse_args()
+
+    results = run_suite(LedgerConfig(args.users, args.transactions, args.jobs, args.seed), args.requests,
+        args.clients)
+    print_results(results)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if len(regressions) > 0:
+            print(f'{len(regressions)} regressions against {args.baseline}:\n' + '\n'.join(regressions))
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
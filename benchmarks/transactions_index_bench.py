@@ -0,0 +1,97 @@
+'''
+Measures the latency of the transactions history queries with and without the transactions indexes.
+
+usage (from repo root):
+python -m benchmarks.transactions_index_bench [--sizes 10000 100000 1000000] [--users 20] [--queries 200]
+'''
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+import uuid
+from cb_server.cb_repo import TRANSACTIONS_ID_INDEX, TRANSACTIONS_USER_TIME_INDEX, Repo
+
+START_TIMESTAMP = 1600000000
+# the average time between two transactions of the same user
+TRANSACTIONS_INTERVAL = 60 * 60 # seconds
+
+def populate(repo: Repo, n_rows: int, n_users: int):
+    users = [f'user{i}' for i in range(n_users)]
+    for userid in users:
+        repo.add_user(userid, 0)
+
+    with repo.pool.connection() as conn:
+        batch = []
+        for i in range(n_rows):
+            timestamp = START_TIMESTAMP + (i // n_users) * TRANSACTIONS_INTERVAL + random.randint(0, 59)
+            batch.append((users[i % n_users], random.randint(-100, 100), timestamp, f'transaction {i}',
+                str(uuid.uuid4())))
+            if len(batch) == 10000:
+                conn.executemany('INSERT INTO transactions (userid, value, timestamp, description, id) ' +
+                    'VALUES (?, ?, ?, ?, ?)', batch)
+                batch = []
+        if len(batch) > 0:
+            conn.executemany('INSERT INTO transactions (userid, value, timestamp, description, id) ' +
+                'VALUES (?, ?, ?, ?, ?)', batch)
+        conn.commit()
+
+    return users
+
+def drop_indexes(repo: Repo):
+    with repo.pool.connection() as conn:
+        conn.execute(f'DROP INDEX IF EXISTS {TRANSACTIONS_USER_TIME_INDEX}')
+        conn.execute(f'DROP INDEX IF EXISTS {TRANSACTIONS_ID_INDEX}')
+        conn.commit()
+
+def measure(repo: Repo, users, n_rows: int, n_queries: int):
+    '''returns the median latency (ms) of each query type'''
+    last_timestamp = START_TIMESTAMP + (n_rows // len(users)) * TRANSACTIONS_INTERVAL
+    queries = {
+        # the bot's poller, only the newest transactions are returned
+        'poll': lambda userid: repo.get_user_transactions(userid, None, from_timestamp=last_timestamp - 60),
+        'last_10': lambda userid: repo.get_user_transactions(userid, 10),
+        'week_range': lambda userid: repo.get_user_transactions(userid, None,
+            from_timestamp=last_timestamp - 14 * 24 * 3600, to_timestamp=last_timestamp - 7 * 24 * 3600),
+    }
+
+    results = {}
+    for name, query in queries.items():
+        latencies = []
+        for _ in range(n_queries):
+            userid = random.choice(users)
+            start = time.perf_counter()
+            query(userid)
+            latencies.append((time.perf_counter() - start) * 1000)
+        results[name] = statistics.median(latencies)
+    return results
+
+def run(n_rows: int, n_users: int, n_queries: int):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        repo = Repo(os.path.join(temp_dir, 'bench.db'), create=True)
+        try:
+            drop_indexes(repo)
+            users = populate(repo, n_rows, n_users)
+            before = measure(repo, users, n_rows, n_queries)
+            repo.create_transactions_indexes()
+            after = measure(repo, users, n_rows, n_queries)
+        finally:
+            repo.close()
+
+    for name in before.keys():
+        print(f'{n_rows:>9} {name:>12} {before[name]:>12.3f} {after[name]:>12.3f} {before[name] / after[name]:>8.1f}x')
+
+def main():
+    parser = argparse.ArgumentParser(description='transactions indexes benchmark')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000], help='table sizes (rows)')
+    parser.add_argument('--users', type=int, default=20, help='number of users')
+    parser.add_argument('--queries', type=int, default=200, help='queries per measurement')
+    args = parser.parse_args()
+
+    print(f'{"rows":>9} {"query":>12} {"before (ms)":>12} {"after (ms)":>12} {"speedup":>9}')
+    for n_rows in args.sizes:
+        run(n_rows, args.users, args.queries)
+
+if __name__ == '__main__':
+    main()
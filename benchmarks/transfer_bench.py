@@ -0,0 +1,93 @@
+'''
+Compares the throughput of concurrent transfers with the old read-then-write transfer (separate SELECTs, absolute
+balance UPDATEs) and the current one (a BEGIN IMMEDIATE transaction with relative, overdraft guarded UPDATEs,
+the writers queue on the pool write lock), and checks that the money is conserved (the old one loses updates).
+
+usage (from repo root):
+python -m benchmarks.transfer_bench [--threads 1 4 8] [--transfers 500] [--users 10]
+'''
+import argparse
+from datetime import datetime
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from cb_server.cb_repo import Repo
+
+INITIAL_BALANCE = 1000
+
+def legacy_transfer(repo: Repo, from_userid: str, to_userid: str, value: float, description: str):
+    # the way transfer_money used to be written
+    with repo.pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT balance FROM user_balance WHERE userid=?', (from_userid,))
+        from_balance = float(cursor.fetchone()[0])
+        cursor.execute('SELECT overdraft_limit FROM user WHERE userid=?', (from_userid,))
+        overdraft_limit = float(cursor.fetchone()[0])
+        if from_balance + overdraft_limit < value:
+            return False, 'Insufficient funds'
+        timestamp = int(datetime.now().timestamp())
+        guid = str(uuid.uuid4())
+        cursor.execute('SELECT balance FROM user_balance WHERE userid=?', (to_userid,))
+        to_balance = float(cursor.fetchone()[0])
+        cursor.execute('UPDATE user_balance SET balance=? WHERE userid=?', (from_balance - value, from_userid))
+        cursor.execute('UPDATE user_balance SET balance=? WHERE userid=?', (to_balance + value, to_userid))
+        cursor.execute('INSERT INTO transactions (userid, value, timestamp, description, id) VALUES (?, ?, ?, ?, ?)',
+            (from_userid, -value, timestamp, description, guid))
+        cursor.execute('INSERT INTO transactions (userid, value, timestamp, description, id) VALUES (?, ?, ?, ?, ?)',
+            (to_userid, value, timestamp, description, guid))
+        repo.update_balance_cache_after_commit(conn, {from_userid: from_balance - value, 
+            to_userid: to_balance + value}, 2)
+        repo.publish_after_commit(conn, cursor.lastrowid)
+        cursor.close()
+        conn.commit()
+        return True, None
+
+def run(transfer, n_threads: int, n_transfers: int, n_users: int):
+    '''returns (transfers per second, errors, money lost or created)'''
+    with tempfile.TemporaryDirectory() as temp_dir:
+        db_path = os.path.join(temp_dir, 'bench.db')
+        repo = Repo(db_path, create=True)
+        users = [f'user{i}' for i in range(n_users)]
+        for userid in users:
+            repo.add_user(userid, INITIAL_BALANCE)
+
+        errors = []
+        def worker(n: int):
+            for i in range(n_transfers // n_threads):
+                try:
+                    transfer(repo, users[(n + i) % n_users], users[(n + i + 1) % n_users], 1, 'bench')
+                except sqlite3.OperationalError as e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(n_threads)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        conn = sqlite3.connect(db_path)
+        total = conn.execute('SELECT SUM(balance) FROM user_balance').fetchone()[0]
+        conn.close()
+        repo.close()
+        return n_transfers / elapsed, len(errors), total - INITIAL_BALANCE * n_users
+
+def main():
+    parser = argparse.ArgumentParser(description='concurrent transfers benchmark')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 4, 8], help='concurrent transferring threads')
+    parser.add_argument('--transfers', type=int, default=500, help='transfers per run')
+    parser.add_argument('--users', type=int, default=10, help='number of accounts')
+    args = parser.parse_args()
+
+    print(f'{"threads":>7} {"variant":>8} {"transfers/s":>12} {"errors":>7} {"money drift":>12}')
+    for n_threads in args.threads:
+        for name, transfer in [('legacy', legacy_transfer), ('atomic', Repo.transfer_money)]:
+            rate, errors, drift = run(transfer, n_threads, args.transfers, args.users)
+            print(f'{n_threads:>7} {name:>8} {rate:>12.0f} {errors:>7} {drift:>12.0f}')
+
+if __name__ == '__main__':
+    main()
@@ -18,11 +18,11 @@ from cb_bot.commands.transfer_command_handler import TransferCommandHandler
 from cb_bot.commands.withdraw_command_handler import WithdrawCommandHandler
 from cb_bot.lock_channel_manager import LockChannelManager
 from cb_bot.styling import Styling
-from cb_bot.updates_manager import UpdatesManager
+from cb_bot.updates_manager import UpdatesManager, UpdatesMode
 from cb_bot.user_interaction_manager import UserInteractionManager
 from cb_bot.user_info_provider import UserInfoProvider
 
-Config = namedtuple('Config', ['bot_token', 'cb_server_url', 'mapper_path', 'is_debug'])
+Config = namedtuple('Config', ['bot_token', 'cb_server_url', 'mapper_path', 'is_debug', 'updates_mode'])
 
 def get_env_config():
     import os
@@ -30,7 +30,8 @@ def get_env_config():
     return {
         'bot_token': os.environ.get('BOT_TOKEN'),
         'cb_server_url': os.environ.get('CB_SERVER_URL'),
-        'mapper_path': os.environ.get('MAPPER_PATH')
+        'mapper_path': os.environ.get('MAPPER_PATH'),
+        'updates_mode': os.environ.get('UPDATES_MODE')
     }
 
 def parse_args(args):
@@ -43,7 +44,8 @@ def parse_args(args):
     }
 
 def main(args):
-    default_config = Config(bot_token=None, cb_server_url='http://localhost:5000', mapper_path=None, is_debug=True)
+    default_config = Config(bot_token=None, cb_server_url='http://localhost:5000', mapper_path=None, is_debug=True, 
+                            updates_mode=UpdatesMode.PUSH.value)
     env_config = get_env_config()
     cmdline_config = parse_args(args)
     
@@ -85,7 +87,7 @@ def main(args):
     user_info_provider = UserInfoProvider(client, lambda t: slow_tasks.append(t))
     user_interaction_manager = UserInteractionManager(command_types, cb_server_connection, user_info_provider, user_mapper, lambda t: fast_tasks.append(t))
     updates_manager = UpdatesManager(cb_server_connection, user_info_provider, lambda t: slow_tasks.append(t), 
-                                     user_interaction_manager.queue_interaction)
+                                     user_interaction_manager.queue_interaction, UpdatesMode(config.updates_mode))
 
     # this is the channel used to send notifications to all users
     general_channel = None
@@ -96,6 +98,8 @@ def main(args):
             return
         
         print(f"Bot {client.user} is going to sleep")
+        logging.info(f"CB server connection pool: {cb_server_connection.get_pool_stats()}")
+        await cb_server_connection.close()
         if general_channel is not None:
             bye_bye_embed = discord.Embed(title=f"Bot __{client.user.display_name}__ is going to sleep", 
                 url=None, description="Bye bye.", color=Styling.DOWN_COLOR)
@@ -137,6 +141,7 @@ def main(args):
         nonlocal general_channel
         nonlocal is_stopped
         print(f"Bot {client.user} is ready")
+        await cb_server_connection.open()
         if not await lock_channel_manager.on_ready():
             print("Starting the lock channel manager failed")
             is_stopped = True
@@ -1,6 +1,10 @@
-from collections import namedtuple
+import asyncio
+from collections import OrderedDict, namedtuple
 from datetime import datetime, timezone
-from typing import List
+from decimal import Decimal
+import logging
+from typing import AsyncIterator, Dict, List, Tuple
+import uuid
 import aiohttp
 
 from cb_bot.cb_user_mapper import UserMapper
@@ -15,79 +19,333 @@ class CBServerNoUserException(CBServerException):
     def __init__(self, user_id: str):
         super().__init__(ServerError(error_code=ErrorCodes.INTERNAL_ERROR, error_msg=f"User '{user_id}' not found on CB server"))
 
+# a page of the server changes feed
+ChangesPage = namedtuple('ChangesPage', ['transactions', 'last_seq', 'head_seq'])
+
+# a page of the user transactions history, 'next_cursor' is None on the last page
+TransactionsPage = namedtuple('TransactionsPage', ['transactions', 'next_cursor'])
+
+# a snapshot of the HTTP connection pool, a reused connection is a request sent on a kept-alive connection
+ClientPoolStats = namedtuple('ClientPoolStats', ['limit', 'limit_per_host', 'requests', 'connections_created', 
+                                                 'connections_reused', 'sessions_opened'])
+
+DEFAULT_POOL_LIMIT = 10 # connections
+DEFAULT_KEEPALIVE_TIMEOUT = 60 # seconds
+DEFAULT_REQUEST_TIMEOUT = 10 # seconds
+TRANSACTIONS_PAGE_SIZE = 100 # transactions
+
+# transfers are retried with the same idempotency key, each attempt gets a short timeout
+IDEMPOTENCY_KEY_HEADER = 'Idempotency-Key'
+TRANSFER_ATTEMPTS = 4
+DEFAULT_TRANSFER_TIMEOUT = 2 # seconds, per attempt
+TRANSFER_RETRY_DELAY = 0.2 # seconds, doubled on every retry
+
+# the last body (and its ETag) of this many GET URLs is kept, to be revalidated with a conditional GET
+MAX_ETAG_CACHE_ENTRIES = 256
+
+# how long a single changes feed request waits on the server for new transactions
+CHANGES_WAIT_TIME = 30 # seconds
+# reconnection backoff of the changes feed subscriber
+MIN_RECONNECT_DELAY = 1 # seconds
+MAX_RECONNECT_DELAY = 60 # seconds
+
 class CBServerConnection:
-    """Represents a connection to the CB backend server"""
-    def __init__(self, server_url: str, mapper: UserMapper):
+    """
+    Represents a connection to the CB backend server.
+    All the requests share a single HTTP session, its keep-alive connections are reused between the requests.
+    """
+    def __init__(self, server_url: str, mapper: UserMapper, pool_limit: int = DEFAULT_POOL_LIMIT, 
+                 keepalive_timeout: float = DEFAULT_KEEPALIVE_TIMEOUT, request_timeout: float = DEFAULT_REQUEST_TIMEOUT,
+                 transfer_timeout: float = DEFAULT_TRANSFER_TIMEOUT):
         self.server_url = server_url
         self.mapper = mapper
+        self.pool_limit = pool_limit
+        self.keepalive_timeout = keepalive_timeout
+        self.request_timeout = request_timeout
+        self.transfer_timeout = transfer_timeout
+        self.session: aiohttp.ClientSession = None
+        self.requests_count = 0
+        self.sessions_opened = 0
+        # counted by the trace hooks of the session
+        self.connections_created = 0
+        self.connections_reused = 0
+        # (url, query params) -> (etag, body), least recently used first
+        self.etag_cache: OrderedDict[tuple, Tuple[str, object]] = OrderedDict()
+        self.not_modified_count = 0
+
+    async def open(self):
+        """Opens the shared HTTP session (must be called from the event loop)"""
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_limit, keepalive_timeout=self.keepalive_timeout)
+            trace_config = aiohttp.TraceConfig()
+            trace_config.on_connection_create_end.append(self.on_connection_created)
+            trace_config.on_connection_reuseconn.append(self.on_connection_reused)
+            self.session = aiohttp.ClientSession(connector=connector, trace_configs=[trace_config],
+                                                 timeout=aiohttp.ClientTimeout(total=self.request_timeout))
+            self.sessions_opened += 1
+
+    async def on_connection_created(self, session: aiohttp.ClientSession, trace_config_ctx, params):
+        self.connections_created += 1
+
+    async def on_connection_reused(self, session: aiohttp.ClientSession, trace_config_ctx, params):
+        self.connections_reused += 1
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    async def get_session(self) -> aiohttp.ClientSession:
+        # the session is opened on first use if 'open' wasn't called (or after 'close')
+        await self.open()
+        self.requests_count += 1
+        return self.session
+
+    def get_pool_stats(self) -> ClientPoolStats:
+        connector = self.session.connector if self.session is not None and not self.session.closed else None
+        # the limits of the open connector, the configured ones when the session is closed
+        limit = connector.limit if connector is not None else self.pool_limit
+        limit_per_host = connector.limit_per_host if connector is not None else 0
+        return ClientPoolStats(limit=limit, limit_per_host=limit_per_host, requests=self.requests_count, 
+                               connections_created=self.connections_created, 
+                               connections_reused=self.connections_reused, sessions_opened=self.sessions_opened)
 
     async def get_server_exception(self, resp: aiohttp.ClientResponse):
         resp_json = await resp.json()
         return CBServerException(ServerError(**resp_json))
 
-    async def do_money_transfer(self, from_user_id: str, to_user_id: str, amount: float, description=None):
+    async def do_money_transfer(self, from_user_id: str, to_user_id: str, amount: Decimal, description=None):
+        """
+        The transfer is retried on connection errors and timeouts, all the attempts carry the same idempotency key,
+        so an attempt that timed out after the server committed it isn't paid again
+        """
         cb_from_user_id = self.mapper.get_cb_user_id(from_user_id)
         cb_to_user_id = self.mapper.get_cb_user_id(to_user_id)
         if cb_from_user_id is None:
             raise CBServerNoUserException(from_user_id)
         if cb_to_user_id is None:
             raise CBServerNoUserException(to_user_id)
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f'{self.server_url}/user/{cb_from_user_id}/transfer', json={
-                'to': cb_to_user_id,
-                'value': amount,
-                'description': description
-            }) as resp:
-                if resp.status == 204:
-                    return
-                
-                raise await self.get_server_exception(resp)
+
+        headers = {IDEMPOTENCY_KEY_HEADER: str(uuid.uuid4())}
+        delay = TRANSFER_RETRY_DELAY
+        for attempt in range(1, TRANSFER_ATTEMPTS + 1):
+            session = await self.get_session()
+            try:
+                async with session.post(f'{self.server_url}/user/{cb_from_user_id}/transfer', json={
+                    'to': cb_to_user_id,
+                    # a decimal string, the server doesn't accept more precision than a minor unit
+                    'value': str(amount),
+                    'description': description
+                }, headers=headers, timeout=aiohttp.ClientTimeout(total=self.transfer_timeout)) as resp:
+                    if resp.status == 204:
+                        return
+                    if resp.status < 500:
+                        raise await self.get_server_exception(resp)
+                    error = Exception(f'Unexpected status code: {resp.status}')
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+
+            if attempt == TRANSFER_ATTEMPTS:
+                raise error
+            logging.warning(f"Transfer attempt {attempt} failed ({error!r}), retrying in {delay} seconds")
+            await asyncio.sleep(delay)
+            delay *= 2
     
+    async def get_json(self, url: str, params: dict = None) -> Tuple[int, object]:
+        """
+        GETs a JSON body, returns (status, body) - the body is None unless the status is 200.
+        The last body of the URL is kept with its ETag, the next request sends the ETag and when the server answers
+        304 Not Modified (nothing changed) the kept body is returned, without the server building it again
+        """
+        key = (url, tuple(sorted((params or {}).items())))
+        cached = self.etag_cache.get(key)
+        headers = {'If-None-Match': cached[0]} if cached is not None else None
+
+        session = await self.get_session()
+        async with session.get(url, params=params, headers=headers) as resp:
+            if resp.status == 304 and cached is not None:
+                self.etag_cache.move_to_end(key)
+                self.not_modified_count += 1
+                return 200, cached[1]
+            if resp.status != 200:
+                self.etag_cache.pop(key, None)
+                return resp.status, None
+
+            body = await resp.json()
+            etag = resp.headers.get('ETag')
+            if etag is not None:
+                self.etag_cache[key] = (etag, body)
+                self.etag_cache.move_to_end(key)
+                if len(self.etag_cache) > MAX_ETAG_CACHE_ENTRIES:
+                    self.etag_cache.popitem(last=False)
+            return 200, body
+
     async def get_user_balance(self, user_id: str):
         cb_user_id = self.mapper.get_cb_user_id(user_id)
         if cb_user_id is None:
             raise CBServerNoUserException(user_id)
         
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f'{self.server_url}/user/{cb_user_id}/balance') as resp:
-                if resp.status == 200:
-                    resp_json = await resp.json()
-                    return float(resp_json['balance'])
-                elif resp.status == 404:
-                    return None
-                else:
-                    raise Exception(f'Unexpected status code: {resp.status}') 
+        status, resp_json = await self.get_json(f'{self.server_url}/user/{cb_user_id}/balance')
+        if status == 200:
+            return Decimal(resp_json['balance'])
+        elif status == 404:
+            return None
+        else:
+            raise Exception(f'Unexpected status code: {status}')
 
     def get_transaction_info(self, user_id: str, transaction: dict) -> UserTransactionInfo:
         return UserTransactionInfo(
             userid=user_id,
             id=transaction['id'],
             timestamp=datetime.fromisoformat(transaction['timestamp']).timestamp(),
-            amount=transaction['amount'],
+            amount=Decimal(transaction['amount']),
             description=transaction['description'])
 
+    def get_transactions_query_params(self, from_timestamp: int = None, to_timestamp: int = None) -> dict:
+        query_params = {}
+        if from_timestamp is not None:
+            query_params['from_time'] = datetime.fromtimestamp(from_timestamp, tz=timezone.utc).isoformat()
+        if to_timestamp is not None:
+            query_params['to_time'] = datetime.fromtimestamp(to_timestamp, tz=timezone.utc).isoformat()
+        return query_params
+
     async def get_user_transactions(self, user_id: str, from_timestamp: int = None, to_timestamp: int = None, last_n: int = None) \
         -> List[UserTransactionInfo]:
         cb_user_id = self.mapper.get_cb_user_id(user_id)
         if cb_user_id is None:
             raise CBServerNoUserException(user_id)
         
-        async with aiohttp.ClientSession() as session:
-            query_params = {}
-            if from_timestamp is not None:
-                query_params['from_time'] = datetime.fromtimestamp(from_timestamp, tz=timezone.utc).isoformat()
-            if to_timestamp is not None:
-                query_params['to_time'] = datetime.fromtimestamp(to_timestamp, tz=timezone.utc).isoformat()
-            if last_n is not None:
-                query_params['last_n'] = last_n
-
-            async with session.get(f'{self.server_url}/user/{cb_user_id}/transactions', params=query_params) as resp:
-                if resp.status == 200:
-                    resp_json = await resp.json()
-                    return [self.get_transaction_info(user_id, t) for t in resp_json]
-                    
-                if resp.status == 404:
-                    return None
-                
-                raise Exception(f'Unexpected status code: {resp.status}')
\ No newline at end of file
+        query_params = self.get_transactions_query_params(from_timestamp, to_timestamp)
+        if last_n is not None:
+            query_params['last_n'] = last_n
+
+        status, resp_json = await self.get_json(f'{self.server_url}/user/{cb_user_id}/transactions', query_params)
+        if status == 200:
+            return [self.get_transaction_info(user_id, t) for t in resp_json]
+            
+        if status == 404:
+            return None
+        
+        raise Exception(f'Unexpected status code: {status}')
+
+    async def get_user_transactions_page(self, user_id: str, page_size: int = TRANSACTIONS_PAGE_SIZE, cursor: str = None,
+        from_timestamp: int = None, to_timestamp: int = None) -> TransactionsPage:
+        """Returns a page of the user transactions (newest first), pass 'next_cursor' to get the next page"""
+        cb_user_id = self.mapper.get_cb_user_id(user_id)
+        if cb_user_id is None:
+            raise CBServerNoUserException(user_id)
+
+        query_params = self.get_transactions_query_params(from_timestamp, to_timestamp)
+        query_params['page_size'] = page_size
+        if cursor is not None:
+            query_params['cursor'] = cursor
+
+        status, resp_json = await self.get_json(f'{self.server_url}/user/{cb_user_id}/transactions', query_params)
+        if status == 200:
+            return TransactionsPage(
+                transactions=[self.get_transaction_info(user_id, t) for t in resp_json['transactions']],
+                next_cursor=resp_json['next_cursor'])
+
+        raise Exception(f'Unexpected status code: {status}')
+
+    async def iter_user_transaction_pages(self, user_id: str, page_size: int = TRANSACTIONS_PAGE_SIZE,
+        from_timestamp: int = None, to_timestamp: int = None) -> AsyncIterator[List[UserTransactionInfo]]:
+        """Iterates over the pages of the user transactions (newest first), one request per page"""
+        cursor = None
+        while True:
+            page = await self.get_user_transactions_page(user_id, page_size, cursor, from_timestamp, to_timestamp)
+            if len(page.transactions) > 0:
+                yield page.transactions
+            if page.next_cursor is None:
+                return
+            cursor = page.next_cursor
+
+    async def get_users_transactions(self, from_timestamps: Dict[str, float]) -> Dict[str, List[UserTransactionInfo]]:
+        """
+        Gets the transactions of multiple users in a single request.
+        from_timestamps: maps a discord user id to the timestamp to get transactions from (None for all the history)
+        returns a mapping from discord user id to its transactions, users without a CB user are omitted
+        """
+        # several discord users may be mapped to the same CB user
+        cb_users: Dict[str, List[str]] = {}
+        cb_from_timestamps: Dict[str, float] = {}
+        for user_id, from_timestamp in from_timestamps.items():
+            cb_user_id = self.mapper.get_cb_user_id(user_id)
+            if cb_user_id is None:
+                continue
+            
+            # use the earliest from time, the callers filter out the transactions they already saw
+            if cb_user_id in cb_users:
+                previous = cb_from_timestamps[cb_user_id]
+                from_timestamp = None if previous is None or from_timestamp is None else min(previous, from_timestamp)
+            cb_users.setdefault(cb_user_id, []).append(user_id)
+            cb_from_timestamps[cb_user_id] = from_timestamp
+
+        if len(cb_users) == 0:
+            return {}
+
+        cb_from_times = {cb_user_id: datetime.fromtimestamp(ts, tz=timezone.utc).isoformat() if ts is not None else None
+            for cb_user_id, ts in cb_from_timestamps.items()}
+        session = await self.get_session()
+        async with session.post(f'{self.server_url}/transactions/query', json={'users': cb_from_times}) as resp:
+            if resp.status != 200:
+                raise Exception(f'Unexpected status code: {resp.status}')
+            resp_json = await resp.json()
+
+        result = {}
+        for cb_user_id, transactions in resp_json.items():
+            for user_id in cb_users.get(cb_user_id, []):
+                # the server has a 1 second resolution, so this is the same filter it applies
+                from_timestamp = int(from_timestamps[user_id]) if from_timestamps[user_id] is not None else None
+                result[user_id] = [t for t in [self.get_transaction_info(user_id, t) for t in transactions] 
+                    if from_timestamp is None or t.timestamp >= from_timestamp]
+        return result
+
+    async def get_changes(self, after_seq: int = None, limit: int = None, wait: int = None) -> ChangesPage:
+        """
+        Gets a page of the server changes feed (all the users transactions, ordered by commit).
+        after_seq: the last sequence number seen, None to get only the current position of the feed
+        wait: if there are no new transactions, let the server wait up to this many seconds for one
+        returns the transactions of the mapped users, each reported once per discord user that is mapped to the CB user
+        """
+        query_params = {}
+        if after_seq is not None:
+            query_params['after'] = after_seq
+        if limit is not None:
+            query_params['limit'] = limit
+        if wait is not None:
+            query_params['wait'] = wait
+
+        # a waiting request may take longer than the other requests
+        timeout = aiohttp.ClientTimeout(total=self.request_timeout + (wait or 0))
+        session = await self.get_session()
+        async with session.get(f'{self.server_url}/changes', params=query_params, timeout=timeout) as resp:
+            if resp.status != 200:
+                raise Exception(f'Unexpected status code: {resp.status}')
+            resp_json = await resp.json()
+
+        transactions = []
+        for change in resp_json['changes']:
+            for user_id in self.mapper.get_discord_user_ids(change['userid']):
+                transactions.append(self.get_transaction_info(user_id, change))
+        return ChangesPage(transactions=transactions, last_seq=resp_json['last_seq'], head_seq=resp_json['head_seq'])
+
+    async def subscribe_changes(self, after_seq: int, limit: int = None) -> AsyncIterator[ChangesPage]:
+        """
+        Follows the server changes feed, a page is yielded as soon as new transactions are committed.
+        Connection errors are retried (with a backoff), the feed is resumed from the last page that was yielded.
+        """
+        delay = MIN_RECONNECT_DELAY
+        while True:
+            try:
+                page = await self.get_changes(after_seq, limit, wait=CHANGES_WAIT_TIME)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logging.warning(f"Changes feed request failed ({e!r}), reconnecting in {delay} seconds")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+                continue
+
+            delay = MIN_RECONNECT_DELAY
+            # a head behind the cursor means the database was replaced, continue from its current position
+            after_seq = page.head_seq if page.head_seq < after_seq else page.last_seq
+            yield page
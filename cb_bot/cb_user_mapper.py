@@ -1,5 +1,6 @@
 from collections import namedtuple
 import csv
+from typing import List
 
 UserMappingInfo = namedtuple('UserMappingInfo', ['cb_user_id', 'is_admin'])
 
@@ -13,15 +14,21 @@ class UserMapper:
         
         next(reader)
         self.user_map = {}
+        # reverse mapping, more than one discord user may be mapped to the same cb user
+        self.cb_user_map = {}
         for row in reader:
             cb_user_id = row[1]
             is_admin = row[2].lower() in ['true', 'yes', 'y', '1']
             self.user_map[row[0]] = UserMappingInfo(cb_user_id, is_admin)
+            self.cb_user_map.setdefault(cb_user_id, []).append(row[0])
 
     def get_cb_user_id(self, discord_user_id: str) -> str:
         result = self.user_map.get(discord_user_id, UserMapper.DEFAULT_INFO).cb_user_id
         return result
     
+    def get_discord_user_ids(self, cb_user_id: str) -> List[str]:
+        return self.cb_user_map.get(cb_user_id, [])
+
     def is_admin(self, discord_user_id: str) -> bool:
         return self.user_map.get(discord_user_id, UserMapper.DEFAULT_INFO).is_admin
     
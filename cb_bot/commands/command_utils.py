@@ -1,9 +1,11 @@
+from decimal import Decimal
 from typing import Callable, List
 
 from cb_bot.commands.command_exception import CommandParamException
 
 from cb_bot.common import get_printable_user_name, get_user_printable_time
 from cb_bot.user_info_provider import ExternalUserInfo
+from models.money import to_decimal, to_minor_units
 from models.transactions import UserTransactionInfo
 
 class CommandUtils:
@@ -85,14 +87,15 @@ class CommandUtils:
             f"{' ' * element_offset}{'^' * element_len}```\n" + \
             f"{str(e)}"
         
-    def parse_amount(num_str: str, context) -> float:
+    def parse_amount(num_str: str, context) -> Decimal:
         try:
-            num = float(num_str)
-            if num <= 0:
-                raise CommandParamException('must be positive', context)
-            return num
+            # rejects amounts that are more precise than a minor unit
+            units = to_minor_units(num_str)
         except ValueError:
             raise CommandParamException('invalid number', context)
+        if units <= 0:
+            raise CommandParamException('must be positive', context)
+        return to_decimal(units)
         
     def parse_n(num_str: str, context) -> int:
         """Parse a positive integer"""
@@ -57,7 +57,7 @@ class TransactionsCommandHandler(CommandHandler):
         formats_example = f'{", ".join(set([datetime.strftime(datetime.now(), f) for f in formats]))}'
         raise CommandParamException('invalid date format, use one of the following formats: ' + formats_example, context)
 
-    async def handle_full_command(self, message: discord.Message, command_parts: List[str], element_offset) -> bool:
+    async def handle_full_command(self, message: discord.Message, command_parts: List[str], element_offset) -> str:
         parts = [p for p in command_parts] # deep copy
         while len(parts) > 0:
             if len(parts) < 2:
@@ -66,20 +66,34 @@ class TransactionsCommandHandler(CommandHandler):
             if parts[0] == 'last':
                 self.last_n = CommandUtils.parse_n(parts[1], element_offset+1)
             elif parts[0] == 'from':
-                self.from_date = self.parse_date(parts[1], element_offset+1)
+                self.from_date = await self.parse_date(parts[1], element_offset+1)
             elif parts[0] == 'to':
-                self.to_date = self.parse_date(parts[1], element_offset+1)
+                self.to_date = await self.parse_date(parts[1], element_offset+1)
             else:
                 raise CommandFormatException()
             
             parts = parts[2:]
             element_offset += 2
         to_date = self.to_date + 24 * 60 * 60 if self.to_date is not None else None # add 1 day to include the whole day
-        result = await self.server_connection.get_user_transactions(self.user_id, from_timestamp=self.from_date, to_timestamp=to_date, \
-            last_n=self.last_n)
+        if self.last_n is not None:
+            result = await self.server_connection.get_user_transactions(self.user_id, from_timestamp=self.from_date, \
+                to_timestamp=to_date, last_n=self.last_n)
+            transaction_lines = CommandUtils.get_transactions_table(result)
+            return transaction_lines if len(result) > 0 else 'No transactions found'
 
-        transaction_lines = CommandUtils.get_transactions_table(result)
-        return transaction_lines if len(result) > 0 else 'No transactions found'
+        # the whole range may be long, send it page by page
+        found = False
+        async for page in self.server_connection.iter_user_transaction_pages(self.user_id, from_timestamp=self.from_date, \
+            to_timestamp=to_date):
+            found = True
+            await self.send_message(message, CommandUtils.get_transactions_table(page))
+        return None if found else 'No transactions found'
+
+    async def send_message(self, message: discord.Message, msg: str):
+        # this prefix is required to force discord to show the message as an ltr one
+        ltr_prefix = '`...more...`'                      
+        for msg_part in CommandUtils.slice_message(msg, prefix=ltr_prefix):
+            await message.channel.send(msg_part)
 
     async def handle_message(self, message: discord.Message) -> bool:
         command_parts = CommandUtils.split_message(message.content)
@@ -100,10 +114,8 @@ class TransactionsCommandHandler(CommandHandler):
         except CommandParamException as e:
             msg = CommandUtils.get_param_error_msg(e, command_parts)
 
-        # this prefix is required to force discord to show the message as an ltr one
-        ltr_prefix = '`...more...`'                      
-        for msg_part in CommandUtils.slice_message(msg, prefix=ltr_prefix):
-            await message.channel.send(msg_part)
+        if msg is not None: # None when the transactions were already sent
+            await self.send_message(message, msg)
         return True
     
     async def check_expired(self) -> bool:
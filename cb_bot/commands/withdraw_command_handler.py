@@ -1,4 +1,5 @@
 from datetime import datetime
+from decimal import Decimal
 import re
 from typing import List
 from discord import Enum
@@ -37,7 +38,7 @@ class WithdrawCommandHandler(CommandHandler):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.status = CommandStatus.START
-        self.amount: float = None
+        self.amount: Decimal = None
         self.requested_user_id = None
         self.channel: discord.channel = None
         self.last_activity: datetime = None
@@ -1,4 +1,5 @@
 from datetime import datetime
+from decimal import Decimal
 from enum import Enum
 from typing import Callable
 
@@ -22,7 +23,7 @@ class WithdrawalRequestHandler(RequestHandler):
     '''
     CONFIRM_MSG = "Please confirm by typing **yes** or **y**"
 
-    def __init__(self, user_id: str, amount: float, requesting_user_id: str, description: str, user_info_provider: UserInfoProvider, 
+    def __init__(self, user_id: str, amount: Decimal, requesting_user_id: str, description: str, user_info_provider: UserInfoProvider, 
                  on_complete: Callable):
         super().__init__(user_id)
         self.amount = amount
@@ -1,15 +1,25 @@
+import asyncio
 import datetime
+from enum import Enum
 import logging
 from typing import Callable, Dict, List, Tuple, Set
 
 
-from cb_bot.cb_server_connection import CBServerConnection, CBServerNoUserException
+from cb_bot.cb_server_connection import ChangesPage, CBServerConnection, CBServerNoUserException
 from cb_bot.commands.command_utils import CommandUtils
 from cb_bot.common import get_user_printable_time
 from cb_bot.commands.notification_handler import NotificationHandler
 from cb_bot.user_info_provider import UserInfoProvider
 from models.transactions import UserTransactionInfo
 
+class UpdatesMode(Enum):
+    PER_USER = 'per_user' # a transactions request per user
+    BULK = 'bulk' # a single transactions request for all the users
+    CHANGES = 'changes' # follow the server changes feed with a single cursor
+    PUSH = 'push' # subscribe to the server changes feed, notifications are sent as soon as transactions are committed
+
+CHANGES_PAGE_SIZE = 100
+
 class UpdatesManager:
     def refresh_users(self):
         all_users = self.user_info_provider.get_all_users()
@@ -24,10 +34,26 @@ class UpdatesManager:
                 logging.info(f"Removing user {user_id} from updates manager")
                 del self.last_update[user_id]
 
-    async def poll_updates(self):
-        self.refresh_users()
+    def handle_user_transactions(self, user_id: str, transactions: List[UserTransactionInfo], now_timestamp: float):
+        _, transaction_ids = self.last_update[user_id]
+        new_transactions : List[UserTransactionInfo] = []
+        for transaction in transactions:
+            if transaction.id in transaction_ids:
+                continue
+            new_transactions.append(transaction) # cache the new set of transaction ids
+            print(f"New transaction for user {user_id}: {transaction}")
+            
+        self.last_update[user_id] = now_timestamp, set([t.id for t in new_transactions])
+        self.notify_user(user_id, new_transactions)
+
+    def notify_user(self, user_id: str, new_transactions: List[UserTransactionInfo]):
+        if len(new_transactions) > 0:
+            self.queue_interaction(user_id, NotificationHandler(user_id, "The following transactions were reported in your account:\n" +
+                CommandUtils.get_transactions_table(new_transactions)))
+
+    async def poll_updates_per_user(self):
         for user_id in self.last_update.keys():
-            last_update, transaction_ids = self.last_update.get(user_id, (datetime.datetime.now().timestamp(), set()))
+            last_update, _ = self.last_update.get(user_id, (datetime.datetime.now().timestamp(), set()))
             # cache the before the request to avoid missing transactions that happened during the request
             now_timestamp = datetime.datetime.now().timestamp() 
             # get all transactions since the last update
@@ -38,27 +64,100 @@ class UpdatesManager:
                 logging.warning(f"Failed to get transactions for user {user_id}")
                 continue
 
-            new_transactions : List[UserTransactionInfo] = []
-            for transaction in transactions:
-                if transaction.id in transaction_ids:
-                    continue
-                new_transactions.append(transaction) # cache the new set of transaction ids
-                print(f"New transaction for user {user_id}: {transaction}")
-                
-            self.last_update[user_id] = now_timestamp, set([t.id for t in new_transactions])
-            if len(new_transactions) > 0:
-                self.queue_interaction(user_id, NotificationHandler(user_id, "The following transactions were reported in your account:\n" +
-                    CommandUtils.get_transactions_table(new_transactions)))
+            self.handle_user_transactions(user_id, transactions, now_timestamp)
+
+    async def poll_updates_bulk(self):
+        # cache the before the request to avoid missing transactions that happened during the request
+        now_timestamp = datetime.datetime.now().timestamp()
+        from_timestamps = {user_id: last_update for user_id, (last_update, _) in self.last_update.items()}
+        transactions = await self.cb_server_connection.get_users_transactions(from_timestamps)
+        for user_id in self.last_update.keys():
+            if user_id not in transactions:
+                # This is actually a valid use case when a user is added to the discord server but does not have mapping to a CB user yet
+                logging.warning(f"Failed to get transactions for user {user_id}")
+                continue
+
+            self.handle_user_transactions(user_id, transactions[user_id], now_timestamp)
+
+    def handle_changes_page(self, page: ChangesPage) -> bool:
+        """Notifies the users about the transactions in the page, returns True if the cursor moved forward"""
+        if page.head_seq < self.changes_cursor:
+            # the server database was replaced (e.g. restored from a backup), start over from its current position
+            logging.warning(f"Changes feed moved back from {self.changes_cursor} to {page.head_seq}")
+            self.changes_cursor = page.head_seq
+            return False
+
+        new_transactions: Dict[str, List[UserTransactionInfo]] = {}
+        for transaction in page.transactions:
+            # users that are not on the discord server are not notified
+            if transaction.userid in self.last_update:
+                new_transactions.setdefault(transaction.userid, []).append(transaction)
+                print(f"New transaction for user {transaction.userid}: {transaction}")
+
+        # the feed is ordered oldest first, the notifications show the newest first (like the other modes)
+        for user_id, transactions in new_transactions.items():
+            self.notify_user(user_id, list(reversed(transactions)))
+
+        is_moved = page.last_seq > self.changes_cursor
+        self.changes_cursor = page.last_seq
+        return is_moved
+
+    async def poll_updates_changes(self):
+        if self.changes_cursor is None:
+            # start from the current position of the feed, older transactions are not reported
+            self.changes_cursor = (await self.cb_server_connection.get_changes()).last_seq
+            return
+        
+        while True:
+            page = await self.cb_server_connection.get_changes(self.changes_cursor, CHANGES_PAGE_SIZE)
+            if not self.handle_changes_page(page) or page.last_seq >= page.head_seq:
+                return
+
+    async def follow_changes(self):
+        if self.changes_cursor is None:
+            # start from the current position of the feed, older transactions are not reported
+            self.changes_cursor = (await self.cb_server_connection.get_changes()).last_seq
+
+        async for page in self.cb_server_connection.subscribe_changes(self.changes_cursor, CHANGES_PAGE_SIZE):
+            self.refresh_users()
+            self.handle_changes_page(page)
+
+    async def ensure_subscribed(self):
+        # the subscriber is started from the first slow task, since it requires a running event loop
+        if self.subscriber_task is not None and not self.subscriber_task.done():
+            return
+
+        if self.subscriber_task is not None and not self.subscriber_task.cancelled() \
+                and self.subscriber_task.exception() is not None:
+            logging.error(f"Changes feed subscriber failed: {self.subscriber_task.exception()!r}, restarting it")
+        # resumes from the cursor of the previous subscriber
+        self.subscriber_task = asyncio.get_running_loop().create_task(self.follow_changes())
+
+    async def poll_updates(self):
+        self.refresh_users()
+        if self.mode == UpdatesMode.PUSH:
+            await self.ensure_subscribed()
+        elif self.mode == UpdatesMode.CHANGES:
+            await self.poll_updates_changes()
+        elif self.mode == UpdatesMode.BULK:
+            await self.poll_updates_bulk()
+        else:
+            await self.poll_updates_per_user()
 
     def __init__(self, cb_server_connection: CBServerConnection, user_info_provider: UserInfoProvider, register_task: Callable, 
-                 queue_interaction: Callable):
+                 queue_interaction: Callable, mode: UpdatesMode = UpdatesMode.BULK):
         self.cb_server_connection: CBServerConnection = cb_server_connection
+        self.mode = mode
         self.user_info_provider: UserInfoProvider = user_info_provider
         self.queue_interaction = queue_interaction
         # mapping from user id to last update timestamp and a set of the last transactions ids
         # the latter part is required because we can't rely on the timestamp alone, since timestamp 
         # resolution is 1 second and we can have multiple transactions in the same second
         self.last_update: Dict[str, Tuple[int, Set[str]]] = {}
+        # in 'changes' mode, the sequence number of the last transaction seen in the server changes feed
+        self.changes_cursor: int = None
+        # in 'push' mode, the task that follows the changes feed
+        self.subscriber_task: asyncio.Task = None
         self.refresh_users()
     
         register_task(self.poll_updates)
@@ -0,0 +1,161 @@
+from collections import namedtuple
+import sqlite3
+import threading
+from typing import Callable, Dict, List
+
+# counts the writes to the balances (and overdraft limits), it's maintained by triggers so it counts the writes of
+# every connection, including the ones of other processes
+BALANCE_WRITES_TABLE = 'balance_writes'
+BALANCE_WRITES_COUNTER_KEY = 'counter'
+BALANCE_WRITES_TRIGGER_PREFIX = 'balance_writes_trigger'
+
+# version: the balance writes counter when the balance was read (or written), a cached balance is never replaced by
+# an older one (the after commit updates of concurrent writes may run out of order)
+CachedBalance = namedtuple('CachedBalance', ['balance', 'overdraft_limit', 'version'])
+
+BalanceCacheStats = namedtuple('BalanceCacheStats', ['size', 'hits', 'misses', 'updates', 'invalidations'])
+
+def create_balance_writes_counter(conn: sqlite3.Connection, tables: List[str]):
+    """Creates the counter and the triggers that count the writes to 'tables'"""
+    cursor = conn.cursor()
+    cursor.execute(f'''CREATE TABLE IF NOT EXISTS {BALANCE_WRITES_TABLE} (
+        id INTEGER PRIMARY KEY CHECK (id = 0), {BALANCE_WRITES_COUNTER_KEY} INTEGER NOT NULL)''')
+    cursor.execute(f'INSERT OR IGNORE INTO {BALANCE_WRITES_TABLE} (id, {BALANCE_WRITES_COUNTER_KEY}) VALUES (0, 0)')
+    for table in tables:
+        for event in ['INSERT', 'UPDATE', 'DELETE']:
+            cursor.execute(f'''CREATE TRIGGER IF NOT EXISTS {BALANCE_WRITES_TRIGGER_PREFIX}_{table}_{event.lower()}
+                AFTER {event} ON {table} BEGIN
+                    UPDATE {BALANCE_WRITES_TABLE} SET {BALANCE_WRITES_COUNTER_KEY}={BALANCE_WRITES_COUNTER_KEY}+1;
+                END''')
+    cursor.close()
+
+def bump_balance_writes_counter(conn: sqlite3.Connection):
+    """Counts a write of a user data that the triggers don't see (e.g. a transaction that doesn't change a balance)"""
+    conn.execute(f'UPDATE {BALANCE_WRITES_TABLE} SET {BALANCE_WRITES_COUNTER_KEY}={BALANCE_WRITES_COUNTER_KEY}+1')
+
+def read_balance_writes_counter(conn: sqlite3.Connection) -> int:
+    return conn.execute(f'SELECT {BALANCE_WRITES_COUNTER_KEY} FROM {BALANCE_WRITES_TABLE}').fetchone()[0]
+
+class BalanceCache:
+    """
+    An in process cache of the users balance and overdraft limit.
+    The repo updates the cached balances after it commits a write. Writes that didn't update the cache (e.g. of other
+    processes) are detected by the balance writes counter and drop the whole cache. The counter is only read when
+    'PRAGMA data_version' shows another connection committed, so a hit doesn't read the database.
+    """
+    def _check_external_writes(self):
+        # must be called with the lock held
+        data_version = self._conn.execute('PRAGMA data_version').fetchone()[0]
+        if data_version == self._known_data_version:
+            return
+        self._known_data_version = data_version
+
+        counter = read_balance_writes_counter(self._conn)
+        # the counter is behind the known one when our own write was committed, but not yet visible here
+        if counter > self._known_counter:
+            self._drop(counter)
+
+    def _drop(self, counter: int):
+        # must be called with the lock held
+        self._known_counter = counter
+        self._base_generation = counter
+        self._epoch += 1
+        if len(self._entries) > 0:
+            self._entries.clear()
+            self._invalidations += 1
+
+    def get(self, userid: str) -> CachedBalance:
+        """Returns the user balance, loading it on a miss, None if there is no such user"""
+        with self._lock:
+            self._check_external_writes()
+            entry = self._entries.get(userid)
+            if entry is not None:
+                self._hits += 1
+                return entry
+            self._misses += 1
+            epoch = self._epoch
+
+        # load without holding the lock, so a slow load doesn't block the hits
+        entry = self.loader(userid)
+        if entry is None:
+            return None
+
+        with self._lock:
+            # don't cache a balance that was loaded before the cache was dropped or before a newer write
+            if epoch == self._epoch and entry.version >= self._write_versions.get(userid, 0):
+                self._entries[userid] = entry
+        return entry
+
+    def get_generation(self, userid: str) -> int:
+        """
+        Returns a number that changes whenever the user balance or transactions change (by any process): the version
+        of the last write to the user, or of the last cache drop. It's based on the persistent counter, so it's not
+        reused after a restart either
+        """
+        with self._lock:
+            self._check_external_writes()
+            return max(self._write_versions.get(userid, 0), self._base_generation)
+
+    def before_commit(self, conn: sqlite3.Connection, n_writes: int) -> int:
+        """
+        Called by a writer inside its write transaction, after it made 'n_writes' writes to the counted tables.
+        Returns the version of the write, pass it to 'update' once the transaction is committed
+        """
+        counter = read_balance_writes_counter(conn)
+        with self._lock:
+            # no other connection can commit while we hold the write lock, so if the counter doesn't add up some
+            # writes didn't update the cache (or one of ours is not updated yet, dropping the cache is safe anyway)
+            if counter - n_writes != self._known_counter:
+                self._drop(counter - n_writes)
+        return counter
+
+    def update(self, balances: Dict[str, int], version: int):
+        """Called after a write was committed with the new balances of the users it changed"""
+        with self._lock:
+            for userid, balance in balances.items():
+                self._write_versions[userid] = max(version, self._write_versions.get(userid, 0))
+                entry = self._entries.get(userid)
+                if entry is not None and version >= entry.version:
+                    self._entries[userid] = entry._replace(balance=balance, version=version)
+            self._known_counter = max(self._known_counter, version)
+            self._updates += 1
+
+    def invalidate(self, userid: str, version: int):
+        """Drops a user after a committed write that changed more than its balance"""
+        with self._lock:
+            self._write_versions[userid] = max(version, self._write_versions.get(userid, 0))
+            self._entries.pop(userid, None)
+            self._known_counter = max(self._known_counter, version)
+
+    def get_stats(self) -> BalanceCacheStats:
+        with self._lock:
+            return BalanceCacheStats(size=len(self._entries), hits=self._hits, misses=self._misses,
+                updates=self._updates, invalidations=self._invalidations)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __init__(self, db_path: str, loader: Callable[[str], CachedBalance]):
+        """
+        loader: reads the balance of a user from the database (along with the balance writes counter, in the same
+        statement), None if there is no such user
+        """
+        self.loader = loader
+        self._lock = threading.Lock()
+        # a connection of our own, its data version changes when any other connection commits
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._known_data_version = self._conn.execute('PRAGMA data_version').fetchone()[0]
+        self._known_counter = read_balance_writes_counter(self._conn)
+        # the users that weren't written since the last drop have this generation
+        self._base_generation = self._known_counter
+        # changes whenever the cache is dropped
+        self._epoch = 0
+        self._entries: Dict[str, CachedBalance] = {}
+        # userid -> the version of the last committed write to the user balance
+        self._write_versions: Dict[str, int] = {}
+
+        self._hits = 0
+        self._misses = 0
+        self._updates = 0
+        self._invalidations = 0
@@ -0,0 +1,413 @@
+"""
+An asyncio server mode (aiohttp) of the flask app routes (cb_server.cb_server): the user, transfer, transactions,
+jobs, changes feed and stats routes. The requests don't hold a thread while they wait, the (blocking) sqlite calls
+run on a dedicated database executor, so slow clients (e.g. streaming exports) don't use up a fixed pool of request
+threads. The request parsing and the responses are the same as in the flask app.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import functools
+import json
+import logging
+import re
+import time
+from aiohttp import ETag, web
+from cb_server.cb_repo import TRANSACTIONS_FETCH_SIZE, IdempotencyKeyReused, Repo, UserNotFound
+from cb_server.cb_server import DEFAULT_CHANGES_LIMIT, DEFAULT_TRANSACTIONS_PAGE_SIZE, IDEMPOTENCY_KEY_HEADER, \
+    MAX_CHANGES_LIMIT, MAX_CHANGES_WAIT, MAX_TRANSACTIONS_PAGE_SIZE, MIN_COMPRESS_SIZE, HTTP_REQUESTS_IN_FLIGHT, \
+    UNMATCHED_ROUTE, decode_cursor, encode_cursor, get_changes_dict, get_error_dict, get_job_dict, get_stats_dict, \
+    get_transactions_list, get_user_etag, parse_idempotency_key, parse_job_fields, parse_transfer, \
+    parse_transfer_legs, parse_users_query, record_request
+from cb_server.change_notifier import ChangeNotifier
+from cb_server.metrics import CONTENT_TYPE, REGISTRY
+from models.money import format_amount
+from models.server_errors import ErrorCodes, ServerError
+
+DEFAULT_DB_THREADS = 8
+
+REPO_KEY = web.AppKey('repo', Repo)
+DB_EXECUTOR_KEY = web.AppKey('db_executor', ThreadPoolExecutor)
+CHANGES_WAITER_KEY = web.AppKey('changes_waiter', 'ChangesWaiter')
+# the ETag of a conditional GET, set on the response when its headers are prepared
+ETAG_KEY = web.RequestKey('etag', str)
+
+async def run_db(request: web.Request, func, *args, **kwargs):
+    """Runs a blocking repo call on the database executor"""
+    return await asyncio.get_running_loop().run_in_executor(request.app[DB_EXECUTOR_KEY],
+        functools.partial(func, *args, **kwargs))
+
+def get_int_from_req(request: web.Request, key: str, default: int=None) -> int:
+    value = request.query.get(key)
+    if value is None:
+        return default
+
+    try:
+        return int(value)
+    except ValueError:
+        raise web.HTTPBadRequest(text=f'Invalid {key} value: {value}')
+
+def parse_timestamp(iso_time: str, key: str) -> int:
+    try:
+        return int(datetime.fromisoformat(iso_time).timestamp())
+    except (TypeError, ValueError):
+        raise web.HTTPBadRequest(text=f'Invalid {key} value: {iso_time}')
+
+def get_timestamp_from_req(request: web.Request, key: str) -> int:
+    iso_time = request.query.get(key)
+    if iso_time is None:
+        return None
+    return parse_timestamp(iso_time, key)
+
+class ChangesWaiter:
+    """
+    The long polls of the changes feed, waiting on the event loop instead of on a database thread each.
+    The notifier of the repo wakes the waiters up through 'call_soon_threadsafe' when a transaction is committed
+    """
+    def _on_publish(self, seq: int):
+        # on the committing thread
+        self._loop.call_soon_threadsafe(self._wake_up, seq)
+
+    def _wake_up(self, seq: int):
+        self.last_seq = max(self.last_seq, seq)
+        # the current waiters are released, the next ones wait on a new event
+        self._event.set()
+        self._event = asyncio.Event()
+
+    async def wait(self, after_seq: int, timeout: float) -> bool:
+        """Same as 'ChangeNotifier.wait', returns False on timeout or when the waiter is closed"""
+        deadline = self._loop.time() + timeout
+        while self.last_seq <= after_seq and not self._closed:
+            remaining = deadline - self._loop.time()
+            if remaining <= 0:
+                break
+            try:
+                await asyncio.wait_for(self._event.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+        return self.last_seq > after_seq
+
+    def close(self):
+        self._notifier.remove_listener(self._on_publish)
+        self._closed = True
+        self._event.set()
+
+    def __init__(self, notifier: ChangeNotifier, loop: asyncio.AbstractEventLoop):
+        self._notifier = notifier
+        self._loop = loop
+        self._closed = False
+        self._event = asyncio.Event()
+        notifier.add_listener(self._on_publish)
+        # read after the listener is added, so no publish is missed in between
+        self.last_seq = notifier.last_seq
+
+def build_error_response(error: ServerError) -> web.Response:
+    return web.json_response(get_error_dict(error), status=400)
+
+def conditional_get(handler):
+    """Answers 304 Not Modified when the ETag of the client is current, the same as in the flask app"""
+    @functools.wraps(handler)
+    async def wrapper(request: web.Request) -> web.StreamResponse:
+        # taken before the handler reads the data, so a body is never newer than its ETag claims
+        etag = await run_db(request, get_user_etag, request.app[REPO_KEY], request.match_info['username'])
+        request[ETAG_KEY] = etag
+        if any(client_etag.value in [etag, '*'] for client_etag in request.if_none_match or []):
+            return web.Response(status=304)
+        return await handler(request)
+    return wrapper
+
+async def set_etag(request: web.Request, response: web.StreamResponse):
+    """Sets the ETag of a conditional GET response, called when the response headers are prepared"""
+    etag = request.get(ETAG_KEY)
+    if etag is not None and response.status in [200, 304]:
+        # weak, the body may be sent compressed or not
+        response.etag = ETag(value=etag, is_weak=True)
+        response.headers['Cache-Control'] = 'no-cache'
+
+def compress_response(request: web.Request, response: web.StreamResponse):
+    """Compresses a large (or a streamed) response if the client accepts it, must be called before it's prepared"""
+    response.headers['Vary'] = 'Accept-Encoding'
+    if 'gzip' not in request.headers.get('Accept-Encoding', '') or \
+            (response.content_length is not None and response.content_length < MIN_COMPRESS_SIZE):
+        return
+    response.enable_compression(web.ContentCoding.gzip)
+
+def get_route_label(request: web.Request) -> str:
+    resource = request.match_info.route.resource
+    if resource is None:
+        return UNMATCHED_ROUTE
+    # the flask syntax, so both modes report the same routes
+    return re.sub(r'\{(\w+)\}', r'<\1>', resource.canonical)
+
+@web.middleware
+async def metrics_middleware(request: web.Request, handler) -> web.StreamResponse:
+    start = time.perf_counter()
+    HTTP_REQUESTS_IN_FLIGHT.inc()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        HTTP_REQUESTS_IN_FLIGHT.dec()
+        record_request(get_route_label(request), request.method, status, time.perf_counter() - start)
+
+@web.middleware
+async def compression_middleware(request: web.Request, handler) -> web.StreamResponse:
+    response = await handler(request)
+    # a streamed response is already prepared, its handler compresses it
+    if response.status == 200 and not response.prepared:
+        compress_response(request, response)
+    return response
+
+@conditional_get
+async def get_user_balance(request: web.Request) -> web.Response:
+    repo = request.app[REPO_KEY]
+    username = request.match_info['username']
+    # optional, the time to get the balance at (the current balance when omitted)
+    at_timestamp = get_timestamp_from_req(request, 'at')
+    try:
+        if at_timestamp is not None:
+            balance = await run_db(request, repo.get_user_balance_at, username, at_timestamp)
+        else:
+            balance = await run_db(request, repo.get_user_balance, username)
+        return web.json_response({'balance': format_amount(balance)})
+    except UserNotFound:
+        return web.json_response({'error': f'User {username} not found'}, status=404)
+
+async def add_user(request: web.Request) -> web.Response:
+    await run_db(request, request.app[REPO_KEY].add_user, request.match_info['username'], 0)
+    return web.Response(status=204)
+
+async def get_json_body(request: web.Request):
+    """The JSON body of the request, None if it's missing or invalid (as flask's get_json(silent=True))"""
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+async def transfer_money(request: web.Request) -> web.Response:
+    username = request.match_info['username']
+    req_body = await get_json_body(request)
+    try:
+        to, value, description = parse_transfer(username, req_body)
+        # a retried request (same key) returns the result of the first one instead of transferring again
+        idempotency_key = parse_idempotency_key(request.headers.get(IDEMPOTENCY_KEY_HEADER))
+    except ValueError as e:
+        return build_error_response(ServerError(ErrorCodes.USER_ERROR, str(e)))
+
+    try:
+        success, msg = await run_db(request, request.app[REPO_KEY].transfer_money, username, to, value, description,
+            idempotency_key=idempotency_key)
+    except IdempotencyKeyReused as e:
+        return build_error_response(ServerError(ErrorCodes.USER_ERROR, str(e)))
+    if not success:
+        return build_error_response(ServerError(ErrorCodes.USER_ERROR, msg))
+
+    return web.Response(status=204)
+
+async def transfer_money_batch(request: web.Request) -> web.Response:
+    """A batch of transfers in one transaction, the request body is the same as of the flask route"""
+    try:
+        legs = parse_transfer_legs(await get_json_body(request))
+    except ValueError as e:
+        return build_error_response(ServerError(ErrorCodes.USER_ERROR, str(e)))
+
+    success, results = await run_db(request, request.app[REPO_KEY].transfer_many, legs)
+    return web.json_response({'success': success,
+        'results': [{'success': leg_success, 'error': error} for leg_success, error in results]})
+
+async def stream_user_transactions(request: web.Request, username: str, from_timestamp: int,
+        to_timestamp: int) -> web.StreamResponse:
+    """
+    Streams the transactions as JSON lines, a page of rows is read from the database at a time.
+    Each page is a separate database call (continuing from the keyset cursor of the previous one), so no read
+    connection is held (or bound to an executor thread) while the client reads
+    """
+    repo = request.app[REPO_KEY]
+    response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+    compress_response(request, response)
+    await response.prepare(request)
+    after = None
+    try:
+        while True:
+            rows = await run_db(request, repo.get_user_transactions_page, username, TRANSACTIONS_FETCH_SIZE, after,
+                from_timestamp, to_timestamp)
+            if len(rows) > 0:
+                lines = ''.join(json.dumps(t) + '\n' for t in get_transactions_list(username, rows))
+                # waits while the client is slow to read, without holding a thread
+                await response.write(lines.encode())
+            if len(rows) < TRANSACTIONS_FETCH_SIZE:
+                break
+            after = (rows[-1][0], rows[-1][3])
+    except ConnectionResetError:
+        # the client went away in the middle of the export
+        return response
+    await response.write_eof()
+    return response
+
+@conditional_get
+async def get_user_transactions(request: web.Request) -> web.StreamResponse:
+    """Returns the user transactions, the query parameters are the same as of the flask route"""
+    repo = request.app[REPO_KEY]
+    username = request.match_info['username']
+    from_timestamp = get_timestamp_from_req(request, 'from_time')
+    to_timestamp = get_timestamp_from_req(request, 'to_time')
+    last_n = get_int_from_req(request, 'last_n')
+    page_size = get_int_from_req(request, 'page_size')
+    cursor = request.query.get('cursor')
+
+    if request.query.get('format') == 'jsonl':
+        return await stream_user_transactions(request, username, from_timestamp, to_timestamp)
+
+    if page_size is not None or cursor is not None:
+        page_size = page_size if page_size is not None else DEFAULT_TRANSACTIONS_PAGE_SIZE
+        if page_size <= 0 or page_size > MAX_TRANSACTIONS_PAGE_SIZE:
+            raise web.HTTPBadRequest(text=f'Invalid page_size value: {page_size}')
+        try:
+            after = decode_cursor(cursor) if cursor is not None else None
+        except ValueError as e:
+            raise web.HTTPBadRequest(text=str(e))
+        # one extra row tells whether there is a next page
+        transactions = await run_db(request, repo.get_user_transactions_page, username, page_size + 1, after,
+            from_timestamp, to_timestamp)
+        next_cursor = encode_cursor(transactions[page_size - 1]) if len(transactions) > page_size else None
+        return web.json_response({'transactions': get_transactions_list(username, transactions[:page_size]),
+            'next_cursor': next_cursor})
+
+    transactions = await run_db(request, repo.get_user_transactions, username, last_n, from_timestamp, to_timestamp)
+    return web.json_response(get_transactions_list(username, transactions))
+
+async def query_users_transactions(request: web.Request) -> web.Response:
+    """The transactions of multiple users in one round trip, the request body is the same as of the flask route"""
+    try:
+        from_times = parse_users_query(await get_json_body(request))
+    except ValueError as e:
+        return build_error_response(ServerError(ErrorCodes.USER_ERROR, str(e)))
+
+    from_timestamps = {username: parse_timestamp(from_time, 'from_time') if from_time is not None else None
+        for username, from_time in from_times.items()}
+    transactions = await run_db(request, request.app[REPO_KEY].get_users_transactions, from_timestamps)
+    return web.json_response({username: get_transactions_list(username, user_transactions)
+        for username, user_transactions in transactions.items()})
+
+async def get_changes(request: web.Request) -> web.Response:
+    """The changes feed, the query parameters and the response are the same as of the flask route"""
+    repo = request.app[REPO_KEY]
+    after = get_int_from_req(request, 'after')
+    limit = get_int_from_req(request, 'limit', DEFAULT_CHANGES_LIMIT)
+    if limit <= 0 or limit > MAX_CHANGES_LIMIT:
+        raise web.HTTPBadRequest(text=f'Invalid limit value: {limit}')
+    wait = get_int_from_req(request, 'wait', 0)
+    if wait < 0 or wait > MAX_CHANGES_WAIT:
+        raise web.HTTPBadRequest(text=f'Invalid wait value: {wait}')
+
+    head_seq = await run_db(request, repo.get_last_seq)
+    if after is None:
+        return web.json_response({'changes': [], 'last_seq': head_seq, 'head_seq': head_seq})
+
+    rows = await run_db(request, repo.get_changes, after, limit)
+    # the long poll waits on the event loop, no database thread is held while waiting
+    if len(rows) == 0 and wait > 0 and head_seq <= after:
+        if await request.app[CHANGES_WAITER_KEY].wait(after, wait):
+            rows = await run_db(request, repo.get_changes, after, limit)
+            head_seq = await run_db(request, repo.get_last_seq)
+
+    return web.json_response(get_changes_dict(rows, after, head_seq))
+
+async def get_user_jobs(request: web.Request) -> web.Response:
+    repo = request.app[REPO_KEY]
+    jobs = await run_db(request, repo.get_user_jobs, request.match_info['username'])
+    return web.json_response([get_job_dict(repo, job_info) for job_info in jobs])
+
+async def add_job(request: web.Request) -> web.Response:
+    """Schedules a transfer, the request body is the same as of the flask route"""
+    username = request.match_info['username']
+    req_body = await get_json_body(request)
+    try:
+        fields = parse_job_fields(username, req_body, partial=False)
+        job_id = await run_db(request, request.app[REPO_KEY].add_job, username, **fields)
+    except (ValueError, UserNotFound) as e:
+        return build_error_response(ServerError(ErrorCodes.USER_ERROR, str(e)))
+
+    return web.json_response({'id': job_id}, status=201)
+
+async def get_existing_job(request: web.Request):
+    job_id = request.match_info['job_id']
+    job_info = await run_db(request, request.app[REPO_KEY].get_job, job_id)
+    if job_info is None:
+        raise web.HTTPNotFound(text=f"Job '{job_id}' not found")
+    return job_info
+
+async def get_job(request: web.Request) -> web.Response:
+    return web.json_response(get_job_dict(request.app[REPO_KEY], await get_existing_job(request)))
+
+async def update_job(request: web.Request) -> web.Response:
+    """Changes the fields of a job, the request body has the same fields as in adding a job (all are optional)"""
+    job_info = await get_existing_job(request)
+    req_body = await get_json_body(request)
+    try:
+        fields = parse_job_fields(job_info.userid, req_body, partial=True)
+        if not await run_db(request, request.app[REPO_KEY].update_job, job_info.id, **fields):
+            raise web.HTTPNotFound(text=f"Job '{job_info.id}' not found")
+    except (ValueError, UserNotFound) as e:
+        return build_error_response(ServerError(ErrorCodes.USER_ERROR, str(e)))
+
+    return web.Response(status=204)
+
+async def delete_job(request: web.Request) -> web.Response:
+    job_id = request.match_info['job_id']
+    if not await run_db(request, request.app[REPO_KEY].delete_job, job_id):
+        raise web.HTTPNotFound(text=f"Job '{job_id}' not found")
+    return web.Response(status=204)
+
+async def get_stats(request: web.Request) -> web.Response:
+    return web.json_response(await run_db(request, get_stats_dict, request.app[REPO_KEY]))
+
+async def get_metrics(request: web.Request) -> web.Response:
+    """The server metrics in the Prometheus text format"""
+    return web.Response(body=REGISTRY.render().encode(), headers={'Content-Type': CONTENT_TYPE})
+
+async def start_changes_waiter(app: web.Application):
+    app[CHANGES_WAITER_KEY] = ChangesWaiter(app[REPO_KEY].change_notifier, asyncio.get_running_loop())
+
+async def close_changes_waiter(app: web.Application):
+    # releases the pending long polls
+    app[CHANGES_WAITER_KEY].close()
+
+async def shutdown_db_executor(app: web.Application):
+    app[DB_EXECUTOR_KEY].shutdown(wait=True)
+
+def create_app(repo: Repo, db_threads: int=DEFAULT_DB_THREADS) -> web.Application:
+    """The repo is not closed by the app, the caller owns it"""
+    app = web.Application(middlewares=[metrics_middleware, compression_middleware])
+    app[REPO_KEY] = repo
+    app[DB_EXECUTOR_KEY] = ThreadPoolExecutor(max_workers=db_threads, thread_name_prefix='cb-db')
+    app.on_startup.append(start_changes_waiter)
+    app.on_shutdown.append(close_changes_waiter)
+    app.on_cleanup.append(shutdown_db_executor)
+    app.on_response_prepare.append(set_etag)
+    app.add_routes([
+        web.get('/user/{username}/balance', get_user_balance),
+        web.post('/user/{username}', add_user),
+        web.post('/user/{username}/transfer', transfer_money),
+        web.post('/transfers/batch', transfer_money_batch),
+        web.get('/user/{username}/transactions', get_user_transactions),
+        web.post('/transactions/query', query_users_transactions),
+        web.get('/user/{username}/jobs', get_user_jobs),
+        web.post('/user/{username}/jobs', add_job),
+        web.get('/jobs/{job_id}', get_job),
+        web.patch('/jobs/{job_id}', update_job),
+        web.delete('/jobs/{job_id}', delete_job),
+        web.get('/changes', get_changes),
+        web.get('/stats', get_stats),
+        web.get('/metrics', get_metrics),
+    ])
+    return app
+
+def serve(repo: Repo, host: str, port: int, db_threads: int=DEFAULT_DB_THREADS):
+    logging.basicConfig(level=logging.INFO)
+    web.run_app(create_app(repo, db_threads), host=host, port=port)
@@ -6,19 +6,46 @@ import inspect
 import json
 import logging
 import sqlite3
+import threading
+import time
 import uuid
+from typing import Callable, Dict, Iterator, List, Tuple
 from apscheduler.schedulers.background import BackgroundScheduler
+from cb_server.balance_cache import BalanceCache, BalanceCacheStats, CachedBalance, \
+    bump_balance_writes_counter, create_balance_writes_counter, BALANCE_WRITES_TABLE, BALANCE_WRITES_COUNTER_KEY
+from cb_server.change_notifier import ChangeNotifier
+from cb_server.connection_pool import DEFAULT_CHECKOUT_TIMEOUT, DEFAULT_POOL_SIZE, ConnectionPool, PooledConnection, \
+    PoolStats
 from cb_server.crontab import CronTab
+from cb_server.job_executor import DEFAULT_WORKERS, PartitionedExecutor
+from cb_server.job_scheduler import JobScheduler
 
-from cb_server.jobs_lock import JobsLock
+from cb_server.jobs_lock import DEFAULT_LEASE_TIME, HEARTBEATS_PER_LEASE, JobsLock, JobsLockLost
+from cb_server.metrics import REGISTRY, CollectedMetric
+from cb_server.sql_profiler import DEFAULT_SLOW_QUERY_TIME, SqlProfiler, StatementStats
+from models.money import MINOR_UNITS
 
-REQUIRED_DB_VERSION = 2
+REQUIRED_DB_VERSION = 12
 
 BALANCE_TABLE = 'user_balance'
 USER_TABLE = 'user'
 TRANACTIONS_TABLE = 'transactions'
 VERSION_TABLE = 'version'
 JOBS_TABLE = 'jobs'
+# a snapshot holds the user balance at the end of the snapshot second (including all the transactions until then)
+BALANCE_SNAPSHOTS_TABLE = 'balance_snapshots'
+BALANCE_SNAPSHOTS_TRIGGER = 'balance_snapshots_trigger'
+# the results of the requests that were given an idempotency key, so a retried request isn't executed twice
+IDEMPOTENCY_KEYS_TABLE = 'idempotency_keys'
+# counts the jobs that were added, changed or deleted (by any instance), the active instance reloads the jobs on a change
+JOBS_WRITES_TABLE = 'jobs_writes'
+JOBS_WRITES_TRIGGER_PREFIX = 'jobs_writes_trigger'
+JOBS_WRITES_COUNTER_KEY = 'counter'
+
+TRANSACTIONS_USER_TIME_INDEX = 'transactions_userid_timestamp_idx'
+TRANSACTIONS_ID_INDEX = 'transactions_id_userid_idx'
+JOBS_NEXT_RUN_INDEX = 'jobs_next_run_idx'
+IDEMPOTENCY_KEYS_CREATED_INDEX = 'idempotency_keys_created_idx'
 
 USERID_KEY = 'userid'
 BALANCE_KEY = 'balance'
@@ -27,6 +54,8 @@ VALUE_KEY = 'value'
 TIMESTAMP_KEY = 'timestamp'
 DESCRIPTION_KEY = 'description'
 ID_KEY = 'id'
+# a monotonically increasing sequence number, given to every transaction row when it is committed
+SEQ_KEY = 'seq'
 VERSION_KEY = 'version'
 CRON_KEY = 'cron'
 ACTION_KEY = 'action'
@@ -37,11 +66,83 @@ LAST_RUN_ERROR_KEY = 'last_run_error'
 # boolean, true means that if multiple events were missed, 
 # they will be handled one after the other
 HANDLE_MISSED_EVENTS_KEY = 'handle_missed_events' 
+# the next time (epoch seconds) the job is scheduled to run
+NEXT_RUN_KEY = 'next_run'
+# bumped whenever the job is changed, the parsed job is cached by its version
+ROW_VERSION_KEY = 'row_version'
+IDEMPOTENCY_KEY = 'idempotency_key'
+REQUEST_KEY = 'request' # the request parameters (json), a key can't be reused for another request
+SUCCESS_KEY = 'success'
+ERROR_KEY = 'error'
+CREATED_KEY = 'created' # epoch seconds
 
 OLD_JOBS_HANDLING_MAX_TIME = 60 # days
+BALANCE_SNAPSHOTS_INTERVAL = 60 # minutes
+TRANSACTIONS_FETCH_SIZE = 500 # rows
+JOB_RETRY_ATTEMPTS = 5
+JOB_RETRY_DELAY = 0.1 # seconds, doubled on every retry
+IDEMPOTENCY_KEY_TTL = 24 * 60 * 60 # seconds
+IDEMPOTENCY_KEYS_PRUNE_INTERVAL = 60 # minutes
 
 JobInfo = namedtuple('JobInfo', ['id', 'userid', 'cron', 'action', 'action_params', 'description', 'last_run', 
-                                 'last_run_status', 'last_run_error', 'handle_missed_events'])
+                                 'last_run_status', 'last_run_error', 'handle_missed_events', 'row_version', 
+                                 'next_run'],
+                     defaults=[0, None])
+JOB_COLUMNS = ', '.join(JobInfo._fields)
+
+# a job's parsed (and compiled) cron and decoded action params, valid as long as the job's row version doesn't change
+CompiledJob = namedtuple('CompiledJob', ['row_version', 'cron', 'action_params'])
+
+# synchronous, cache_size, mmap_size and busy_timeout are applied as PRAGMAs to every connection
+# NORMAL synchronous is durable enough in WAL mode (a power loss may roll back the last commits, never corrupt)
+# batch_catch_up: run the missed runs of a job in a single transaction, instead of a transaction per run
+# job_workers: the number of threads that run jobs (of different users) concurrently
+# jobs_lease_time: how long (seconds) a crashed instance keeps the jobs lock before a standby takes over
+# profile_sql: profile the statements of the pools connections (see cb_server.sql_profiler), the statements slower
+# than slow_query_time (seconds) are logged with their query plan
+RepoConfig = namedtuple('RepoConfig', ['pool_size', 'pool_timeout', 'read_pool_size', 'synchronous', 'cache_size',
+                                       'mmap_size', 'busy_timeout', 'batch_catch_up', 'job_workers', 
+                                       'jobs_lease_time', 'profile_sql', 'slow_query_time'],
+                        defaults=[DEFAULT_POOL_SIZE, DEFAULT_CHECKOUT_TIMEOUT, DEFAULT_POOL_SIZE, 'NORMAL',
+                                  -16000, # negative values are in KiB (16MB)
+                                  64 * 1024 * 1024,
+                                  5000, # ms
+                                  True,
+                                  DEFAULT_WORKERS,
+                                  DEFAULT_LEASE_TIME,
+                                  False,
+                                  DEFAULT_SLOW_QUERY_TIME])
+
+# jobs: the number of scheduled jobs, queued: due jobs waiting for a worker (or for another job of the same user),
+# total_time and max_time are the execution times of the jobs (seconds)
+JobsStats = namedtuple('JobsStats', ['jobs', 'queued', 'running', 'executed', 'failed', 'retries', 'total_time',
+                                     'max_time'])
+
+# a leg of a batch transfer
+TransferLeg = namedtuple('TransferLeg', ['from_userid', 'to_userid', 'value', 'description'], defaults=[''])
+# the error of the valid legs of a batch that wasn't executed (because another leg failed)
+BATCH_NOT_EXECUTED_ERROR = 'Not executed, another transfer in the batch failed'
+
+# the results of the transfers counter
+TRANSFER_SUCCESS = 'success'
+TRANSFER_INSUFFICIENT_FUNDS = 'insufficient_funds'
+TRANSFER_USER_NOT_FOUND = 'user_not_found'
+# a retried request, the stored result was returned
+TRANSFER_REPLAYED = 'replayed'
+
+REPO_CALL_SECONDS = REGISTRY.histogram('cb_repo_call_duration_seconds', 
+    'Duration of the repo database methods (including the connection checkout)', ['method'])
+TRANSFERS = REGISTRY.counter('cb_transfers_total', 'Transfers by result', ['result'])
+BATCH_TRANSFERS = REGISTRY.counter('cb_batch_transfers_total', 'Batch transfers by result', ['result'])
+JOB_RUNS = REGISTRY.counter('cb_job_runs_total', 'Job runs (including the caught up ones) by status', ['status'])
+JOB_CATCH_UP_RUNS = REGISTRY.counter('cb_job_catch_up_runs_total', 'Missed job runs that were caught up')
+JOB_RUN_SECONDS = REGISTRY.histogram('cb_job_run_duration_seconds', 'Duration of processing a due job')
+JOBS_LAST_TICK_SECONDS = REGISTRY.gauge('cb_jobs_last_tick_duration_seconds', 
+    'How long the last jobs scheduler tick took to hand the due jobs to the workers')
+JOBS_LAST_TICK_DUE_JOBS = REGISTRY.gauge('cb_jobs_last_tick_due_jobs', 'Due jobs in the last jobs scheduler tick')
+
+def is_database_locked(e: sqlite3.OperationalError) -> bool:
+    return 'database is locked' in str(e) or 'database is busy' in str(e)
 
 class RepoException(Exception):
     pass
@@ -49,30 +150,41 @@ class RepoException(Exception):
 class UserNotFound(RepoException):
     pass
 
+class IdempotencyKeyReused(RepoException):
+    pass
+
 class ActionType(Enum):
     TRANSFER = 1
 
-# this wrapper function is used to reuse the same connection for multiple calls
-def reuse_conn(func):
-    @functools.wraps(func)
-    def wrapper(self, *args, **kwargs):
+def _pooled_conn(pool_attr: str):
+    def decorator(func):
         # Check if 'conn' is in kwargs
         params = inspect.signature(func).parameters
         if 'conn' not in params:
             raise ValueError(f"Function {func.__name__} does not have a 'conn' parameter")
-        
-        if kwargs.get('conn') is not None:
-            return func(self, *args, **kwargs)
-        
-        conn = sqlite3.connect(self.db_path)
-        kwargs['conn'] = conn
-        try:
-            result = func(self, *args, **kwargs)
-            conn.commit()
-            return result
-        finally:
-            conn.close()
-    return wrapper
+
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                if kwargs.get('conn') is not None:
+                    return func(self, *args, **kwargs)
+                
+                with getattr(self, pool_attr).connection() as conn:
+                    kwargs['conn'] = conn
+                    result = func(self, *args, **kwargs)
+                    conn.commit()
+                    return result
+            finally:
+                REPO_CALL_SECONDS.observe(time.perf_counter() - start, method=func.__name__)
+        return wrapper
+    return decorator
+
+# this wrapper function is used to reuse the same connection for multiple calls
+reuse_conn = _pooled_conn('pool')
+# same as 'reuse_conn', but a new connection is taken from the read only pool, 
+# in WAL mode these readers never block on (or block) the writer
+reuse_read_conn = _pooled_conn('read_pool')
 
 class Repo:
     @reuse_conn
@@ -133,10 +245,220 @@ class Repo:
             )
         ''')
 
+    @reuse_conn
+    def add_jobs_next_run(self, conn: sqlite3.Connection=None):
+        cursor = conn.cursor()
+        # NULL until the job is scheduled for the first time
+        cursor.execute(f'ALTER TABLE {JOBS_TABLE} ADD COLUMN {NEXT_RUN_KEY} INTEGER')
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS {JOBS_NEXT_RUN_INDEX} ON {JOBS_TABLE} ({NEXT_RUN_KEY})')
+        cursor.close()
+
+    @reuse_conn
+    def add_jobs_row_version(self, conn: sqlite3.Connection=None):
+        cursor = conn.cursor()
+        cursor.execute(f'ALTER TABLE {JOBS_TABLE} ADD COLUMN {ROW_VERSION_KEY} INTEGER NOT NULL DEFAULT 0')
+        cursor.close()
+
+    @reuse_conn
+    def create_balance_writes_counter(self, conn: sqlite3.Connection=None):
+        create_balance_writes_counter(conn, [BALANCE_TABLE, USER_TABLE])
+
+    @reuse_conn
+    def create_jobs_writes_counter(self, conn: sqlite3.Connection=None):
+        cursor = conn.cursor()
+        cursor.execute(f'''CREATE TABLE IF NOT EXISTS {JOBS_WRITES_TABLE} (
+            id INTEGER PRIMARY KEY CHECK (id = 0), {JOBS_WRITES_COUNTER_KEY} INTEGER NOT NULL)''')
+        cursor.execute(f'INSERT OR IGNORE INTO {JOBS_WRITES_TABLE} (id, {JOBS_WRITES_COUNTER_KEY}) VALUES (0, 0)')
+        # the runs of a job only change its last and next run, 'update_job' bumps the row version
+        for event in ['INSERT', 'DELETE', f'UPDATE OF {ROW_VERSION_KEY}']:
+            name = event.split(' ')[0].lower()
+            cursor.execute(f'''CREATE TRIGGER IF NOT EXISTS {JOBS_WRITES_TRIGGER_PREFIX}_{name} 
+                AFTER {event} ON {JOBS_TABLE} BEGIN
+                    UPDATE {JOBS_WRITES_TABLE} SET {JOBS_WRITES_COUNTER_KEY}={JOBS_WRITES_COUNTER_KEY}+1;
+                END''')
+        cursor.close()
+
+    @reuse_read_conn
+    def get_jobs_writes(self, conn: sqlite3.Connection=None) -> int:
+        cursor = conn.cursor()
+        cursor.execute(f'SELECT {JOBS_WRITES_COUNTER_KEY} FROM {JOBS_WRITES_TABLE}')
+        res = cursor.fetchone()[0]
+        cursor.close()
+        return res
+
+    @reuse_conn
+    def create_transactions_table(self, conn: sqlite3.Connection=None, table_name: str=TRANACTIONS_TABLE):
+        cursor = conn.cursor()
+        # AUTOINCREMENT guarantees that sequence numbers are never reused (unlike a plain rowid)
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table_name} (
+                {SEQ_KEY} INTEGER PRIMARY KEY AUTOINCREMENT,
+                {USERID_KEY} TEXT NOT NULL,
+                {VALUE_KEY} INTEGER NOT NULL,
+                {TIMESTAMP_KEY} INTEGER NOT NULL,
+                {DESCRIPTION_KEY} TEXT NOT NULL,
+                {ID_KEY} TEXT NOT NULL
+            )
+        ''')
+        cursor.close()
+
+    @reuse_conn
+    def add_transactions_seq(self, conn: sqlite3.Connection=None):
+        # sqlite can't add a primary key to an existing table, so the table is rebuilt 
+        # the existing rows are numbered by their insertion order
+        columns = ', '.join([USERID_KEY, VALUE_KEY, TIMESTAMP_KEY, DESCRIPTION_KEY, ID_KEY])
+        temp_table = f'{TRANACTIONS_TABLE}_new'
+        self.create_transactions_table(conn=conn, table_name=temp_table)
+        cursor = conn.cursor()
+        cursor.execute(f'INSERT INTO {temp_table} ({columns}) SELECT {columns} FROM {TRANACTIONS_TABLE} ORDER BY rowid')
+        cursor.execute(f'DROP TABLE {TRANACTIONS_TABLE}')
+        cursor.execute(f'ALTER TABLE {temp_table} RENAME TO {TRANACTIONS_TABLE}')
+        cursor.close()
+        self.create_transactions_indexes(conn=conn)
+
+    @reuse_conn
+    def create_transactions_indexes(self, conn: sqlite3.Connection=None):
+        cursor = conn.cursor()
+        # serves the per user history queries (user + time range, newest first) without a sort
+        cursor.execute(f'''CREATE INDEX IF NOT EXISTS {TRANSACTIONS_USER_TIME_INDEX} 
+            ON {TRANACTIONS_TABLE} ({USERID_KEY}, {TIMESTAMP_KEY} DESC)''')
+        # a transfer guid appears once per user (the two sides of the transfer)
+        cursor.execute(f'''CREATE UNIQUE INDEX IF NOT EXISTS {TRANSACTIONS_ID_INDEX} 
+            ON {TRANACTIONS_TABLE} ({ID_KEY}, {USERID_KEY})''')
+        cursor.close()
+
+    @reuse_conn
+    def create_idempotency_keys_table(self, conn: sqlite3.Connection=None):
+        cursor = conn.cursor()
+        # the primary key is the lookup index, the created index is for pruning the expired keys
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {IDEMPOTENCY_KEYS_TABLE} (
+                {USERID_KEY} TEXT NOT NULL,
+                {IDEMPOTENCY_KEY} TEXT NOT NULL,
+                {REQUEST_KEY} TEXT NOT NULL,
+                {SUCCESS_KEY} INTEGER NOT NULL,
+                {ERROR_KEY} TEXT,
+                {CREATED_KEY} INTEGER NOT NULL,
+                PRIMARY KEY ({USERID_KEY}, {IDEMPOTENCY_KEY})
+            )
+        ''')
+        cursor.execute(f'''CREATE INDEX IF NOT EXISTS {IDEMPOTENCY_KEYS_CREATED_INDEX} 
+            ON {IDEMPOTENCY_KEYS_TABLE} ({CREATED_KEY})''')
+        cursor.close()
+
+    @reuse_conn
+    def create_balance_table(self, conn: sqlite3.Connection=None, table_name: str=BALANCE_TABLE):
+        cursor = conn.cursor()
+        # money columns hold integer minor units
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table_name} (
+                {USERID_KEY} TEXT PRIMARY KEY,
+                {BALANCE_KEY} INTEGER NOT NULL
+            )
+        ''')
+        cursor.close()
+
+    @reuse_conn
+    def create_user_table(self, conn: sqlite3.Connection=None, table_name: str=USER_TABLE):
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table_name} (
+                {USERID_KEY} TEXT PRIMARY KEY,
+                {OVERDRAFT_LIMIT_KEY} INTEGER NOT NULL
+            )
+        ''')
+        cursor.close()
+
+    @reuse_conn
+    def convert_money_to_minor_units(self, conn: sqlite3.Connection=None):
+        # sqlite can't change the type of a column (and a REAL column turns integers back to floats), so the money 
+        # tables are rebuilt with INTEGER columns and the amounts are converted to minor units
+        self.begin_write(conn)
+        cursor = conn.cursor()
+        cursor.execute("SELECT seq FROM sqlite_sequence WHERE name=?", (TRANACTIONS_TABLE,))
+        res = cursor.fetchone()
+        last_seq = res[0] if res is not None else 0
+        # the trigger refers to the snapshots table, which is replaced (renaming a table fails while a trigger refers
+        # to a missing one)
+        cursor.execute(f'DROP TRIGGER IF EXISTS {BALANCE_SNAPSHOTS_TRIGGER}')
+
+        tables = [
+            (BALANCE_TABLE, self.create_balance_table, [USERID_KEY, BALANCE_KEY], BALANCE_KEY),
+            (USER_TABLE, self.create_user_table, [USERID_KEY, OVERDRAFT_LIMIT_KEY], OVERDRAFT_LIMIT_KEY),
+            (TRANACTIONS_TABLE, self.create_transactions_table, 
+                [SEQ_KEY, USERID_KEY, VALUE_KEY, TIMESTAMP_KEY, DESCRIPTION_KEY, ID_KEY], VALUE_KEY),
+            (BALANCE_SNAPSHOTS_TABLE, self.create_balance_snapshots_table, [USERID_KEY, TIMESTAMP_KEY, BALANCE_KEY], 
+                BALANCE_KEY),
+        ]
+        for table, create_table, columns, money_column in tables:
+            temp_table = f'{table}_new'
+            create_table(conn=conn, table_name=temp_table)
+            values = [f'CAST(ROUND({column} * {MINOR_UNITS}) AS INTEGER)' if column == money_column else column 
+                for column in columns]
+            cursor.execute(f'''INSERT INTO {temp_table} ({", ".join(columns)}) 
+                SELECT {", ".join(values)} FROM {table}''')
+            cursor.execute(f'DROP TABLE {table}')
+            cursor.execute(f'ALTER TABLE {temp_table} RENAME TO {table}')
+
+        # keep the sequence where it was, so the changes feed never sees a seq twice
+        cursor.execute("UPDATE sqlite_sequence SET seq=MAX(seq, ?) WHERE name=?", (last_seq, TRANACTIONS_TABLE))
+        # the amounts of the jobs and of the stored idempotent requests
+        cursor.execute(f'''UPDATE {JOBS_TABLE} SET {ACTION_PARAMS_KEY}=json_set({ACTION_PARAMS_KEY}, '$.value', 
+            CAST(ROUND(json_extract({ACTION_PARAMS_KEY}, '$.value') * {MINOR_UNITS}) AS INTEGER)), 
+            {ROW_VERSION_KEY}={ROW_VERSION_KEY}+1''')
+        cursor.execute(f'''UPDATE {IDEMPOTENCY_KEYS_TABLE} SET {REQUEST_KEY}=json_set({REQUEST_KEY}, '$[1]', 
+            CAST(ROUND(json_extract({REQUEST_KEY}, '$[1]') * {MINOR_UNITS}) AS INTEGER))''')
+        cursor.close()
+
+        # the indexes and triggers were dropped with the tables
+        self.create_transactions_indexes(conn=conn)
+        self.create_balance_snapshots_trigger(conn=conn)
+        self.create_balance_writes_counter(conn=conn)
+
+    @reuse_conn
+    def create_balance_snapshots_table(self, conn: sqlite3.Connection=None, table_name: str=BALANCE_SNAPSHOTS_TABLE):
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table_name} (
+                {USERID_KEY} TEXT NOT NULL,
+                {TIMESTAMP_KEY} INTEGER NOT NULL,
+                {BALANCE_KEY} INTEGER NOT NULL,
+                PRIMARY KEY ({USERID_KEY}, {TIMESTAMP_KEY})
+            )
+        ''')
+        cursor.close()
+        if table_name == BALANCE_SNAPSHOTS_TABLE:
+            self.create_balance_snapshots_trigger(conn=conn)
+
+    @reuse_conn
+    def create_balance_snapshots_trigger(self, conn: sqlite3.Connection=None):
+        # a transaction that is inserted with a timestamp older than a snapshot (e.g. a transfer in the same second)
+        # is part of that snapshot balance. The trigger keeps the snapshots correct for every path that moves the
+        # balance, without extra statements in the transfer code ('force_add_transaction' doesn't move it, and undoes
+        # the adjustment)
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {BALANCE_SNAPSHOTS_TRIGGER} AFTER INSERT ON {TRANACTIONS_TABLE}
+            BEGIN
+                UPDATE {BALANCE_SNAPSHOTS_TABLE} SET {BALANCE_KEY}={BALANCE_KEY} + NEW.{VALUE_KEY} 
+                WHERE {USERID_KEY}=NEW.{USERID_KEY} AND {TIMESTAMP_KEY}>=NEW.{TIMESTAMP_KEY};
+            END
+        ''')
+        cursor.close()
+
+    def set_wal_mode(self, conn: sqlite3.Connection):
+        # the journal mode is persistent, it only has to be set once per database file
+        cursor = conn.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        mode = cursor.fetchone()[0]
+        cursor.close()
+        if mode.lower() != 'wal':
+            raise Exception(f"Failed to switch the database to WAL mode (mode={mode})")
+
     def backward_compatibility(self):
         # get database version
         is_migrated = False
-        with sqlite3.connect(self.db_path) as conn:
+        with self.pool.connection() as conn:
             db_version = self.get_database_version(conn=conn)
             while db_version < REQUIRED_DB_VERSION:
                 is_migrated = True
@@ -147,6 +469,37 @@ class Repo:
                 elif db_version == 1:
                     # create the 'jobs' table
                     self.create_jobs_table(conn=conn)
+                elif db_version == 2:
+                    # switch from the rollback journal to WAL, so readers and the writer don't block each other
+                    self.set_wal_mode(conn)
+                elif db_version == 3:
+                    # index the transactions table
+                    self.create_transactions_indexes(conn=conn)
+                elif db_version == 4:
+                    # number the transactions, for the changes feed
+                    self.add_transactions_seq(conn=conn)
+                elif db_version == 5:
+                    # balance snapshots, for the historical balance lookups
+                    self.create_balance_snapshots_table(conn=conn)
+                    self.checkpoint_balances(conn=conn)
+                elif db_version == 6:
+                    # keep the next run time of the jobs, for the jobs scheduler
+                    self.add_jobs_next_run(conn=conn)
+                elif db_version == 7:
+                    # version the jobs, for the parsed jobs cache
+                    self.add_jobs_row_version(conn=conn)
+                elif db_version == 8:
+                    # count the balance writes, for the balance cache
+                    self.create_balance_writes_counter(conn=conn)
+                elif db_version == 9:
+                    # store the results of the requests with an idempotency key
+                    self.create_idempotency_keys_table(conn=conn)
+                elif db_version == 10:
+                    # integer minor units instead of floats
+                    self.convert_money_to_minor_units(conn=conn)
+                elif db_version == 11:
+                    # count the jobs writes, for the active instance to pick up the jobs changed by the others
+                    self.create_jobs_writes_counter(conn=conn)
                 else:
                     raise Exception(f"Unknown database version {db_version}")
 
@@ -161,38 +514,23 @@ class Repo:
     
         print(f"Database is up to date (version={db_version})")
 
-    def create_database(self):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        # Create the 'balance' table
-        cursor.execute(f'''
-            CREATE TABLE IF NOT EXISTS {BALANCE_TABLE} (
-                {USERID_KEY} TEXT PRIMARY KEY,
-                {BALANCE_KEY} REAL NOT NULL
-            )
-        ''')
-        # Create the 'user' table
-        cursor.execute(f'''
-            CREATE TABLE IF NOT EXISTS {USER_TABLE} (
-                {USERID_KEY} TEXT PRIMARY KEY,
-                {OVERDRAFT_LIMIT_KEY} REAL NOT NULL
-            )
-        ''')
+    @reuse_conn
+    def create_database(self, conn: sqlite3.Connection=None):
+        self.set_wal_mode(conn)
+        self.create_balance_table(conn=conn)
+        self.create_user_table(conn=conn)
         # create the tranctions table
-        cursor.execute(f'''
-            CREATE TABLE IF NOT EXISTS {TRANACTIONS_TABLE} (
-                {USERID_KEY} TEXT NOT NULL,
-                {VALUE_KEY} REAL NOT NULL,
-                {TIMESTAMP_KEY} INTEGER NOT NULL,
-                {DESCRIPTION_KEY} TEXT NOT NULL,
-                {ID_KEY} TEXT NOT NULL
-            )
-        ''')
+        self.create_transactions_table(conn=conn)
+        self.create_transactions_indexes(conn=conn)
+        self.create_balance_snapshots_table(conn=conn)
         # create the version table
-        self.create_version_table(conn)
-        self.create_jobs_table(conn)
-        conn.commit()
-        conn.close()
+        self.create_version_table(conn=conn)
+        self.create_jobs_table(conn=conn)
+        self.add_jobs_next_run(conn=conn)
+        self.add_jobs_row_version(conn=conn)
+        self.create_balance_writes_counter(conn=conn)
+        self.create_idempotency_keys_table(conn=conn)
+        self.create_jobs_writes_counter(conn=conn)
 
     def _process_job(self, job_info: JobInfo, ts: datetime, conn: sqlite3.Connection, 
             is_catching_up: bool=False):
@@ -201,17 +539,24 @@ class Repo:
         last_run_status = 0
         last_run_error = ''
 
-        action_params = json.loads(job_info.action_params)
+        action_params = self.get_compiled_job(job_info.id, job_info.row_version, job_info.cron, 
+            job_info.action_params).action_params
         desc = action_params.get('description', '')
         if is_catching_up:
             desc += f" (catching up to {ts.isoformat()})"
         if job_info.action == ActionType.TRANSFER.value:
+            # fenced by the lease in the transfer's transaction, a standby may have taken over the jobs meanwhile
+            self.begin_write(conn)
+            self.jobs_lock.check_lease(conn)
             success, msg = self.transfer_money(job_info.userid, action_params['to'], action_params['value'], desc, 
                 conn=conn)
             if not success:
                 logging.error(f"Failed to run job '{job_info.id}': {msg}")
                 last_run_status = -1 
                 last_run_error = msg
+            JOB_RUNS.inc(status='success' if success else 'failed')
+            if is_catching_up:
+                JOB_CATCH_UP_RUNS.inc()
         else:
             raise Exception(f"Unknown action type {job_info.action}")
         
@@ -222,6 +567,88 @@ class Repo:
         cursor.close()
         conn.commit()
 
+    def _catch_up_job(self, job_info: JobInfo, missed_times: List[datetime], conn: sqlite3.Connection):
+        """
+        Runs the missed runs of a job in a single transaction, same as calling '_process_job' for each of them 
+        (with is_catching_up=True), but with one balance update per user and one commit
+        """
+        if job_info.action != ActionType.TRANSFER.value:
+            raise Exception(f"Unknown action type {job_info.action}")
+
+        action_params = self.get_compiled_job(job_info.id, job_info.row_version, job_info.cron, 
+            job_info.action_params).action_params
+        desc = action_params.get('description', '')
+        from_userid = job_info.userid
+        to_userid = action_params['to']
+        value = action_params['value']
+
+        # the balance is read and then updated, keep other writers out in between
+        self.begin_write(conn)
+        self.jobs_lock.check_lease(conn)
+        cursor = conn.cursor()
+        try:
+            cursor.execute(f'''SELECT b.{BALANCE_KEY}, u.{OVERDRAFT_LIMIT_KEY} FROM {BALANCE_TABLE} b 
+                JOIN {USER_TABLE} u ON u.{USERID_KEY}=b.{USERID_KEY} WHERE b.{USERID_KEY}=?''', (from_userid,))
+            from_row = cursor.fetchone()
+            cursor.execute(f'SELECT 1 FROM {BALANCE_TABLE} WHERE {USERID_KEY}=?', (to_userid,))
+            to_exists = cursor.fetchone() is not None
+
+            # replay the runs against the balance, so each one sees the balance the previous ones left
+            balance = from_row[0] if from_row is not None else None
+            timestamp = int(datetime.now().timestamp())
+            rows = []
+            n_failed = 0
+            last_run_status = 0
+            last_run_error = ''
+            for ts in missed_times:
+                msg = None
+                if from_row is None:
+                    msg = f"Transfer failed: transferring user '{from_userid}' not found"
+                elif balance + from_row[1] < value:
+                    msg = 'Insufficient funds'
+                elif not to_exists:
+                    msg = f"Transfer failed: target user '{to_userid}' not found"
+
+                if msg is not None:
+                    n_failed += 1
+                    last_run_status = -1
+                    last_run_error = msg
+                    continue
+
+                last_run_status = 0
+                last_run_error = ''
+                if to_userid != from_userid:
+                    balance -= value
+                run_desc = desc + f" (catching up to {ts.isoformat()})"
+                guid = str(uuid.uuid4())
+                rows.append((from_userid, -value, timestamp, run_desc, guid))
+                rows.append((to_userid, value, timestamp, run_desc, guid))
+
+            if n_failed > 0:
+                logging.error(f"Failed to run {n_failed} of {len(missed_times)} missed runs of job '{job_info.id}'," +
+                    f" last error: {last_run_error}")
+            JOB_RUNS.inc(len(missed_times) - n_failed, status='success')
+            JOB_RUNS.inc(n_failed, status='failed')
+            JOB_CATCH_UP_RUNS.inc(len(missed_times))
+
+            if len(rows) > 0:
+                total = value * (len(rows) // 2)
+                cursor.execute(f'UPDATE {BALANCE_TABLE} SET {BALANCE_KEY}={BALANCE_KEY}-? WHERE {USERID_KEY}=?', 
+                    (total, from_userid))
+                cursor.execute(f'UPDATE {BALANCE_TABLE} SET {BALANCE_KEY}={BALANCE_KEY}+? WHERE {USERID_KEY}=?', 
+                    (total, to_userid))
+                balances = self.get_balances_for_update([from_userid, to_userid], cursor)
+                cursor.executemany(f'''INSERT INTO {TRANACTIONS_TABLE} ({USERID_KEY}, {VALUE_KEY}, {TIMESTAMP_KEY}, 
+                    {DESCRIPTION_KEY}, {ID_KEY}) VALUES (?, ?, ?, ?, ?)''', rows)
+                self.update_balance_cache_after_commit(conn, balances, 2)
+                self.publish_after_commit(conn, self.get_last_seq(conn=conn))
+
+            cursor.execute(f'''UPDATE {JOBS_TABLE} SET {LAST_RUN_KEY}=?, {LAST_RUN_STATUS_KEY}=?, {LAST_RUN_ERROR_KEY}=? 
+                WHERE {ID_KEY}=?''', (int(missed_times[-1].timestamp()), last_run_status, last_run_error, job_info.id))
+        finally:
+            cursor.close()
+        conn.commit()
+
     def process_job(self, job_info: JobInfo, conn: sqlite3.Connection):
         # if a job did not run for more than 60 days, we don't handle missed events
         # this is to prevent a scenario of loading very old database causing problems
@@ -233,160 +660,857 @@ class Repo:
             logging.warning(f"Job '{job_info.id}' did not run for more than {OLD_JOBS_HANDLING_MAX_TIME} days," + 
                 " disabling 'handle_missed_events'")
             
-        cron = CronTab()
-        cron.from_line(job_info.cron)
-        next_run = cron.get_next_run(last_run)
-        
-        missed_events_times = []
-        
+        cron = self.get_compiled_job(job_info.id, job_info.row_version, job_info.cron, job_info.action_params).cron
+        now = datetime.now()
         if is_handle_missed_events:
-            # calculate the number of missed events
-            while next_run < datetime.now():
-                missed_events_times.append(next_run)
-                next_run = cron.get_next_run(next_run)
-        
-            for ts in missed_events_times[:-1]:
-                self._process_job(job_info, ts, conn=conn, is_catching_up=True)
-            
-            # the last missed event is the next run time
-            next_run = missed_events_times[-1] if len(missed_events_times) > 0 else next_run
+            # all the runs since the last one, in one pass over the schedule
+            missed_events_times = cron.get_runs_between(last_run, now)
+            if len(missed_events_times) > 1:
+                # the last missed event is the next run time, it runs below
+                if self.config.batch_catch_up:
+                    self._catch_up_job(job_info, missed_events_times[:-1], conn=conn)
+                else:
+                    for ts in missed_events_times[:-1]:
+                        self._process_job(job_info, ts, conn=conn, is_catching_up=True)
+            is_due = len(missed_events_times) > 0
+        else:
+            # the missed runs are skipped, only whether a run is due matters (no need to enumerate them)
+            is_due = cron.get_next_run(last_run) < now
         
-        if next_run < datetime.now():
+        if is_due:
             self._process_job(job_info, ts=datetime.now(), conn=conn)
 
-    def process_jobs(self):
-        # get all the jobs
-        conn = sqlite3.connect(self.db_path)
+    def get_compiled_job(self, job_id: str, row_version: int, cron_line: str, action_params: str) -> CompiledJob:
+        """
+        Returns the parsed cron and the decoded action params of a job, they are parsed once per version of the job
+        (the version is bumped whenever the job is changed through 'update_job')
+        """
+        cached: CompiledJob = self.jobs_cache.get(job_id)
+        if cached is None or cached.row_version != row_version:
+            cron = CronTab()
+            cron.from_line(cron_line)
+            cron.compile()
+            cached = CompiledJob(row_version=row_version, cron=cron, action_params=json.loads(action_params))
+            self.jobs_cache[job_id] = cached
+        return cached
+
+    def get_job_next_run(self, cron: CronTab, last_run: int, after: int=None) -> int:
+        """
+        Returns the first time (epoch seconds) a job should run after 'last_run', may be in the past.
+        after: the run time that was just handled, the next run is always later (so a job that didn't run is never
+        rescheduled to the same time over and over)
+        """
+        # the same start as process_job's (it adds a second to the last run), a run it would skip is never scheduled,
+        # and it doesn't look further back than OLD_JOBS_HANDLING_MAX_TIME (get_next_run is strictly after its start)
+        start = max(datetime.fromtimestamp(last_run + 1), 
+            datetime.now() - timedelta(days=OLD_JOBS_HANDLING_MAX_TIME))
+        if after is not None:
+            start = max(start, datetime.fromtimestamp(after))
+        return int(cron.get_next_run(start).timestamp())
+
+    @reuse_conn
+    def reschedule_job(self, job_id: str, due_time: int=None, conn: sqlite3.Connection=None):
+        """
+        Updates the next run time of a job after it was run, added or changed (or unschedules a deleted job).
+        due_time: the run time the job was just run for
+        """
+        # the job is read and then updated, a deferred transaction could fail to upgrade to a write
+        self.begin_write(conn)
         cursor = conn.cursor()
-        cursor.execute(f'SELECT {ID_KEY} FROM {JOBS_TABLE}')
-        jobs_ids = [row[0] for row in cursor.fetchall()]
+        cursor.execute(f'''SELECT {ROW_VERSION_KEY}, {CRON_KEY}, {ACTION_PARAMS_KEY}, {LAST_RUN_KEY} FROM {JOBS_TABLE} 
+            WHERE {ID_KEY}=?''', (job_id,))
+        result = cursor.fetchone()
+        if result is None:
+            cursor.close()
+            self.job_scheduler.remove(job_id)
+            self.jobs_cache.pop(job_id, None)
+            return
+
+        row_version, cron_line, action_params, last_run = result
+        compiled = self.get_compiled_job(job_id, row_version, cron_line, action_params)
+        next_run = self.get_job_next_run(compiled.cron, last_run, after=due_time)
+        cursor.execute(f'UPDATE {JOBS_TABLE} SET {NEXT_RUN_KEY}=? WHERE {ID_KEY}=?', (next_run, job_id))
         cursor.close()
-        conn.commit() # close the transactions, se we want to handle each job in a separate transaction
-        for job_id in jobs_ids:
-            cursor = conn.cursor()
-            cursor.execute(f'''SELECT {ID_KEY}, {USERID_KEY}, {CRON_KEY}, {ACTION_KEY}, {ACTION_PARAMS_KEY}, 
-                {DESCRIPTION_KEY}, {LAST_RUN_KEY}, {LAST_RUN_STATUS_KEY}, {LAST_RUN_ERROR_KEY}, 
-                {HANDLE_MISSED_EVENTS_KEY} FROM {JOBS_TABLE} WHERE {ID_KEY}=?
-                ''', (job_id,))
-            
-            result = cursor.fetchone()
-            if result is None:
-                # job was deleted, That's weird, but not neccessarily an error
-                logging.warning(f"Job '{job_id}' was deleted while processing it")
-            else:
-                job_info = JobInfo(*result)
+        conn.commit()
+        self.job_scheduler.schedule(job_id, next_run)
+
+    @reuse_conn
+    def update_jobs(self, conn: sqlite3.Connection=None):
+        """
+        Reloads the jobs schedule from the jobs table, call it after jobs were added, changed or deleted
+        (or use 'reschedule_job' for a single job)
+        """
+        # read before the jobs, a change committed in between is picked up by the next 'check_jobs_writes'
+        self.known_jobs_writes = self.get_jobs_writes(conn=conn)
+        cursor = conn.cursor()
+        cursor.execute(f'''SELECT {ID_KEY}, {ROW_VERSION_KEY}, {CRON_KEY}, {ACTION_PARAMS_KEY}, {LAST_RUN_KEY}, 
+            {NEXT_RUN_KEY} FROM {JOBS_TABLE}''')
+        next_runs = {}
+        unscheduled = []
+        for job_id, row_version, cron_line, action_params, last_run, next_run in cursor.fetchall():
+            if next_run is None:
+                compiled = self.get_compiled_job(job_id, row_version, cron_line, action_params)
+                next_run = self.get_job_next_run(compiled.cron, last_run)
+                unscheduled.append((next_run, job_id))
+            next_runs[job_id] = next_run
+
+        if len(unscheduled) > 0:
+            cursor.executemany(f'UPDATE {JOBS_TABLE} SET {NEXT_RUN_KEY}=? WHERE {ID_KEY}=?', unscheduled)
+        cursor.close()
+        conn.commit()
+        # forget the deleted jobs
+        for job_id in set(self.jobs_cache.keys()) - set(next_runs.keys()):
+            self.jobs_cache.pop(job_id, None)
+        self.job_scheduler.reset(next_runs)
+
+    def check_jobs_writes(self):
+        """
+        Reloads the jobs schedule if jobs were added, changed or deleted since it was loaded, e.g. through the API of
+        a standby instance (its scheduler doesn't run them). Called periodically on the active instance
+        """
+        if not self.jobs_lock.is_locked:
+            return
+        if self.get_jobs_writes() != self.known_jobs_writes:
+            self.update_jobs()
+
+    @reuse_read_conn
+    def run_due_jobs(self, job_ids: List[str], conn: sqlite3.Connection=None):
+        """
+        Hands the jobs the scheduler found due to the job workers, the jobs are partitioned by the accounts they 
+        touch, so jobs of unrelated users run concurrently and jobs that share an account run in order
+        """
+        if not self.jobs_lock.is_locked:
+            # a standby, e.g. a job was added through this instance (the active instance picks it up in 
+            # 'check_jobs_writes')
+            return
+
+        start = time.perf_counter()
+        try:
+            for job_id in job_ids:
+                cursor = conn.cursor()
+                cursor.execute(f'''SELECT {USERID_KEY}, {ROW_VERSION_KEY}, {CRON_KEY}, {ACTION_PARAMS_KEY}, 
+                    {NEXT_RUN_KEY} FROM {JOBS_TABLE} WHERE {ID_KEY}=?''', (job_id,))
+                result = cursor.fetchone()
+                cursor.close()
+                if result is None:
+                    logging.warning(f"Job '{job_id}' was deleted before it was run")
+                    self.job_scheduler.remove(job_id)
+                    continue
+
+                userid, row_version, cron_line, action_params, next_run = result
+                accounts = {userid}
+                to_userid = self.get_compiled_job(job_id, row_version, cron_line, action_params).action_params.get('to')
+                if to_userid is not None:
+                    accounts.add(to_userid)
+                self.job_executor.submit(accounts, functools.partial(self.run_job, job_id, next_run), name=job_id)
+        finally:
+            JOBS_LAST_TICK_SECONDS.set(time.perf_counter() - start)
+            JOBS_LAST_TICK_DUE_JOBS.set(len(job_ids))
+
+    def run_job(self, job_id: str, due_time: int=None):
+        """Runs a due job and schedules its next run (after 'due_time', the run time it was due at), on a job worker"""
+        with JOB_RUN_SECONDS.time():
+            self.retry_job_step(job_id, 'process', lambda: self._run_job(job_id))
+        if not self.jobs_lock.is_locked:
+            # the jobs run on another instance now
+            return
+        if not self.retry_job_step(job_id, 'reschedule', lambda: self.reschedule_job(job_id, due_time=due_time)):
+            # the scheduler already popped the job, keep it at the run it was due at instead of dropping it (its
+            # runs were recorded, so running it again is a no-op until its next run is due)
+            if due_time is not None:
+                self.job_scheduler.schedule(job_id, due_time)
+
+    def _run_job(self, job_id: str):
+        # every attempt starts from the job as it's in the database, a failed attempt may have committed some 
+        # of the runs (e.g. the catch up runs) and they are not repeated
+        with self.pool.connection() as conn:
+            job_info = self.get_job(job_id, conn=conn)
+            conn.commit()
+            if job_info is not None:
                 self.process_job(job_info, conn=conn)
 
-            cursor.close()
-                
-        conn.close()        
+    def retry_job_step(self, job_id: str, step: str, func: Callable[[], None]) -> bool:
+        """Calls 'func', retrying it while another writer holds the database, returns whether it succeeded"""
+        for attempt in range(JOB_RETRY_ATTEMPTS):
+            try:
+                func()
+                return True
+            except JobsLockLost as e:
+                logging.error(f"Failed to {step} job '{job_id}': {e}")
+                return False
+            except sqlite3.OperationalError as e:
+                # another writer holds the database for longer than the busy timeout
+                if not is_database_locked(e) or attempt == JOB_RETRY_ATTEMPTS - 1:
+                    logging.exception(f"Failed to {step} job '{job_id}': {e}")
+                    return False
+                with self.jobs_stats_lock:
+                    self.job_retries += 1
+                time.sleep(JOB_RETRY_DELAY * 2 ** attempt)
+            except Exception as e:
+                logging.exception(f"Failed to {step} job '{job_id}': {e}")
+                return False
+
+    @reuse_read_conn
+    def get_job(self, job_id: str, conn: sqlite3.Connection=None) -> JobInfo:
+        """Returns the job, None if there is no such job"""
+        cursor = conn.cursor()
+        cursor.execute(f'SELECT {JOB_COLUMNS} FROM {JOBS_TABLE} WHERE {ID_KEY}=?', (job_id,))
+        result = cursor.fetchone()
+        cursor.close()
+
+        return JobInfo(*result) if result is not None else None
+
+    @reuse_read_conn
+    def get_user_jobs(self, userid: str, conn: sqlite3.Connection=None) -> List[JobInfo]:
+        cursor = conn.cursor()
+        cursor.execute(f'SELECT {JOB_COLUMNS} FROM {JOBS_TABLE} WHERE {USERID_KEY}=? ORDER BY {ID_KEY}', (userid,))
+        res = [JobInfo(*row) for row in cursor.fetchall()]
+        cursor.close()
+
+        return res
+
+    def check_job_users(self, userid: str, to_userid: str, conn: sqlite3.Connection):
+        cursor = conn.cursor()
+        for user in [userid, to_userid]:
+            cursor.execute(f'SELECT 1 FROM {USER_TABLE} WHERE {USERID_KEY}=?', (user,))
+            if cursor.fetchone() is None:
+                cursor.close()
+                raise UserNotFound(f"User '{user}' not found")
+        cursor.close()
+
+    @reuse_conn
+    def add_job(self, userid: str, cron_line: str, to_userid: str, value: int, description: str, 
+            handle_missed_events: bool=False, conn: sqlite3.Connection=None) -> str:
+        """
+        Adds a job that transfers 'value' from 'userid' to 'to_userid' on the 'cron_line' schedule, returns its id.
+        raises CronParsingException for an invalid cron line and UserNotFound for an unknown user
+        """
+        cron = CronTab()
+        cron.from_line(cron_line)
+        self.check_job_users(userid, to_userid, conn)
+
+        job_id = str(uuid.uuid4())
+        action_params = json.dumps({'to': to_userid, 'value': value, 'description': description})
+        # the schedule starts now, there are no missed runs to catch up on
+        last_run = int(datetime.now().timestamp())
+        next_run = self.get_job_next_run(cron, last_run)
+        cursor = conn.cursor()
+        cursor.execute(f'INSERT INTO {JOBS_TABLE} ({JOB_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', 
+            (job_id, userid, cron_line, ActionType.TRANSFER.value, action_params, description, last_run, 0, '', 
+            int(handle_missed_events), 0, next_run))
+        cursor.close()
+        # the scheduler must not see the job before it's committed
+        conn.after_commit(lambda: self.job_scheduler.schedule(job_id, next_run))
+
+        return job_id
+
+    @reuse_conn
+    def update_job(self, job_id: str, cron_line: str=None, to_userid: str=None, value: int=None, 
+            description: str=None, handle_missed_events: bool=None, conn: sqlite3.Connection=None) -> bool:
+        """
+        Changes the given fields of a job (the others are kept), returns False if there is no such job.
+        raises CronParsingException for an invalid cron line and UserNotFound for an unknown user
+        """
+        job_info = self.get_job(job_id, conn=conn)
+        if job_info is None:
+            return False
+
+        action_params = dict(json.loads(job_info.action_params))
+        if to_userid is not None:
+            self.check_job_users(job_info.userid, to_userid, conn)
+            action_params['to'] = to_userid
+        if value is not None:
+            action_params['value'] = value
+        if description is not None:
+            action_params['description'] = description
+
+        last_run = job_info.last_run
+        if cron_line is not None and cron_line != job_info.cron:
+            CronTab().from_line(cron_line)
+            # the new schedule starts now, the runs it would have had in the past are not caught up on
+            last_run = int(datetime.now().timestamp())
+
+        cursor = conn.cursor()
+        cursor.execute(f'''UPDATE {JOBS_TABLE} SET {CRON_KEY}=?, {ACTION_PARAMS_KEY}=?, {DESCRIPTION_KEY}=?, 
+            {HANDLE_MISSED_EVENTS_KEY}=?, {LAST_RUN_KEY}=?, {ROW_VERSION_KEY}={ROW_VERSION_KEY}+1, {NEXT_RUN_KEY}=NULL 
+            WHERE {ID_KEY}=?''', (cron_line or job_info.cron, json.dumps(action_params), 
+            description if description is not None else job_info.description, 
+            int(handle_missed_events) if handle_missed_events is not None else job_info.handle_missed_events, 
+            last_run, job_id))
+        cursor.close()
+        conn.after_commit(lambda: self.reschedule_job(job_id))
 
-    def __init__(self, db_path: str, create: bool=False, ):
+        return True
+
+    @reuse_conn
+    def delete_job(self, job_id: str, conn: sqlite3.Connection=None) -> bool:
+        """returns False if there is no such job"""
+        cursor = conn.cursor()
+        cursor.execute(f'DELETE FROM {JOBS_TABLE} WHERE {ID_KEY}=?', (job_id,))
+        deleted = cursor.rowcount > 0
+        cursor.close()
+        if deleted:
+            conn.after_commit(lambda: self.reschedule_job(job_id))
+
+        return deleted
+
+    def get_jobs_stats(self) -> JobsStats:
+        executor_stats = self.job_executor.get_stats()
+        with self.jobs_stats_lock:
+            retries = self.job_retries
+        return JobsStats(jobs=self.job_scheduler.get_job_count(), queued=executor_stats.queued, 
+            running=executor_stats.running, executed=executor_stats.executed, failed=executor_stats.failed, 
+            retries=retries, total_time=executor_stats.total_time, max_time=executor_stats.max_time)
+
+    def __init__(self, db_path: str, create: bool=False, config: RepoConfig=None):
         thread_safe = sqlite3.threadsafety
         if thread_safe < 1:
             raise Exception(f"sqlite3 is not thread safe (level={thread_safe}). Level 1 or higher is required")
         
         self.db_path = db_path
+        self.config = config or RepoConfig()
+        pragmas = {
+            'synchronous': self.config.synchronous,
+            'cache_size': self.config.cache_size,
+            'mmap_size': self.config.mmap_size,
+            'busy_timeout': self.config.busy_timeout,
+        }
+        self.sql_profiler = SqlProfiler(db_path, self.config.slow_query_time) if self.config.profile_sql else None
+        on_connect = self.sql_profiler.attach if self.sql_profiler is not None else None
+        # all the database access goes through the pools, connections are kept open for the lifetime of the repo
+        self.pool = ConnectionPool(db_path, max_size=self.config.pool_size, timeout=self.config.pool_timeout, 
+            pragmas=pragmas, on_connect=on_connect)
+        self.read_pool = ConnectionPool(db_path, max_size=self.config.read_pool_size, 
+            timeout=self.config.pool_timeout, pragmas=pragmas, read_only=True, on_connect=on_connect)
         if create:
             self.create_database()
         else:
             self.backward_compatibility()
 
-        self.jobs_cache = {}
-        # take the jobs lock so only one instance of the job processor is running at a time
-        self.jobs_lock = JobsLock(db_path)
+        self.balance_cache = BalanceCache(db_path, self.load_cached_balance)
+        # transactions written by other processes are not published, the waiters find them when they time out
+        self.change_notifier = ChangeNotifier(self.get_last_seq())
+
+        # job id -> the parsed job, see 'get_compiled_job'
+        self.jobs_cache: Dict[str, CompiledJob] = {}
+        # the jobs are run when they are due, instead of scanning all the jobs periodically
+        self.job_executor = PartitionedExecutor(self.config.job_workers)
+        self.jobs_stats_lock = threading.Lock()
+        self.job_retries = 0
+        self.job_scheduler = JobScheduler(self.run_due_jobs)
+        self.job_scheduler.start()
+        self.known_jobs_writes = None
+        # only the instance that holds the jobs lock runs the jobs, the others stand by until its lease expires
+        self.jobs_lock = JobsLock(db_path, lease_time=self.config.jobs_lease_time, 
+            on_acquired=self.on_jobs_lock_acquired, on_lost=self.on_jobs_lock_lost)
+        self.jobs_lock.start()
         self.scheduler = BackgroundScheduler()
-        self.scheduler.add_job(self.process_jobs, 'interval', seconds=60)
+        self.scheduler.add_job(self.checkpoint_balances, 'interval', minutes=BALANCE_SNAPSHOTS_INTERVAL)
+        self.scheduler.add_job(self.prune_idempotency_keys, 'interval', minutes=IDEMPOTENCY_KEYS_PRUNE_INTERVAL)
+        self.scheduler.add_job(self.check_jobs_writes, 'interval', 
+            seconds=self.config.jobs_lease_time / HEARTBEATS_PER_LEASE)
         self.scheduler.start()
+        REGISTRY.add_collector(self.collect_metrics)
         
-    def get_user_balance(self, userid):
-        conn = sqlite3.connect(self.db_path)
+    def get_user_balance(self, userid, conn: sqlite3.Connection=None):
+        """The balance is served from the balance cache, unless a connection (and its transaction) is given"""
+        if conn is not None:
+            return self.read_user_balance(userid, conn=conn)
+
+        entry = self.balance_cache.get(userid)
+        if entry is None:
+            raise UserNotFound(f"User '{userid}' not found")
+        return entry.balance
+
+    @reuse_read_conn
+    def read_user_balance(self, userid, conn: sqlite3.Connection=None):
         cursor = conn.cursor()
         cursor.execute(f'SELECT {BALANCE_KEY} FROM {BALANCE_TABLE} WHERE {USERID_KEY}=?', (userid,))
         res = cursor.fetchone()
+        cursor.close()
         if res is None:
             raise UserNotFound(f"User '{userid}' not found")
         
         return res[0]
+
+    @reuse_read_conn
+    def load_cached_balance(self, userid: str, conn: sqlite3.Connection=None) -> CachedBalance:
+        """Reads a user balance for the balance cache, None if there is no such user"""
+        cursor = conn.cursor()
+        # a single statement reads a consistent snapshot, the balance is as of the version (the balance writes counter)
+        cursor.execute(f'''SELECT b.{BALANCE_KEY}, u.{OVERDRAFT_LIMIT_KEY}, 
+            (SELECT {BALANCE_WRITES_COUNTER_KEY} FROM {BALANCE_WRITES_TABLE}) 
+            FROM {BALANCE_TABLE} b LEFT JOIN {USER_TABLE} u ON u.{USERID_KEY}=b.{USERID_KEY} 
+            WHERE b.{USERID_KEY}=?''', (userid,))
+        res = cursor.fetchone()
+        cursor.close()
+
+        return CachedBalance(*res) if res is not None else None
+
+    def update_balance_cache_after_commit(self, conn: PooledConnection, balances: Dict[str, int], n_writes: int):
+        """
+        Updates the cached balances once the write transaction is committed, must be called after the 'n_writes'
+        balance writes of the transaction were made (a self transfer writes the same balance twice)
+        """
+        version = self.balance_cache.before_commit(conn, n_writes)
+        conn.after_commit(lambda: self.balance_cache.update(balances, version))
+
+    def get_user_generation(self, userid: str) -> int:
+        """A number that changes whenever the user balance or transactions change, it doesn't query the user data"""
+        return self.balance_cache.get_generation(userid)
+
+    def get_balance_cache_stats(self) -> BalanceCacheStats:
+        return self.balance_cache.get_stats()
     
-    def add_user(self, userid, balance):
-        conn = sqlite3.connect(self.db_path)
+    @reuse_conn
+    def add_user(self, userid, balance, conn: sqlite3.Connection=None):
         cursor = conn.cursor()
         cursor.execute(f'INSERT INTO {USER_TABLE} ({USERID_KEY}, {OVERDRAFT_LIMIT_KEY}, {OVERDRAFT_LIMIT_KEY}) VALUES (?, ?, ?)', 
                        (userid, 0, 0))
         cursor.execute(f'INSERT INTO {BALANCE_TABLE} ({USERID_KEY}, {BALANCE_KEY}) VALUES (?, ?)', (userid, balance))
-        conn.commit()
-        conn.close()
+        cursor.close()
+        # two writes, the user and its balance
+        version = self.balance_cache.before_commit(conn, 2)
+        conn.after_commit(lambda: self.balance_cache.invalidate(userid, version))
 
         return True, None
     
-    def force_add_transaction(self, userid: str, value: float, timestamp: int, description: str):
-        conn = sqlite3.connect(self.db_path)
+    def publish_after_commit(self, conn: PooledConnection, seq: int):
+        """Wakes up the changes feed waiters once the transaction that added 'seq' is committed"""
+        conn.after_commit(lambda: self.change_notifier.publish(seq))
+
+    def wait_for_changes(self, after_seq: int, timeout: float) -> bool:
+        """Waits (up to 'timeout' seconds) for a transaction newer than 'after_seq' to be committed"""
+        return self.change_notifier.wait(after_seq, timeout)
+
+    @reuse_conn
+    def force_add_transaction(self, userid: str, value: int, timestamp: int, description: str, 
+            conn: sqlite3.Connection=None):
         cursor = conn.cursor()
         cursor.execute(f'''INSERT INTO {TRANACTIONS_TABLE} ({USERID_KEY}, {VALUE_KEY}, {TIMESTAMP_KEY}, {DESCRIPTION_KEY}, {ID_KEY}) 
             VALUES (?, ?, ?, ?, ?)''', (userid, value, timestamp, description, str(uuid.uuid4()))) 
-        conn.commit()
-        conn.close()
+        self.publish_after_commit(conn, cursor.lastrowid)
+        # the balance already includes the imported transaction, so the snapshots after it (which the snapshots
+        # trigger moved, as for a transfer) must not change either
+        cursor.execute(f'''UPDATE {BALANCE_SNAPSHOTS_TABLE} SET {BALANCE_KEY}={BALANCE_KEY} - ? 
+            WHERE {USERID_KEY}=? AND {TIMESTAMP_KEY}>=?''', (value, userid, timestamp))
+        cursor.close()
+        # the balance doesn't change, but the user generation must
+        bump_balance_writes_counter(conn)
+        version = self.balance_cache.before_commit(conn, 1)
+        conn.after_commit(lambda: self.balance_cache.invalidate(userid, version))
 
         return True, None
     
+    def begin_write(self, conn: PooledConnection):
+        """
+        Starts a transaction that takes the database write lock up front (BEGIN IMMEDIATE), so the rows it reads
+        can't be changed by another connection before it writes, a no-op if the connection is in a transaction
+        """
+        if not conn.in_transaction:
+            conn.begin_immediate()
+
+    @reuse_conn
+    def transfer_money(self, from_userid: str, to_userid: str, value: int, description: str, 
+            idempotency_key: str=None, conn: sqlite3.Connection=None):
+        """
+        idempotency_key: a key the client gives the request, so it can be retried safely. The result of the first
+        request with the key is stored (for IDEMPOTENCY_KEY_TTL) and a repeated request returns it without 
+        transferring again
+        """
+        self.begin_write(conn)
+        if idempotency_key is None:
+            return self._transfer_money(from_userid, to_userid, value, description, conn)
+
+        # both requests run under the write lock, so a concurrent retry sees the first one's result
+        request = json.dumps([to_userid, value, description])
+        result = self.get_idempotent_result(from_userid, idempotency_key, request, conn=conn)
+        if result is not None:
+            TRANSFERS.inc(result=TRANSFER_REPLAYED)
+            return result
+        result = self._transfer_money(from_userid, to_userid, value, description, conn)
+        conn.execute(f'''INSERT OR REPLACE INTO {IDEMPOTENCY_KEYS_TABLE} ({USERID_KEY}, {IDEMPOTENCY_KEY}, {REQUEST_KEY}, 
+            {SUCCESS_KEY}, {ERROR_KEY}, {CREATED_KEY}) VALUES (?, ?, ?, ?, ?, ?)''', 
+            (from_userid, idempotency_key, request, result[0], result[1], int(time.time())))
+        return result
+
     @reuse_conn
-    def transfer_money(self, from_userid: str, to_userid: str, value: float, description: str, 
+    def get_idempotent_result(self, userid: str, idempotency_key: str, request: str, 
+            conn: sqlite3.Connection=None) -> Tuple[bool, str]:
+        """Returns the stored result of a request with the key, None if there is none (or it expired)"""
+        cursor = conn.cursor()
+        cursor.execute(f'''SELECT {REQUEST_KEY}, {SUCCESS_KEY}, {ERROR_KEY} FROM {IDEMPOTENCY_KEYS_TABLE} 
+            WHERE {USERID_KEY}=? AND {IDEMPOTENCY_KEY}=? AND {CREATED_KEY}>?''', 
+            (userid, idempotency_key, int(time.time()) - IDEMPOTENCY_KEY_TTL))
+        res = cursor.fetchone()
+        cursor.close()
+        if res is None:
+            return None
+
+        stored_request, success, error = res
+        if stored_request != request:
+            raise IdempotencyKeyReused(f"Idempotency key '{idempotency_key}' was already used for another request")
+        return bool(success), error
+
+    @reuse_conn
+    def prune_idempotency_keys(self, conn: sqlite3.Connection=None):
+        """Deletes the expired idempotency keys"""
+        conn.execute(f'DELETE FROM {IDEMPOTENCY_KEYS_TABLE} WHERE {CREATED_KEY}<=?', 
+            (int(time.time()) - IDEMPOTENCY_KEY_TTL,))
+
+    def _transfer_money(self, from_userid: str, to_userid: str, value: int, description: str, 
             conn: sqlite3.Connection):
         cursor = conn.cursor()
         try: 
-            cursor.execute(f'SELECT {BALANCE_KEY} FROM {BALANCE_TABLE} WHERE {USERID_KEY}=?', (from_userid,))
-            result = cursor.fetchone()
-            if result is None:
-                return False, f"Transfer failed: transferring user '{from_userid}' not found"
-            from_balance = float(result[0])
-
-            cursor.execute(f'SELECT {OVERDRAFT_LIMIT_KEY} FROM {USER_TABLE} WHERE {USERID_KEY}=?', (from_userid,))
-            overdraft_limit = float(cursor.fetchone()[0])
-            if from_balance + overdraft_limit < value:
+            # relative updates, the debit is guarded by the overdraft check and by the target user existing, so once it
+            # succeeded the credit can't fail (the transaction holds the write lock)
+            cursor.execute(f'''UPDATE {BALANCE_TABLE} SET {BALANCE_KEY}={BALANCE_KEY}-:value 
+                WHERE {USERID_KEY}=:from AND EXISTS (SELECT 1 FROM {BALANCE_TABLE} WHERE {USERID_KEY}=:to) 
+                    AND {BALANCE_KEY} + (SELECT {OVERDRAFT_LIMIT_KEY} FROM {USER_TABLE} WHERE {USERID_KEY}=:from) >= :value
+                ''', {'from': from_userid, 'to': to_userid, 'value': value})
+            # the guarded debit changed no row (sqlite changes())
+            if cursor.rowcount == 0:
+                # nothing was changed, find out why (an extra query only on failure)
+                cursor.execute(f'''SELECT EXISTS (SELECT 1 FROM {BALANCE_TABLE} WHERE {USERID_KEY}=?), 
+                    EXISTS (SELECT 1 FROM {BALANCE_TABLE} WHERE {USERID_KEY}=?)''', (from_userid, to_userid))
+                from_exists, to_exists = cursor.fetchone()
+                if not from_exists or not to_exists:
+                    TRANSFERS.inc(result=TRANSFER_USER_NOT_FOUND)
+                if not from_exists:
+                    return False, f"Transfer failed: transferring user '{from_userid}' not found"
+                if not to_exists:
+                    return False, f"Transfer failed: target user '{to_userid}' not found"
+                TRANSFERS.inc(result=TRANSFER_INSUFFICIENT_FUNDS)
                 return False, 'Insufficient funds'
-            
+
+            cursor.execute(f'UPDATE {BALANCE_TABLE} SET {BALANCE_KEY}={BALANCE_KEY}+? WHERE {USERID_KEY}=?', 
+                (value, to_userid))
+            balances = self.get_balances_for_update([from_userid, to_userid], cursor)
+
             timestamp = int(datetime.now().timestamp())
             guid = str(uuid.uuid4()) # guid is unique for user.
-            cursor.execute(f'SELECT {BALANCE_KEY} FROM {BALANCE_TABLE} WHERE {USERID_KEY}=?', (to_userid,))
-            result = cursor.fetchone()
-            if result is None:
-                return False, f"Transfer failed: target user '{to_userid}' not found"
-            to_balance = float(result[0])
-            cursor.execute(f'UPDATE {BALANCE_TABLE} SET {BALANCE_KEY}=? WHERE {USERID_KEY}=?', (from_balance - value, from_userid))
-            cursor.execute(f'UPDATE {BALANCE_TABLE} SET {BALANCE_KEY}=? WHERE {USERID_KEY}=?', (to_balance + value, to_userid))
-            cursor.execute(f'''INSERT INTO {TRANACTIONS_TABLE} ({USERID_KEY}, {VALUE_KEY}, {TIMESTAMP_KEY}, {DESCRIPTION_KEY}, {ID_KEY}) 
-                            VALUES (?, ?, ?, ?, ?)''', (from_userid, -value, timestamp, description, guid))
-            cursor.execute(f'''INSERT INTO {TRANACTIONS_TABLE} ({USERID_KEY}, {VALUE_KEY}, {TIMESTAMP_KEY}, {DESCRIPTION_KEY}, {ID_KEY}) 
-                            VALUES (?, ?, ?, ?, ?)''', (to_userid, value, timestamp, description, guid))
+            cursor.executemany(f'''INSERT INTO {TRANACTIONS_TABLE} ({USERID_KEY}, {VALUE_KEY}, {TIMESTAMP_KEY}, 
+                {DESCRIPTION_KEY}, {ID_KEY}) VALUES (?, ?, ?, ?, ?)''', 
+                [(from_userid, -value, timestamp, description, guid), (to_userid, value, timestamp, description, guid)])
+            self.update_balance_cache_after_commit(conn, balances, 2)
+            self.publish_after_commit(conn, self.get_last_seq(conn=conn))
         finally:    
             cursor.close()
 
+        TRANSFERS.inc(result=TRANSFER_SUCCESS)
         return True, None
     
-    def get_user_transactions(self, userid: str, last_n: int, from_timestamp: int=None, to_timestamp: int=None):
-        conn = sqlite3.connect(self.db_path)
+    def get_balances_for_update(self, userids: List[str], cursor: sqlite3.Cursor) -> Dict[str, int]:
+        """
+        The new balances of the updated users, read in the write transaction that updated them (instead of 
+        UPDATE ... RETURNING, which needs sqlite 3.35)
+        """
+        userids = list(set(userids))
+        cursor.execute(f'''SELECT {USERID_KEY}, {BALANCE_KEY} FROM {BALANCE_TABLE} 
+            WHERE {USERID_KEY} IN ({', '.join('?' * len(userids))})''', userids)
+        return dict(cursor.fetchall())
+
+    @reuse_conn
+    def transfer_many(self, legs: List[TransferLeg], conn: sqlite3.Connection=None) -> Tuple[bool, List[Tuple[bool, str]]]:
+        """
+        Runs a batch of transfers in a single transaction, all or nothing. The overdraft limit of every paying user 
+        is checked against the net effect of the whole batch (so money received in the batch can be passed on).
+        Returns (success, [(success, error) of each leg]), if any leg fails none of them is executed
+        """
+        if len(legs) == 0:
+            return True, []
+
+        self.begin_write(conn)
         cursor = conn.cursor()
-        where_parts = filter(lambda x: x is not None, [
-            f'{USERID_KEY}=?', 
-            f'{TIMESTAMP_KEY}>={from_timestamp}' if from_timestamp is not None else None,
-            f'{TIMESTAMP_KEY}<={to_timestamp}' if to_timestamp is not None else None
-        ])
+        try:
+            userids = list({userid for leg in legs for userid in (leg.from_userid, leg.to_userid)})
+            cursor.execute(f'''SELECT b.{USERID_KEY}, b.{BALANCE_KEY}, u.{OVERDRAFT_LIMIT_KEY} 
+                FROM json_each(?) AS c JOIN {BALANCE_TABLE} AS b ON b.{USERID_KEY}=c.value 
+                JOIN {USER_TABLE} AS u ON u.{USERID_KEY}=b.{USERID_KEY}''', (json.dumps(userids),))
+            accounts = {userid: (balance, overdraft_limit) for userid, balance, overdraft_limit in cursor.fetchall()}
+
+            net: Dict[str, int] = {}
+            for leg in legs:
+                net[leg.from_userid] = net.get(leg.from_userid, 0) - leg.value
+                net[leg.to_userid] = net.get(leg.to_userid, 0) + leg.value
+
+            results = []
+            for leg in legs:
+                error = None
+                if leg.from_userid not in accounts:
+                    error = f"Transfer failed: transferring user '{leg.from_userid}' not found"
+                elif leg.to_userid not in accounts:
+                    error = f"Transfer failed: target user '{leg.to_userid}' not found"
+                else:
+                    balance, overdraft_limit = accounts[leg.from_userid]
+                    if net[leg.from_userid] < 0 and balance + overdraft_limit + net[leg.from_userid] < 0:
+                        error = 'Insufficient funds'
+                results.append((error is None, error))
+
+            if not all(success for success, _ in results):
+                BATCH_TRANSFERS.inc(result='failed')
+                return False, [(False, error or BATCH_NOT_EXECUTED_ERROR) for _, error in results]
 
-        limit_part = f'LIMIT {last_n}' if last_n is not None else ''
+            # one relative update per user, with its net change (we hold the write lock, so the balances we read are 
+            # the ones we update)
+            deltas = [(delta, userid) for userid, delta in net.items() if delta != 0]
+            cursor.executemany(f'UPDATE {BALANCE_TABLE} SET {BALANCE_KEY}={BALANCE_KEY}+? WHERE {USERID_KEY}=?', 
+                deltas)
+            timestamp = int(datetime.now().timestamp())
+            rows = []
+            for leg in legs:
+                guid = str(uuid.uuid4())
+                rows.append((leg.from_userid, -leg.value, timestamp, leg.description, guid))
+                rows.append((leg.to_userid, leg.value, timestamp, leg.description, guid))
+            cursor.executemany(f'''INSERT INTO {TRANACTIONS_TABLE} ({USERID_KEY}, {VALUE_KEY}, {TIMESTAMP_KEY}, 
+                {DESCRIPTION_KEY}, {ID_KEY}) VALUES (?, ?, ?, ?, ?)''', rows)
+            # the users whose legs cancel out have new transactions too, their generation must change
+            n_writes = len(deltas)
+            if len(deltas) < len(net):
+                bump_balance_writes_counter(conn)
+                n_writes += 1
+            self.update_balance_cache_after_commit(conn, 
+                {userid: accounts[userid][0] + delta for userid, delta in net.items()}, n_writes)
+            self.publish_after_commit(conn, self.get_last_seq(conn=conn))
+        finally:
+            cursor.close()
+
+        BATCH_TRANSFERS.inc(result='success')
+        return True, results
+
+    def get_transactions_filter(self, userid: str, from_timestamp: int=None, to_timestamp: int=None, 
+            after: Tuple[int, str]=None) -> Tuple[str, list]:
+        """
+        Builds the WHERE clause (and its parameters) of the user transactions queries.
+        after: a (timestamp, id) keyset position, only older transactions are selected
+        """
+        # bound parameters keep the statement text stable, so sqlite can reuse the prepared statement
+        where_parts = [f'{USERID_KEY}=?']
+        params = [userid]
+        if from_timestamp is not None:
+            where_parts.append(f'{TIMESTAMP_KEY}>=?')
+            params.append(from_timestamp)
+        if to_timestamp is not None:
+            where_parts.append(f'{TIMESTAMP_KEY}<=?')
+            params.append(to_timestamp)
+        if after is not None:
+            where_parts.append(f'({TIMESTAMP_KEY}, {ID_KEY})<(?, ?)')
+            params.extend(after)
+        
+        return " AND ".join(where_parts), params
+
+    @reuse_read_conn
+    def get_user_transactions(self, userid: str, last_n: int, from_timestamp: int=None, to_timestamp: int=None, 
+            conn: sqlite3.Connection=None):
+        cursor = conn.cursor()
+        where, params = self.get_transactions_filter(userid, from_timestamp, to_timestamp)
+
+        limit_part = ''
+        if last_n is not None:
+            limit_part = 'LIMIT ?'
+            params.append(last_n)
 
         cursor.execute(f'SELECT {TIMESTAMP_KEY}, {VALUE_KEY}, {DESCRIPTION_KEY}, {ID_KEY} FROM {TRANACTIONS_TABLE} ' +
-                       f'WHERE {" AND ".join(where_parts)} ORDER BY {TIMESTAMP_KEY} DESC ' + 
-                       limit_part , (userid,))
+                       f'WHERE {where} ORDER BY {TIMESTAMP_KEY} DESC ' + 
+                       limit_part, params)
+        res = cursor.fetchall()
+        cursor.close()
+
+        return res
+
+    @reuse_read_conn
+    def get_user_transactions_page(self, userid: str, page_size: int, after: Tuple[int, str]=None, 
+            from_timestamp: int=None, to_timestamp: int=None, conn: sqlite3.Connection=None) -> List[tuple]:
+        """
+        Returns a page of the user transactions (newest first), in the same format as 'get_user_transactions'.
+        after: the (timestamp, id) of the last transaction of the previous page, None for the first page
+        The page is located through the index, so the cost of a page doesn't depend on how deep it is
+        """
+        where, params = self.get_transactions_filter(userid, from_timestamp, to_timestamp, after)
+        cursor = conn.cursor()
+        cursor.execute(f'''SELECT {TIMESTAMP_KEY}, {VALUE_KEY}, {DESCRIPTION_KEY}, {ID_KEY} FROM {TRANACTIONS_TABLE} 
+            WHERE {where} ORDER BY {TIMESTAMP_KEY} DESC, {ID_KEY} DESC LIMIT ?''', params + [page_size])
         res = cursor.fetchall()
+        cursor.close()
 
-        conn.close()
         return res
+
+    def iter_user_transactions(self, userid: str, from_timestamp: int=None, to_timestamp: int=None, 
+            batch_size: int=TRANSACTIONS_FETCH_SIZE) -> Iterator[tuple]:
+        """
+        Iterates the user transactions (newest first) from a single server side cursor, 'batch_size' rows are held
+        in memory at a time. The read connection is held until the iteration completes (or the iterator is closed)
+        """
+        where, params = self.get_transactions_filter(userid, from_timestamp, to_timestamp)
+        with self.read_pool.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(f'''SELECT {TIMESTAMP_KEY}, {VALUE_KEY}, {DESCRIPTION_KEY}, {ID_KEY} 
+                    FROM {TRANACTIONS_TABLE} WHERE {where} ORDER BY {TIMESTAMP_KEY} DESC, {ID_KEY} DESC''', params)
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if len(rows) == 0:
+                        break
+                    yield from rows
+            finally:
+                cursor.close()
     
+    @reuse_read_conn
+    def get_users_transactions(self, from_timestamps: Dict[str, int], conn: sqlite3.Connection=None) \
+            -> Dict[str, List[tuple]]:
+        """
+        Returns the transactions of multiple users in a single query.
+        from_timestamps: maps a user id to the timestamp to return transactions from (None for all the history)
+        returns a mapping from user id to its transactions (same format as 'get_user_transactions'), newest first
+        """
+        result = {userid: [] for userid in from_timestamps.keys()}
+        if len(from_timestamps) == 0:
+            return result
+        
+        # the users are passed as a single json parameter, so the statement is the same for any number of users
+        cursors = json.dumps({userid: ts if ts is not None else 0 for userid, ts in from_timestamps.items()})
+        cursor = conn.cursor()
+        cursor.execute(f'''SELECT t.{USERID_KEY}, t.{TIMESTAMP_KEY}, t.{VALUE_KEY}, t.{DESCRIPTION_KEY}, t.{ID_KEY} 
+            FROM json_each(?) AS c JOIN {TRANACTIONS_TABLE} AS t ON t.{USERID_KEY}=c.key AND t.{TIMESTAMP_KEY}>=c.value
+            ORDER BY t.{USERID_KEY}, t.{TIMESTAMP_KEY} DESC''', (cursors,))
+        for row in cursor:
+            result[row[0]].append(row[1:])
+        cursor.close()
+
+        return result
+
+    @reuse_conn
+    def checkpoint_balances(self, conn: sqlite3.Connection=None):
+        """Takes a balance snapshot of every user that has new transactions since its last snapshot"""
+        now = int(datetime.now().timestamp())
+        cursor = conn.cursor()
+        # transactions with future timestamps (if any) are not part of the snapshot
+        cursor.execute(f'''
+            INSERT OR REPLACE INTO {BALANCE_SNAPSHOTS_TABLE} ({USERID_KEY}, {TIMESTAMP_KEY}, {BALANCE_KEY})
+            SELECT b.{USERID_KEY}, :now, b.{BALANCE_KEY} - COALESCE((SELECT SUM(t.{VALUE_KEY}) FROM {TRANACTIONS_TABLE} t 
+                WHERE t.{USERID_KEY}=b.{USERID_KEY} AND t.{TIMESTAMP_KEY}>:now), 0)
+            FROM {BALANCE_TABLE} b
+            WHERE NOT EXISTS (SELECT 1 FROM {BALANCE_SNAPSHOTS_TABLE} s WHERE s.{USERID_KEY}=b.{USERID_KEY})
+                OR EXISTS (SELECT 1 FROM {TRANACTIONS_TABLE} t WHERE t.{USERID_KEY}=b.{USERID_KEY} AND t.{TIMESTAMP_KEY}>
+                    (SELECT MAX(s.{TIMESTAMP_KEY}) FROM {BALANCE_SNAPSHOTS_TABLE} s WHERE s.{USERID_KEY}=b.{USERID_KEY}))
+        ''', {'now': now})
+        cursor.close()
+
+    @reuse_read_conn
+    def get_user_balance_at(self, userid: str, timestamp: int, conn: sqlite3.Connection=None) -> int:
+        """
+        Returns the user balance at the given time (including the transactions of that second).
+        The nearest snapshot is used, so only the transactions between the snapshot and the given time are summed
+        """
+        balance = self.get_user_balance(userid, conn=conn)
+        cursor = conn.cursor()
+        delta_query = f'''SELECT COALESCE(SUM({VALUE_KEY}), 0) FROM {TRANACTIONS_TABLE} 
+            WHERE {USERID_KEY}=? AND {TIMESTAMP_KEY}>? AND {TIMESTAMP_KEY}<=?'''
+        try:
+            # the latest snapshot before the requested time
+            cursor.execute(f'''SELECT {TIMESTAMP_KEY}, {BALANCE_KEY} FROM {BALANCE_SNAPSHOTS_TABLE} 
+                WHERE {USERID_KEY}=? AND {TIMESTAMP_KEY}<=? ORDER BY {TIMESTAMP_KEY} DESC LIMIT 1''', (userid, timestamp))
+            res = cursor.fetchone()
+            if res is not None:
+                snapshot_timestamp, snapshot_balance = res
+                cursor.execute(delta_query, (userid, snapshot_timestamp, timestamp))
+                return snapshot_balance + cursor.fetchone()[0]
+            
+            # no snapshot before the requested time, walk back from the first snapshot after it (or from the current
+            # balance, when there are no snapshots at all)
+            cursor.execute(f'''SELECT {TIMESTAMP_KEY}, {BALANCE_KEY} FROM {BALANCE_SNAPSHOTS_TABLE} 
+                WHERE {USERID_KEY}=? AND {TIMESTAMP_KEY}>? ORDER BY {TIMESTAMP_KEY} LIMIT 1''', (userid, timestamp))
+            res = cursor.fetchone()
+            if res is not None:
+                snapshot_timestamp, snapshot_balance = res
+                cursor.execute(delta_query, (userid, timestamp, snapshot_timestamp))
+                return snapshot_balance - cursor.fetchone()[0]
+            
+            cursor.execute(f'''SELECT COALESCE(SUM({VALUE_KEY}), 0) FROM {TRANACTIONS_TABLE} 
+                WHERE {USERID_KEY}=? AND {TIMESTAMP_KEY}>?''', (userid, timestamp))
+            return balance - cursor.fetchone()[0]
+        finally:
+            cursor.close()
+
+    @reuse_read_conn
+    def get_changes(self, after_seq: int, limit: int, conn: sqlite3.Connection=None) -> List[tuple]:
+        """
+        Returns the transactions committed after the given sequence number, oldest first.
+        every row is (seq, userid, timestamp, value, description, id)
+        """
+        cursor = conn.cursor()
+        cursor.execute(f'''SELECT {SEQ_KEY}, {USERID_KEY}, {TIMESTAMP_KEY}, {VALUE_KEY}, {DESCRIPTION_KEY}, {ID_KEY} 
+            FROM {TRANACTIONS_TABLE} WHERE {SEQ_KEY}>? ORDER BY {SEQ_KEY} LIMIT ?''', (after_seq, limit))
+        res = cursor.fetchall()
+        cursor.close()
+
+        return res
+
+    @reuse_read_conn
+    def get_last_seq(self, conn: sqlite3.Connection=None) -> int:
+        """Returns the sequence number of the last committed transaction (0 if there are none)"""
+        cursor = conn.cursor()
+        cursor.execute(f'SELECT MAX({SEQ_KEY}) FROM {TRANACTIONS_TABLE}')
+        res = cursor.fetchone()[0]
+        cursor.close()
+
+        return res if res is not None else 0
+
+    def on_jobs_lock_acquired(self):
+        logging.info("Running the jobs")
+        self.update_jobs()
+
+    def on_jobs_lock_lost(self):
+        logging.error("Lost the jobs lock, another instance runs the jobs")
+        self.job_scheduler.reset({})
+
+    def get_pool_stats(self) -> Dict[str, PoolStats]:
+        return {'write': self.pool.get_stats(), 'read': self.read_pool.get_stats()}
+
+    def get_sql_stats(self) -> List[StatementStats]:
+        """The profiled statements, the slowest (total time) first. Empty unless 'profile_sql' is configured"""
+        return self.sql_profiler.get_stats() if self.sql_profiler is not None else []
+
+    def collect_metrics(self) -> List[CollectedMetric]:
+        """The pools, jobs and balance cache stats as metrics, they are read at scrape time"""
+        pools = self.get_pool_stats()
+        jobs = self.get_jobs_stats()
+        cache = self.get_balance_cache_stats()
+        def pool_metric(name: str, metric_type: str, help: str, field: str) -> CollectedMetric:
+            return CollectedMetric(name, metric_type, help, 
+                [({'pool': pool}, getattr(stats, field)) for pool, stats in pools.items()])
+
+        return [
+            pool_metric('cb_pool_connections', 'gauge', 'Open connections of the pool', 'size'),
+            pool_metric('cb_pool_connections_in_use', 'gauge', 'Checked out connections of the pool', 'in_use'),
+            pool_metric('cb_pool_waits_total', 'counter', 'Checkouts that waited for a connection', 'waits'),
+            pool_metric('cb_pool_wait_seconds_total', 'counter', 'Time spent waiting for a connection', 'wait_time'),
+            pool_metric('cb_pool_timeouts_total', 'counter', 'Checkouts that timed out', 'timeouts'),
+            CollectedMetric('cb_jobs', 'gauge', 'Scheduled jobs', [({}, jobs.jobs)]),
+            CollectedMetric('cb_jobs_queued', 'gauge', 'Due jobs waiting for a worker', [({}, jobs.queued)]),
+            CollectedMetric('cb_jobs_running', 'gauge', 'Jobs being run', [({}, jobs.running)]),
+            CollectedMetric('cb_jobs_failed_total', 'counter', 'Jobs that raised', [({}, jobs.failed)]),
+            CollectedMetric('cb_jobs_retries_total', 'counter', 'Job attempts retried on a locked database', 
+                [({}, jobs.retries)]),
+            CollectedMetric('cb_balance_cache_entries', 'gauge', 'Cached balances', [({}, cache.size)]),
+            CollectedMetric('cb_balance_cache_lookups_total', 'counter', 'Balance cache lookups by result', 
+                [({'result': 'hit'}, cache.hits), ({'result': 'miss'}, cache.misses)]),
+            CollectedMetric('cb_balance_cache_invalidations_total', 'counter', 'Balance cache drops', 
+                [({}, cache.invalidations)]),
+        ]
+
     def close(self):
+        REGISTRY.remove_collector(self.collect_metrics)
+        self.change_notifier.close()
+        self.job_scheduler.close()
+        self.job_executor.close()
         self.scheduler.shutdown()
         self.jobs_lock.drop()
+        self.balance_cache.close()
+        self.pool.close()
+        self.read_pool.close()
+        if self.sql_profiler is not None:
+            logging.info(self.sql_profiler.format_report())
+            self.sql_profiler.close()
         print("propery closing the database")
 
-    def update_jobs(self):
-        raise NotImplementedError()
@@ -1,10 +1,20 @@
 import argparse
+import base64
 from datetime import datetime, timezone
+import functools
+import gzip
+import json
 import logging
 import os
-from typing import List
+import time
+from typing import Dict, List, Tuple
 import flask
-from cb_server.cb_repo import Repo, UserNotFound
+from cb_server.cb_repo import IdempotencyKeyReused, JobInfo, Repo, RepoConfig, TransferLeg, UserNotFound
+from cb_server.crontab import CronParsingException, CronTab
+from cb_server.metrics import CONTENT_TYPE, REGISTRY
+from cb_server.sql_profiler import REPORT_SIZE, SLOW_QUERIES_LOGGER
+from models.jobs import ScheduledTransferInfo
+from models.money import format_amount, to_minor_units
 from models.server_errors import ErrorCodes, ServerError
 from models.transactions import UserTransactionInfo
 
@@ -13,54 +23,331 @@ def get_timestamp_from_req(req , key: str) -> int:
     if iso_time is None:
         return None
     
+    return parse_timestamp(iso_time, key)
+
+def parse_timestamp(iso_time: str, key: str) -> int:
     try:
         return int(datetime.fromisoformat(iso_time).timestamp())
-    except ValueError:
+    except (TypeError, ValueError):
         flask.abort(400, f'Invalid {key} value: {iso_time}')
 
+def get_transactions_list(username: str, transactions) -> List[dict]:
+    transactions_list: List[UserTransactionInfo] = []
+    for t in transactions:
+        transactions_list.append(UserTransactionInfo(
+            userid=username,
+            amount=format_amount(t[1]),
+            timestamp=datetime.fromtimestamp(t[0], timezone.utc).isoformat(),
+            description=t[2],
+            id=t[3]
+        ))
+
+    return [t._asdict() for t in transactions_list]
+
+def get_int_from_req(req, key: str, default: int=None) -> int:
+    value = req.args.get(key)
+    if value is None:
+        return default
+
+    try:
+        return int(value)
+    except ValueError:
+        flask.abort(400, f'Invalid {key} value: {value}')
+
+def get_job_dict(repo: Repo, job_info: JobInfo) -> dict:
+    action_params = repo.get_compiled_job(job_info.id, job_info.row_version, job_info.cron, 
+        job_info.action_params).action_params
+    return ScheduledTransferInfo(
+        id=job_info.id,
+        userid=job_info.userid,
+        cron=job_info.cron,
+        to=action_params['to'],
+        value=format_amount(action_params['value']),
+        description=action_params.get('description', ''),
+        handle_missed_events=job_info.handle_missed_events == 1,
+        last_run=datetime.fromtimestamp(job_info.last_run, timezone.utc).isoformat(),
+        last_run_status=job_info.last_run_status,
+        last_run_error=job_info.last_run_error,
+        next_run=datetime.fromtimestamp(job_info.next_run, timezone.utc).isoformat() 
+            if job_info.next_run is not None else None
+    )._asdict()
+
+def parse_job_fields(username: str, req_body: dict, partial: bool) -> dict:
+    """
+    Validates the fields of a job request, returns them as 'add_job' / 'update_job' arguments.
+    partial: only the fields in the request are required (an update)
+    """
+    if not isinstance(req_body, dict):
+        raise ValueError('The request body must be a JSON object')
+
+    fields = {}
+    required = ['cron', 'to', 'value'] if not partial else []
+    for key in required:
+        if req_body.get(key) is None:
+            raise ValueError(f"'{key}' is required")
+
+    if req_body.get('cron') is not None:
+        try:
+            CronTab().from_line(req_body['cron'])
+        except (CronParsingException, AttributeError):
+            raise ValueError(f"Invalid cron: '{req_body['cron']}'")
+        fields['cron_line'] = req_body['cron']
+    if req_body.get('to') is not None:
+        if req_body['to'] == username:
+            raise ValueError('You cannot transfer money to yourself')
+        fields['to_userid'] = req_body['to']
+    if req_body.get('value') is not None:
+        try:
+            value = to_minor_units(req_body['value'])
+        except ValueError:
+            value = None
+        if value is None or value <= 0:
+            raise ValueError(f"Invalid amount: '{req_body['value']}'")
+        fields['value'] = value
+    if req_body.get('description') is not None:
+        fields['description'] = str(req_body['description'])
+    elif not partial:
+        fields['description'] = ''
+    if req_body.get('handle_missed_events') is not None:
+        fields['handle_missed_events'] = bool(req_body['handle_missed_events'])
+
+    return fields
+
+def parse_transfer(username: str, req_body: dict) -> Tuple[str, int, str]:
+    """Validates a transfer request, returns the (to, value, description) of the transfer"""
+    if not isinstance(req_body, dict) or req_body.get('to') is None or req_body.get('value') is None:
+        raise ValueError("'to' and 'value' are required")
+    to = req_body['to']
+    if to == username:
+        raise ValueError('You cannot transfer money to yourself')
+    try:
+        value = to_minor_units(req_body['value'])
+    except ValueError:
+        value = None
+    if value is None or value <= 0:
+        raise ValueError(f"Invalid amount: '{req_body['value']}'")
+    return to, value, req_body.get('description') or ''
+
+def parse_idempotency_key(idempotency_key: str) -> str:
+    if idempotency_key is not None and (len(idempotency_key) == 0 or len(idempotency_key) > MAX_IDEMPOTENCY_KEY_LENGTH):
+        raise ValueError('Invalid idempotency key')
+    return idempotency_key
+
+def parse_transfer_legs(req_body: dict) -> List[TransferLeg]:
+    """Validates the transfers of a batch transfer request"""
+    if not isinstance(req_body, dict) or not isinstance(req_body.get('transfers'), list):
+        raise ValueError("The request body must be a JSON object with a 'transfers' list")
+    transfers = req_body['transfers']
+    if len(transfers) == 0 or len(transfers) > MAX_BATCH_TRANSFERS:
+        raise ValueError(f"A batch must have 1 to {MAX_BATCH_TRANSFERS} transfers")
+
+    legs = []
+    for i, transfer in enumerate(transfers):
+        if not isinstance(transfer, dict):
+            raise ValueError(f"Transfer {i}: must be a JSON object")
+        for key in ['from', 'to', 'value']:
+            if transfer.get(key) is None:
+                raise ValueError(f"Transfer {i}: '{key}' is required")
+        if transfer['to'] == transfer['from']:
+            raise ValueError(f"Transfer {i}: you cannot transfer money to yourself")
+        try:
+            value = to_minor_units(transfer['value'])
+        except ValueError:
+            value = None
+        if value is None or value <= 0:
+            raise ValueError(f"Transfer {i}: invalid amount: '{transfer['value']}'")
+        legs.append(TransferLeg(str(transfer['from']), str(transfer['to']), value, 
+            str(transfer.get('description') or '')))
+    return legs
+
+def encode_cursor(transaction) -> str:
+    """Encodes the (timestamp, id) position of a transaction as an opaque page cursor"""
+    position = json.dumps([transaction[0], transaction[3]]).encode()
+    return base64.urlsafe_b64encode(position).decode()
+
+def decode_cursor(cursor: str) -> Tuple[int, str]:
+    try:
+        timestamp, guid = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if not isinstance(timestamp, int) or not isinstance(guid, str):
+            raise ValueError("unexpected cursor content")
+        return timestamp, guid
+    except (TypeError, ValueError):
+        raise ValueError(f'Invalid cursor value: {cursor}')
+
+def parse_users_query(req_body: dict) -> Dict[str, str]:
+    """Returns the {username: from_time (or None)} of a transactions query body, raises ValueError"""
+    users = req_body.get('users') if isinstance(req_body, dict) else None
+    if isinstance(users, dict):
+        return users
+    if isinstance(users, list):
+        return {username: req_body.get('from_time') for username in users}
+    raise ValueError("'users' must be a list or a mapping")
+
+def get_changes_dict(rows: List[tuple], after: int, head_seq: int) -> dict:
+    """The changes feed response of the rows of 'Repo.get_changes'"""
+    changes = []
+    for seq, userid, timestamp, value, description, guid in rows:
+        transaction = get_transactions_list(userid, [(timestamp, value, description, guid)])[0]
+        changes.append({**transaction, 'seq': seq})
+
+    last_seq = changes[-1]['seq'] if len(changes) > 0 else after
+    return {'changes': changes, 'last_seq': last_seq, 'head_seq': max(head_seq, last_seq)}
+
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Starts the Chunka bank database server")
     parser.add_argument('db_path', nargs="?", default=os.environ.get('CB_DB_PATH', None), help='Database file path')
     parser.add_argument('-c', '--create', action='store_true', help='Create a new database')
+    defaults = RepoConfig()
+    parser.add_argument('--synchronous', default=defaults.synchronous, choices=['OFF', 'NORMAL', 'FULL', 'EXTRA'],
+        help='SQLite synchronous mode')
+    parser.add_argument('--cache-size', type=int, default=defaults.cache_size, 
+        help='SQLite page cache size (pages, or KiB when negative)')
+    parser.add_argument('--mmap-size', type=int, default=defaults.mmap_size, help='SQLite memory map size in bytes')
+    parser.add_argument('--server', default='waitress', choices=['waitress', 'aiohttp'],
+        help='waitress serves the routes from a thread pool, aiohttp serves the same routes from an asyncio loop')
+    parser.add_argument('--threads', type=int, default=8, 
+        help='Number of server threads (each waiting changes feed request holds one), with aiohttp the number of '
+            'database threads')
+    parser.add_argument('--busy-timeout', type=int, default=defaults.busy_timeout, 
+        help='How long to wait for a locked database (ms)')
+    parser.add_argument('--job-workers', type=int, default=defaults.job_workers, 
+        help='Number of threads that run the jobs of different users concurrently')
+    parser.add_argument('--jobs-lease-time', type=float, default=defaults.jobs_lease_time, 
+        help='How long (seconds) a crashed instance holds the jobs lock before a standby instance takes over')
+    parser.add_argument('--profile-sql', action='store_true', 
+        help='Profile the SQL statements, the report is logged when the server stops')
+    parser.add_argument('--slow-query-ms', type=float, default=defaults.slow_query_time * 1000, 
+        help='With --profile-sql, log the statements that take longer than this (ms) with their query plan')
+    parser.add_argument('--slow-query-log', default=None, 
+        help='With --profile-sql, write the slow queries to this file (instead of the server log)')
     return parser.parse_args()
 
-def build_error_response(error: ServerError) -> flask.Response:
+def get_error_dict(error: ServerError) -> dict:
     # a workaround to convert the enum to string
-    error_dict = {**error._asdict(), "error_code":error.error_code.name}
-    response = flask.jsonify(error_dict)
+    return {**error._asdict(), "error_code":error.error_code.name}
+
+def build_error_response(error: ServerError) -> flask.Response:
+    response = flask.jsonify(get_error_dict(error))
     response.status_code = 400
     return response
 
-args = parse_args()
-print ("args:", args)
+DEFAULT_CHANGES_LIMIT = 100
+MAX_CHANGES_LIMIT = 1000
+MAX_CHANGES_WAIT = 60 # seconds
+DEFAULT_TRANSACTIONS_PAGE_SIZE = 100
+MAX_TRANSACTIONS_PAGE_SIZE = 1000
+MAX_BATCH_TRANSFERS = 100
+IDEMPOTENCY_KEY_HEADER = 'Idempotency-Key'
+MAX_IDEMPOTENCY_KEY_LENGTH = 255
+# smaller responses are sent as is, compressing them doesn't save much
+MIN_COMPRESS_SIZE = 1024 # bytes
+GZIP_LEVEL = 6
+# the route label of a request that didn't match a route, so unknown URLs don't add labels
+UNMATCHED_ROUTE = 'unmatched'
 
-create = False
-if args.create:
-    if os.path.isfile(args.db_path):
-        print(f"Database file already exists at '{args.db_path}'")
-        exit(-1)
-    
-    create = True
-else:
-    if not os.path.isfile(args.db_path):
-        print(f"No database file found at {args.db_path}, to create new one re-run the server with the '--create' flag")
-        exit(-1)
+HTTP_REQUESTS = REGISTRY.counter('cb_http_requests_total', 'HTTP requests by route, method and status', 
+    ['route', 'method', 'status'])
+HTTP_REQUEST_SECONDS = REGISTRY.histogram('cb_http_request_duration_seconds', 
+    'HTTP request duration by route (a streamed response is timed until it starts)', ['route', 'method'])
+HTTP_REQUESTS_IN_FLIGHT = REGISTRY.gauge('cb_http_requests_in_flight', 'HTTP requests being handled')
+
+def record_request(route: str, method: str, status: int, duration: float):
+    HTTP_REQUESTS.inc(route=route, method=method, status=status)
+    HTTP_REQUEST_SECONDS.observe(duration, route=route, method=method)
 
 repo = None
 
 app = flask.Flask(__name__)
 app.logger.setLevel(logging.INFO)
 
+@app.before_request
+def start_request():
+    flask.g.request_start = time.perf_counter()
+    HTTP_REQUESTS_IN_FLIGHT.inc()
+
+@app.teardown_request
+def end_request(exception):
+    # runs also when the request failed before its response was made
+    if 'request_start' in flask.g:
+        HTTP_REQUESTS_IN_FLIGHT.dec()
+
 @app.after_request
 def log_request_info(response):
-    app.logger.info(f'{flask.request.method} {flask.request.url} {response.status}')
+    duration = time.perf_counter() - flask.g.request_start if 'request_start' in flask.g else 0
+    route = flask.request.url_rule.rule if flask.request.url_rule is not None else UNMATCHED_ROUTE
+    record_request(route, flask.request.method, response.status_code, duration)
+    app.logger.info(f'{flask.request.method} {flask.request.url} {response.status} {duration * 1000:.1f}ms')
     return response
 
+def get_user_etag(repo: Repo, username: str) -> str:
+    # the client keeps a body per URL, so the ETag only has to change with the user data
+    return f'{username}-{repo.get_user_generation(username)}'
+
+def conditional_get(view):
+    """
+    Answers 304 Not Modified, without running the view, when the If-None-Match ETag of the client is current.
+    The ETag is weak, the body may be sent compressed or not
+    """
+    @functools.wraps(view)
+    def wrapper(username, *args, **kwargs):
+        # taken before the view reads the data, so a body is never newer than its ETag claims
+        etag = get_user_etag(repo, username)
+        if flask.request.if_none_match.contains_weak(etag):
+            response = flask.Response(status=304)
+        else:
+            response = flask.make_response(view(username, *args, **kwargs))
+            if response.status_code != 200:
+                return response
+        response.set_etag(etag, weak=True)
+        # the client may keep the body, but must revalidate it
+        response.cache_control.no_cache = True
+        return response
+    return wrapper
+
+@app.after_request
+def compress_response(response: flask.Response):
+    # streamed responses (the JSON lines export) are sent as is
+    if response.status_code != 200 or response.direct_passthrough or response.is_streamed or \
+            'Content-Encoding' in response.headers:
+        return response
+    response.vary.add('Accept-Encoding')
+    if flask.request.accept_encodings['gzip'] == 0 or len(response.get_data()) < MIN_COMPRESS_SIZE:
+        return response
+
+    response.set_data(gzip.compress(response.get_data(), compresslevel=GZIP_LEVEL))
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+def get_jobs_lock_info(repo: Repo) -> dict:
+    holder = repo.jobs_lock.get_holder()
+    return {'is_locked': repo.jobs_lock.is_locked, 'holder': holder._asdict() if holder is not None else None}
+
+def get_stats_dict(repo: Repo) -> dict:
+    return {'pools': {name: stats._asdict() for name, stats in repo.get_pool_stats().items()},
+        'jobs': repo.get_jobs_stats()._asdict(), 'jobs_lock': get_jobs_lock_info(repo),
+        'balance_cache': repo.get_balance_cache_stats()._asdict(),
+        'sql': [stats._asdict() for stats in repo.get_sql_stats()[:REPORT_SIZE]]}
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """The server metrics in the Prometheus text format"""
+    return flask.Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+@app.route('/stats', methods=['GET'])
+def get_stats():
+    return flask.jsonify(get_stats_dict(repo))
+
 @app.route('/user/<username>/balance', methods=['GET'])
+@conditional_get
 def get_user_balance(username):
+    # optional, the time to get the balance at (the current balance when omitted)
+    at_timestamp = get_timestamp_from_req(flask.request, 'at')
     try:
-        balance = repo.get_user_balance(username)
-        return flask.jsonify({'balance': balance})
+        if at_timestamp is not None:
+            balance = repo.get_user_balance_at(username, at_timestamp)
+        else:
+            balance = repo.get_user_balance(username)
+        return flask.jsonify({'balance': format_amount(balance)})
     except UserNotFound:
         return flask.jsonify({'error': f'User {username} not found'}), 404
     
@@ -72,23 +359,17 @@ def add_user(username):
     
 @app.route('/user/<username>/transfer', methods=['POST'])
 def transfer_money(username):
-    # get the request body
-    req_body = flask.request.json
-    
-    to = req_body['to']
-    if to == username:
-        return build_error_response(ServerError(ErrorCodes.USER_ERROR, 'You cannot transfer money to yourself'))
     try:
-        value = float(req_body['value'])
-    except ValueError:
-        value = None
-    if value is None or value <= 0:
-        return build_error_response(ServerError(ErrorCodes.USER_ERROR, f'Invalid amount: \'{req_body["value"]}\''))
-    
-    # get the 'description' field
-    description = req_body['description']
+        to, value, description = parse_transfer(username, flask.request.get_json(silent=True))
+        # a retried request (same key) returns the result of the first one instead of transferring again
+        idempotency_key = parse_idempotency_key(flask.request.headers.get(IDEMPOTENCY_KEY_HEADER))
+    except ValueError as e:
+        return build_error_response(ServerError(ErrorCodes.USER_ERROR, str(e)))
     # transfer the money
-    sucess, msg = repo.transfer_money(username, to, value, description)
+    try:
+        sucess, msg = repo.transfer_money(username, to, value, description, idempotency_key=idempotency_key)
+    except IdempotencyKeyReused as e:
+        return build_error_response(ServerError(ErrorCodes.USER_ERROR, str(e)))
     if not sucess:
         error = ServerError(ErrorCodes.USER_ERROR, msg)
         return build_error_response(error)
@@ -96,35 +377,184 @@ def transfer_money(username):
     # upon success return 204
     return '', 204
 
+@app.route('/transfers/batch', methods=['POST'])
+def transfer_money_batch():
+    """
+    Runs a batch of transfers in one transaction, all or nothing, the body is 
+    {"transfers": [{"from": ..., "to": ..., "value": ..., "description": ...}, ...]}.
+    Returns {"success": ..., "results": [{"success": ..., "error": ...}, ...]} with a result per transfer
+    """
+    req_body = flask.request.get_json(silent=True)
+    try:
+        legs = parse_transfer_legs(req_body)
+    except ValueError as e:
+        return build_error_response(ServerError(ErrorCodes.USER_ERROR, str(e)))
+
+    success, results = repo.transfer_many(legs)
+    return flask.jsonify({'success': success, 
+        'results': [{'success': leg_success, 'error': error} for leg_success, error in results]})
+
 @app.route('/user/<username>/transactions', methods=['GET'])
+@conditional_get
 def get_user_transactions(username):
+    """
+    Returns the user transactions (newest first), query parameters:
+    - from_time, to_time: an optional time range (ISO format)
+    - last_n: return only the last n transactions (a plain list)
+    - page_size: return a page of up to this many transactions as {"transactions": [...], "next_cursor": ...}, 
+      pass 'next_cursor' as 'cursor' to get the next page (it's null on the last page)
+    - format=jsonl: stream all the transactions as JSON lines, without loading the whole history to memory
+    """
     # get the request query parameters
     from_timestamp = get_timestamp_from_req(flask.request, 'from_time')
     to_timestamp = get_timestamp_from_req(flask.request, 'to_time')
-    try:
-        last_n = int(flask.request.args.get('last_n')) if flask.request.args.get('last_n') is not None else None
-    except ValueError:
-        flask.abort(400, f'Invalid last_n value: {last_n}')
-    
+    last_n = get_int_from_req(flask.request, 'last_n')
+    page_size = get_int_from_req(flask.request, 'page_size')
+    cursor = flask.request.args.get('cursor')
+
+    if flask.request.args.get('format') == 'jsonl':
+        transactions = repo.iter_user_transactions(username, from_timestamp, to_timestamp)
+        lines = (json.dumps(get_transactions_list(username, [t])[0]) + '\n' for t in transactions)
+        return flask.Response(flask.stream_with_context(lines), mimetype='application/x-ndjson')
+
+    if page_size is not None or cursor is not None:
+        page_size = page_size if page_size is not None else DEFAULT_TRANSACTIONS_PAGE_SIZE
+        if page_size <= 0 or page_size > MAX_TRANSACTIONS_PAGE_SIZE:
+            flask.abort(400, f'Invalid page_size value: {page_size}')
+        try:
+            after = decode_cursor(cursor) if cursor is not None else None
+        except ValueError as e:
+            flask.abort(400, str(e))
+        # one extra row tells whether there is a next page
+        transactions = repo.get_user_transactions_page(username, page_size + 1, after, from_timestamp, to_timestamp)
+        next_cursor = encode_cursor(transactions[page_size - 1]) if len(transactions) > page_size else None
+        return flask.jsonify({'transactions': get_transactions_list(username, transactions[:page_size]), 
+            'next_cursor': next_cursor})
+
     # get the transactions
     transactions = repo.get_user_transactions(username, last_n, from_timestamp, to_timestamp)
-
-    transactions_list: List[UserTransactionInfo] = []
-    for t in transactions:
-        transactions_list.append(UserTransactionInfo(
-            userid=username,
-            amount=t[1],
-            timestamp=datetime.fromtimestamp(t[0], timezone.utc).isoformat(),
-            description=t[2],
-            id=t[3]
-        ))
         
     # return the transactions
-    return flask.jsonify([t._asdict() for t in transactions_list])
+    return flask.jsonify(get_transactions_list(username, transactions))
+
+@app.route('/transactions/query', methods=['POST'])
+def query_users_transactions():
+    """
+    Returns the transactions of multiple users in one round trip, the request body is one of:
+    - {"users": {"<username>": "<from_time>" | null, ...}} - a separate from time per user
+    - {"users": ["<username>", ...], "from_time": "<from_time>" | null} - the same from time for all the users
+    The response maps each username to its transactions (newest first)
+    """
+    try:
+        from_times = parse_users_query(flask.request.json)
+    except ValueError as e:
+        return build_error_response(ServerError(ErrorCodes.USER_ERROR, str(e)))
+
+    from_timestamps = {username: parse_timestamp(from_time, 'from_time') if from_time is not None else None
+        for username, from_time in from_times.items()}
+    transactions = repo.get_users_transactions(from_timestamps)
+
+    return flask.jsonify({username: get_transactions_list(username, user_transactions) 
+        for username, user_transactions in transactions.items()})
+
+@app.route('/user/<username>/jobs', methods=['GET'])
+def get_user_jobs(username):
+    return flask.jsonify([get_job_dict(repo, job_info) for job_info in repo.get_user_jobs(username)])
+
+@app.route('/user/<username>/jobs', methods=['POST'])
+def add_job(username):
+    """
+    Schedules a transfer, the request body is:
+    {"cron": "<cron line>", "to": "<username>", "value": "<amount>", "description": "<description>", 
+     "handle_missed_events": <bool>}
+    description and handle_missed_events are optional, the response includes the id of the new job
+    """
+    try:
+        fields = parse_job_fields(username, flask.request.get_json(silent=True), partial=False)
+        job_id = repo.add_job(username, **fields)
+    except (ValueError, UserNotFound) as e:
+        return build_error_response(ServerError(ErrorCodes.USER_ERROR, str(e)))
+
+    return flask.jsonify({'id': job_id}), 201
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job_info = repo.get_job(job_id)
+    if job_info is None:
+        flask.abort(404, f"Job '{job_id}' not found")
+    return flask.jsonify(get_job_dict(repo, job_info))
+
+@app.route('/jobs/<job_id>', methods=['PATCH'])
+def update_job(job_id):
+    """Changes the fields of a job, the request body has the same fields as in adding a job (all are optional)"""
+    job_info = repo.get_job(job_id)
+    if job_info is None:
+        flask.abort(404, f"Job '{job_id}' not found")
+
+    try:
+        fields = parse_job_fields(job_info.userid, flask.request.get_json(silent=True), partial=True)
+        if not repo.update_job(job_id, **fields):
+            flask.abort(404, f"Job '{job_id}' not found")
+    except (ValueError, UserNotFound) as e:
+        return build_error_response(ServerError(ErrorCodes.USER_ERROR, str(e)))
+
+    return '', 204
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+def delete_job(job_id):
+    if not repo.delete_job(job_id):
+        flask.abort(404, f"Job '{job_id}' not found")
+    return '', 204
+
+@app.route('/changes', methods=['GET'])
+def get_changes():
+    """
+    A feed of all the committed transactions, ordered by their sequence number.
+    query parameters:
+    - after: return the transactions with a sequence number greater than this one, 
+      when omitted no transactions are returned (use it to get the current position of the feed)
+    - limit: the maximal number of transactions to return
+    - wait: when there are no new transactions, wait up to this many seconds for one to be committed (long poll)
+    The response includes 'last_seq', the cursor to pass as 'after' in the next request and 'head_seq', the sequence 
+    number of the last committed transaction (if it's lower than the cursor, the database was replaced)
+    """
+    after = get_int_from_req(flask.request, 'after')
+    limit = get_int_from_req(flask.request, 'limit', DEFAULT_CHANGES_LIMIT)
+    if limit <= 0 or limit > MAX_CHANGES_LIMIT:
+        flask.abort(400, f'Invalid limit value: {limit}')
+    wait = get_int_from_req(flask.request, 'wait', 0)
+    if wait < 0 or wait > MAX_CHANGES_WAIT:
+        flask.abort(400, f'Invalid wait value: {wait}')
+
+    head_seq = repo.get_last_seq()
+    if after is None:
+        return flask.jsonify({'changes': [], 'last_seq': head_seq, 'head_seq': head_seq})
+
+    rows = repo.get_changes(after, limit)
+    if len(rows) == 0 and wait > 0 and head_seq <= after:
+        if repo.wait_for_changes(after, wait):
+            rows = repo.get_changes(after, limit)
+            head_seq = repo.get_last_seq()
+
+    return flask.jsonify(get_changes_dict(rows, after, head_seq))
 
 if __name__ == '__main__':
-    from waitress import serve
     from urllib.parse import urlparse
+    args = parse_args()
+    print ("args:", args)
+
+    create = False
+    if args.create:
+        if os.path.isfile(args.db_path):
+            print(f"Database file already exists at '{args.db_path}'")
+            exit(-1)
+        
+        create = True
+    else:
+        if not os.path.isfile(args.db_path):
+            print(f"No database file found at {args.db_path}, to create new one re-run the server with the '--create' flag")
+            exit(-1)
+
     cb_server_url = os.environ.get('CB_SERVER_URL', 'http://127.0.0.1:5000')
     
     parsed = urlparse(cb_server_url)
@@ -133,10 +563,24 @@ if __name__ == '__main__':
     if parsed.hostname not in ['localhost', '127.0.0.1']:
         raise Exception("cb server must run on localhost, since its not protected")
 
+    if args.profile_sql:
+        # the profile report is logged (at INFO) when the repo is closed
+        logging.basicConfig(level=logging.INFO)
+        if args.slow_query_log is not None:
+            SLOW_QUERIES_LOGGER.addHandler(logging.FileHandler(args.slow_query_log))
+            SLOW_QUERIES_LOGGER.propagate = False
+
     try:
-        repo = Repo(args.db_path, create)
-        serve(app, listen=parsed.netloc)
+        config = RepoConfig(synchronous=args.synchronous, cache_size=args.cache_size, mmap_size=args.mmap_size, 
+            busy_timeout=args.busy_timeout, job_workers=args.job_workers, 
+            jobs_lease_time=args.jobs_lease_time, profile_sql=args.profile_sql, 
+            slow_query_time=args.slow_query_ms / 1000)
+        repo = Repo(args.db_path, create, config)
+        if args.server == 'aiohttp':
+            from cb_server import cb_async_server
+            cb_async_server.serve(repo, parsed.hostname, parsed.port or 80, db_threads=args.threads)
+        else:
+            from waitress import serve
+            serve(app, listen=parsed.netloc, threads=args.threads)
     finally:
         repo and repo.close()
-    
-
@@ -0,0 +1,50 @@
+import threading
+from typing import Callable, List
+
+class ChangeNotifier:
+    """
+    Wakes up the threads waiting for new transactions (the changes feed long polls).
+    The notifier only tracks the last published sequence number, the waiters read the changes from the database.
+    """
+    def publish(self, seq: int):
+        with self._cond:
+            if seq > self.last_seq:
+                self.last_seq = seq
+                self._cond.notify_all()
+                listeners = list(self._listeners)
+            else:
+                listeners = []
+        for listener in listeners:
+            listener(seq)
+
+    def add_listener(self, listener: Callable[[int], None]):
+        """Calls 'listener' with every newly published sequence number (on the publishing thread, keep it short)"""
+        with self._cond:
+            self._listeners.append(listener)
+
+    def remove_listener(self, listener: Callable[[int], None]):
+        with self._cond:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+
+    def wait(self, after_seq: int, timeout: float) -> bool:
+        """
+        Waits until a transaction with a sequence number greater than 'after_seq' is published.
+        returns False on timeout or when the notifier is closed
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self.last_seq > after_seq or self._closed, timeout)
+            return self.last_seq > after_seq
+
+    def close(self):
+        """Releases all the waiters"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def __init__(self, last_seq: int=0):
+        self.last_seq = last_seq
+        self._closed = False
+        self._cond = threading.Condition()
+        # e.g. the long polls of an asyncio server, which don't wait on a thread
+        self._listeners: List[Callable[[int], None]] = []
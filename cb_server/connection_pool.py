@@ -0,0 +1,302 @@
+from collections import namedtuple
+from contextlib import contextmanager, nullcontext
+import logging
+import pathlib
+import queue
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, List
+
+DEFAULT_POOL_SIZE = 8
+DEFAULT_CHECKOUT_TIMEOUT = 10 # seconds
+# connections that were idle for longer than this are pinged before being handed out
+HEALTH_CHECK_IDLE_TIME = 30 # seconds
+
+PoolStats = namedtuple('PoolStats', ['max_size', 'size', 'idle', 'in_use', 'checkouts', 'connects', 'connect_time',
+                                     'waits', 'wait_time', 'max_wait_time', 'timeouts', 'discarded'])
+
+class PoolException(Exception):
+    pass
+
+class PoolTimeout(PoolException):
+    pass
+
+class PoolClosed(PoolException):
+    pass
+
+class PooledConnection(sqlite3.Connection):
+    """A sqlite connection that can run callbacks once the current transaction is committed"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._after_commit_callbacks: List[Callable] = []
+        # set by the pool, shared by all its connections
+        self.write_lock: threading.Lock = None
+        self.write_lock_timeout = DEFAULT_CHECKOUT_TIMEOUT
+        self._holds_write_lock = False
+        # set when a sql profiler is attached (see cb_server.sql_profiler), its cursors time the statements
+        self.profile = None
+
+    def _profiled(self, sql: str):
+        return self.profile.timed(sql) if self.profile is not None else nullcontext()
+
+    def cursor(self, factory=None):
+        if factory is None:
+            factory = self.profile.cursor_factory if self.profile is not None else sqlite3.Cursor
+        return super().cursor(factory)
+
+    def execute(self, sql: str, parameters=()):
+        if self.profile is None:
+            return super().execute(sql, parameters)
+        # the sqlite3 module doesn't create these cursors through 'cursor'
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql: str, seq_of_parameters):
+        if self.profile is None:
+            return super().executemany(sql, seq_of_parameters)
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def after_commit(self, callback: Callable):
+        """Registers a callback to run after the current transaction is committed (dropped on rollback)"""
+        self._after_commit_callbacks.append(callback)
+
+    def begin_immediate(self):
+        """
+        Starts a write transaction (BEGIN IMMEDIATE). The writers of the pool queue on the pool write lock, so a 
+        waiting writer is woken up as soon as the transaction before it ends, instead of polling (sleeping) in the
+        sqlite busy handler. The lock is released when the transaction is committed or rolled back
+        """
+        if self.write_lock is not None:
+            if not self.write_lock.acquire(timeout=self.write_lock_timeout):
+                # the same error sqlite raises when its busy timeout expires
+                raise sqlite3.OperationalError("database is locked")
+            self._holds_write_lock = True
+        try:
+            self.execute('BEGIN IMMEDIATE')
+        except BaseException:
+            self._release_write_lock()
+            raise
+
+    def _release_write_lock(self):
+        if self._holds_write_lock:
+            self._holds_write_lock = False
+            self.write_lock.release()
+
+    def commit(self):
+        with self._profiled('COMMIT'):
+            super().commit()
+        self._release_write_lock()
+        callbacks = self._after_commit_callbacks
+        self._after_commit_callbacks = []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                # the transaction is already committed, a failing callback must not fail the caller
+                logging.exception(f"After commit callback failed: {e}")
+
+    def rollback(self):
+        self._after_commit_callbacks = []
+        try:
+            with self._profiled('ROLLBACK'):
+                super().rollback()
+        finally:
+            self._release_write_lock()
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self._release_write_lock()
+
+class ConnectionPool:
+    """
+    A bounded pool of long lived sqlite connections.
+    A thread that already holds a connection gets the same connection back on nested checkouts, so a call chain
+    (e.g. processing a job that transfers money) runs on a single connection and a single transaction.
+    The connections are not pinned to threads for their lifetime: the server, job worker and database executor
+    threads together outnumber the connections that are needed at once, and connections kept in thread locals
+    could be neither bounded nor closed by 'close'. The idle connections are handed out LIFO, so a lightly loaded
+    server keeps reusing the same warm connection.
+    """
+    def _connect(self) -> PooledConnection:
+        start = time.perf_counter()
+        # connections are handed between the server threads, but only one thread uses a connection at a time
+        if self.read_only:
+            uri = pathlib.Path(self.db_path).absolute().as_uri() + '?mode=ro'
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False, factory=PooledConnection)
+            conn.execute('PRAGMA query_only=1')
+        else:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, factory=PooledConnection)
+        for name, value in self.pragmas.items():
+            conn.execute(f'PRAGMA {name}={value}')
+        if not self.read_only:
+            conn.write_lock = self._write_lock
+            # wait for the other writers as long as sqlite would (busy_timeout is in milliseconds)
+            conn.write_lock_timeout = self.pragmas['busy_timeout'] / 1000 if 'busy_timeout' in self.pragmas \
+                else self.timeout
+        if self.on_connect is not None:
+            self.on_connect(conn)
+        with self._lock:
+            self._connect_time += time.perf_counter() - start
+            self._connects += 1
+        return conn
+
+    def _is_healthy(self, conn: sqlite3.Connection) -> bool:
+        try:
+            conn.execute('SELECT 1').fetchone()
+            return True
+        except sqlite3.Error as e:
+            logging.warning(f"Discarding unhealthy database connection: {e}")
+            return False
+
+    def _discard(self, conn: sqlite3.Connection):
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass # the connection is already broken, nothing to do
+        with self._lock:
+            self._size -= 1
+            self._discarded += 1
+
+    def _checkout(self) -> sqlite3.Connection:
+        deadline = time.monotonic() + self.timeout
+        waited = False
+        wait_start = time.perf_counter()
+        while True:
+            if self._closed:
+                raise PoolClosed("The connection pool is closed")
+
+            try:
+                conn, idle_since = self._idle.get_nowait()
+            except queue.Empty:
+                conn = None
+                with self._lock:
+                    can_open = self._size < self.max_size
+                    if can_open:
+                        self._size += 1 # reserve the slot before connecting (outside the lock)
+                if can_open:
+                    try:
+                        conn = self._connect()
+                    except Exception:
+                        with self._lock:
+                            self._size -= 1
+                        raise
+                    break
+
+                # the pool is exhausted, wait for a connection to be returned
+                waited = True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    with self._lock:
+                        self._timeouts += 1
+                    raise PoolTimeout(f"No database connection available after {self.timeout} seconds")
+                try:
+                    conn, idle_since = self._idle.get(timeout=remaining)
+                except queue.Empty:
+                    continue # the next iteration raises the timeout
+
+            if time.monotonic() - idle_since > HEALTH_CHECK_IDLE_TIME and not self._is_healthy(conn):
+                self._discard(conn)
+                continue
+            break
+
+        with self._lock:
+            self._checkouts += 1
+            self._in_use += 1
+            if waited:
+                wait_time = time.perf_counter() - wait_start
+                self._waits += 1
+                self._wait_time += wait_time
+                self._max_wait_time = max(self._max_wait_time, wait_time)
+        return conn
+
+    def _checkin(self, conn: sqlite3.Connection):
+        with self._lock:
+            self._in_use -= 1
+
+        if self._closed:
+            self._discard(conn)
+            return
+
+        try:
+            # never hand over a connection with a dangling transaction (or its pending after commit callbacks),
+            # this is a no-op when there is no open transaction
+            conn.rollback()
+        except sqlite3.Error as e:
+            logging.warning(f"Failed to reset database connection: {e}")
+            self._discard(conn)
+            return
+
+        self._idle.put((conn, time.monotonic()))
+
+    @contextmanager
+    def connection(self):
+        """Checks out a connection for the duration of the 'with' block"""
+        held = getattr(self._local, 'conn', None)
+        if held is not None:
+            # nested checkout on the same thread, reuse the connection
+            yield held
+            return
+
+        conn = self._checkout()
+        self._local.conn = conn
+        try:
+            yield conn
+        finally:
+            self._local.conn = None
+            self._checkin(conn)
+
+    def get_stats(self) -> PoolStats:
+        with self._lock:
+            return PoolStats(max_size=self.max_size, size=self._size, idle=self._idle.qsize(), in_use=self._in_use,
+                checkouts=self._checkouts, connects=self._connects, connect_time=self._connect_time,
+                waits=self._waits, wait_time=self._wait_time, max_wait_time=self._max_wait_time,
+                timeouts=self._timeouts, discarded=self._discarded)
+
+    def close(self):
+        """Closes all the idle connections, connections in use are closed when they are returned"""
+        self._closed = True
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+
+    def __init__(self, db_path: str, max_size: int=DEFAULT_POOL_SIZE, timeout: float=DEFAULT_CHECKOUT_TIMEOUT,
+            pragmas: Dict[str, Any]=None, read_only: bool=False,
+            on_connect: Callable[[PooledConnection], None]=None):
+        """
+        pragmas: PRAGMA statements (name -> value) applied to every new connection
+        read_only: open the connections in read only mode (the database file must already exist)
+        on_connect: called with every new connection (e.g. to attach a profiler)
+        """
+        if max_size < 1:
+            raise ValueError(f"Invalid pool size {max_size}")
+
+        self.db_path = db_path
+        self.max_size = max_size
+        self.timeout = timeout
+        self.pragmas = pragmas or {}
+        self.read_only = read_only
+        self.on_connect = on_connect
+
+        # LIFO so the most recently used (and warmest) connection is handed out first
+        self._idle = queue.LifoQueue()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # serializes the write transactions started by 'begin_immediate' (sqlite allows a single writer anyway)
+        self._write_lock = threading.Lock()
+        self._closed = False
+
+        self._size = 0
+        self._in_use = 0
+        self._checkouts = 0
+        self._connects = 0
+        self._connect_time = 0.0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+        self._timeouts = 0
+        self._discarded = 0
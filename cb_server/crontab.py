@@ -1,10 +1,23 @@
-from datetime import datetime
+from collections import namedtuple
+from datetime import date, datetime, timedelta
 from typing import List, Set
 from croniter import croniter
 
 class CronParsingException(Exception):
     pass
 
+# the cron fields in a form that is cheap to match: sorted lists for the fields that are enumerated and bitmasks 
+# for the fields that are tested, a day matches when either of the (restricted) day fields matches, like in cron
+CompiledCronTab = namedtuple('CompiledCronTab', ['minutes', 'hours', 'days_of_month_mask', 'months_mask', 
+                                                 'days_of_week_mask', 'is_day_of_month_restricted', 
+                                                 'is_day_of_week_restricted'])
+
+def _to_mask(values: Set[int]) -> int:
+    mask = 0
+    for value in values:
+        mask |= 1 << value
+    return mask
+
 class CronTab:
     """
     Represents a single line in a crontab file.
@@ -72,9 +85,11 @@ class CronTab:
         self.day_of_month: Set[int] = day_of_month or []
         self.month: Set[int] = month or []
         self.day_of_week: Set[int] = day_of_week or []
+        self._compiled: CompiledCronTab = None
     
     def from_line(self, line: str):
         self._parse_cron_line(line)
+        self._compiled = None
 
     def _set_to_string(self, values_set: Set[int], min_value: int, max_value: int) -> str:
         if len(values_set) == max_value - min_value + 1:
@@ -123,4 +138,54 @@ class CronTab:
         now: The current time
         """
         iter = croniter(self.to_string(), now)
-        return iter.get_next(datetime)
\ No newline at end of file
+        return iter.get_next(datetime)
+
+    def compile(self) -> CompiledCronTab:
+        """
+        Returns the compiled form of the cron line, it's cached until the line is parsed again
+        (so don't change the fields of a cron that was already used)
+        """
+        if self._compiled is None:
+            self._compiled = CompiledCronTab(
+                minutes=sorted(self.minute),
+                hours=sorted(self.hour),
+                days_of_month_mask=_to_mask(self.day_of_month),
+                months_mask=_to_mask(self.month),
+                days_of_week_mask=_to_mask(self.day_of_week),
+                is_day_of_month_restricted=len(self.day_of_month) < 31,
+                is_day_of_week_restricted=len(self.day_of_week) < 7)
+        return self._compiled
+
+    def _is_day_matching(self, compiled: CompiledCronTab, day: date) -> bool:
+        day_of_month_match = compiled.days_of_month_mask >> day.day & 1 == 1
+        # cron counts the days of the week from sunday
+        day_of_week_match = compiled.days_of_week_mask >> ((day.weekday() + 1) % 7) & 1 == 1
+        if compiled.is_day_of_month_restricted and compiled.is_day_of_week_restricted:
+            return day_of_month_match or day_of_week_match
+        return day_of_month_match and day_of_week_match
+
+    def get_runs_between(self, start: datetime, end: datetime) -> List[datetime]:
+        """
+        Returns all the times this cron line should run after 'start' and before 'end' (both exclusive), 
+        ordered by time. The same times 'get_next_run' returns when called repeatedly, in a single pass.
+        """
+        compiled = self.compile()
+        runs = []
+        day = start.date()
+        while day <= end.date():
+            if compiled.months_mask >> day.month & 1 == 0:
+                # skip the whole month
+                day = date(day.year + day.month // 12, day.month % 12 + 1, 1)
+                continue
+            
+            if self._is_day_matching(compiled, day):
+                # only the first and the last days of the range need to be compared with its edges
+                is_edge = day == start.date() or day == end.date()
+                for hour in compiled.hours:
+                    for minute in compiled.minutes:
+                        run = datetime(day.year, day.month, day.day, hour, minute)
+                        if not is_edge or start < run < end:
+                            runs.append(run)
+            day += timedelta(days=1)
+
+        return runs
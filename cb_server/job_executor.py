@@ -0,0 +1,93 @@
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+import time
+from typing import Callable, Deque, Set
+
+DEFAULT_WORKERS = 4
+
+ExecutorStats = namedtuple('ExecutorStats', ['workers', 'queued', 'running', 'executed', 'failed', 'total_time',
+                                             'max_time'])
+
+# a submitted task, 'keys' are the accounts it touches
+_Task = namedtuple('_Task', ['keys', 'func', 'name'])
+
+class PartitionedExecutor:
+    """
+    Runs tasks on a pool of worker threads, tasks that share a key (an account) run one at a time and in the order
+    they were submitted, tasks with disjoint keys run concurrently.
+    A task waits while any of its keys is held by a running task, or by an earlier task that is still waiting,
+    so a busy account never lets later tasks overtake earlier ones.
+    """
+    def _dispatch(self):
+        # must be called with the lock held
+        blocked: Set[str] = set(self._busy)
+        waiting: Deque[_Task] = deque()
+        for task in self._pending:
+            if self._closed:
+                break
+            if len(task.keys & blocked) > 0:
+                waiting.append(task)
+            else:
+                self._busy |= task.keys
+                self._running += 1
+                self._workers.submit(self._run, task)
+            blocked |= task.keys
+        self._pending = waiting
+
+    def _run(self, task: _Task):
+        start = time.perf_counter()
+        failed = False
+        try:
+            task.func()
+        except Exception as e:
+            failed = True
+            logging.exception(f"Task '{task.name}' failed: {e}")
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self._busy -= task.keys
+                self._running -= 1
+                self._executed += 1
+                self._failed += 1 if failed else 0
+                self._total_time += elapsed
+                self._max_time = max(self._max_time, elapsed)
+                self._dispatch()
+
+    def submit(self, keys: Set[str], func: Callable[[], None], name: str=''):
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("The executor is closed")
+            self._pending.append(_Task(frozenset(keys), func, name))
+            self._dispatch()
+
+    def get_stats(self) -> ExecutorStats:
+        with self._lock:
+            return ExecutorStats(workers=self.workers, queued=len(self._pending), running=self._running,
+                executed=self._executed, failed=self._failed, total_time=self._total_time, max_time=self._max_time)
+
+    def close(self):
+        """Drops the queued tasks and waits for the running ones"""
+        with self._lock:
+            self._closed = True
+            self._pending.clear()
+        self._workers.shutdown(wait=True)
+
+    def __init__(self, workers: int=DEFAULT_WORKERS):
+        if workers < 1:
+            raise ValueError(f"Invalid number of workers {workers}")
+
+        self.workers = workers
+        self._workers = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job-worker')
+        self._lock = threading.Lock()
+        self._pending: Deque[_Task] = deque()
+        # the keys of the running tasks
+        self._busy: Set[str] = set()
+        self._closed = False
+
+        self._running = 0
+        self._executed = 0
+        self._failed = 0
+        self._total_time = 0.0
+        self._max_time = 0.0
@@ -0,0 +1,94 @@
+import heapq
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Tuple
+
+class JobScheduler:
+    """
+    Fires jobs at their next run time.
+    The jobs are kept in a min heap keyed on their next run time and a single thread sleeps until the earliest one
+    is due, so an idle scheduler costs nothing no matter how many jobs there are.
+    Rescheduling or removing a job leaves its old heap entry in place, stale entries are skipped when popped.
+    """
+    def _pop_due_jobs(self, now: float) -> List[str]:
+        due = []
+        while len(self._heap) > 0 and self._heap[0][0] <= now:
+            next_run, job_id = heapq.heappop(self._heap)
+            if self._next_runs.get(job_id) != next_run:
+                continue # stale entry
+            del self._next_runs[job_id]
+            due.append(job_id)
+        return due
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed:
+                    now = time.time()
+                    due = self._pop_due_jobs(now)
+                    if len(due) > 0:
+                        break
+                    timeout = self._heap[0][0] - now if len(self._heap) > 0 else None
+                    self._cond.wait(timeout)
+                if self._closed:
+                    return
+
+            # run the jobs outside the lock, so they can reschedule themselves
+            try:
+                self.on_due(due)
+            except Exception as e:
+                logging.exception(f"Failed to run the due jobs {due}: {e}")
+
+    def schedule(self, job_id: str, next_run: float):
+        """Sets the next run time (epoch seconds) of a job, replacing its previous one"""
+        with self._cond:
+            if self._next_runs.get(job_id) == next_run:
+                return
+            self._next_runs[job_id] = next_run
+            heapq.heappush(self._heap, (next_run, job_id))
+            # wake up the thread, the new run may be earlier than the one it's waiting for
+            self._cond.notify()
+
+    def remove(self, job_id: str):
+        with self._cond:
+            self._next_runs.pop(job_id, None)
+
+    def reset(self, next_runs: Dict[str, float]):
+        """Replaces all the scheduled jobs"""
+        with self._cond:
+            self._next_runs = dict(next_runs)
+            self._heap = [(next_run, job_id) for job_id, next_run in next_runs.items()]
+            heapq.heapify(self._heap)
+            self._cond.notify()
+
+    def get_job_count(self) -> int:
+        with self._cond:
+            return len(self._next_runs)
+
+    def get_next(self) -> Tuple[float, str]:
+        """Returns the (next run time, job id) of the earliest job, None if there are no jobs"""
+        with self._cond:
+            while len(self._heap) > 0 and self._next_runs.get(self._heap[0][1]) != self._heap[0][0]:
+                heapq.heappop(self._heap)
+            return self._heap[0] if len(self._heap) > 0 else None
+
+    def start(self):
+        self._thread.start()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._thread.is_alive() and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def __init__(self, on_due: Callable[[List[str]], None]):
+        """on_due: called (on the scheduler thread) with the ids of the jobs that are due"""
+        self.on_due = on_due
+        self._heap: List[Tuple[float, str]] = []
+        # job id -> next run time, the heap entries that don't match it are stale
+        self._next_runs: Dict[str, float] = {}
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='job-scheduler', daemon=True)
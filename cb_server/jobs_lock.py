@@ -1,10 +1,33 @@
+from collections import namedtuple
 from enum import Enum
+import logging
+import os
+import socket
 import sqlite3
+import threading
+import time
+from typing import Callable
+import uuid
 
 LOCKS_TABLE = 'locks'
 
 LOCK_TYPE_KEY = 'type'
 LOCKED_KEY = 'locked'
+OWNER_KEY = 'owner'
+PID_KEY = 'pid'
+HOSTNAME_KEY = 'hostname'
+LEASE_EXPIRY_KEY = 'lease_expiry' # epoch seconds
+
+DEFAULT_LEASE_TIME = 30 # seconds
+# the lease is renewed (or, by a standby, checked) this many times per lease time
+HEARTBEATS_PER_LEASE = 3
+# how long to wait for another instance that is writing to the database
+LOCK_DB_TIMEOUT = 5 # seconds
+
+LockHolder = namedtuple('LockHolder', ['owner', 'pid', 'hostname', 'lease_expiry'])
+
+class JobsLockLost(Exception):
+    pass
 
 class LockType(Enum):
     JOBS = 'jobs'
@@ -12,52 +35,169 @@ class LockType(Enum):
 class JobsLock:
     """
     Locks the jobs processing so only one instance of the job processor is running at a time.
+    The lock is a lease: the holder renews it periodically (heartbeat), an instance that crashed stops renewing it
+    and once the lease expires another instance (a standby) takes it over.
     """
-    def take_lock(self):
-        # check if the lock table exists
-        conn = sqlite3.connect(self.db_path)
+    def _create_table(self, c: sqlite3.Cursor):
+        c.execute(f'''CREATE TABLE IF NOT EXISTS {LOCKS_TABLE} ({LOCK_TYPE_KEY} TEXT, {LOCKED_KEY} INTEGER,
+            {OWNER_KEY} TEXT, {PID_KEY} INTEGER, {HOSTNAME_KEY} TEXT, {LEASE_EXPIRY_KEY} REAL)''')
+        # the table of older versions has no lease columns
+        columns = {row[1] for row in c.execute(f'PRAGMA table_info({LOCKS_TABLE})')}
+        for column, column_type in [(OWNER_KEY, 'TEXT'), (PID_KEY, 'INTEGER'), (HOSTNAME_KEY, 'TEXT'),
+                (LEASE_EXPIRY_KEY, 'REAL')]:
+            if column not in columns:
+                c.execute(f'ALTER TABLE {LOCKS_TABLE} ADD COLUMN {column} {column_type}')
+
+    def take_lock(self) -> bool:
+        """Takes the lock if it's free, expired or already ours (renewing the lease), returns whether it's ours"""
+        c = self.conn.cursor()
+        # BEGIN IMMEDIATE takes the database write lock up front, so the check and the update are atomic
+        c.execute('BEGIN IMMEDIATE')
+        try:
+            self._create_table(c)
+            c.execute(f"SELECT {LOCKED_KEY}, {OWNER_KEY}, {LEASE_EXPIRY_KEY} FROM {LOCKS_TABLE} WHERE {LOCK_TYPE_KEY}=?",
+                (LockType.JOBS.value,))
+            res = c.fetchall()
+            if len(res) > 1:
+                # multiple locks found, abort
+                raise Exception("Multiple jobs locks found, something is wrong with the database")
+
+            now = time.time()
+            if len(res) == 0:
+                c.execute(f"INSERT INTO {LOCKS_TABLE} ({LOCK_TYPE_KEY}, {LOCKED_KEY}) VALUES (?, 0)",
+                    (LockType.JOBS.value,))
+            else:
+                locked, owner, lease_expiry = res[0]
+                if locked == 1 and owner != self.owner:
+                    if lease_expiry is not None and lease_expiry > now:
+                        # the lock is taken
+                        c.execute('ROLLBACK')
+                        return False
+                    # the holder stopped renewing the lease (a lock of an older version has no lease at all)
+                    logging.warning(f"Taking over the expired jobs lock of '{owner}'")
+
+            c.execute(f'''UPDATE {LOCKS_TABLE} SET {LOCKED_KEY}=1, {OWNER_KEY}=?, {PID_KEY}=?, {HOSTNAME_KEY}=?,
+                {LEASE_EXPIRY_KEY}=? WHERE {LOCK_TYPE_KEY}=?''',
+                (self.owner, os.getpid(), socket.gethostname(), now + self.lease_time, LockType.JOBS.value))
+            c.execute('COMMIT')
+            self.lease_expiry = now + self.lease_time
+            return True
+        except BaseException:
+            if self.conn.in_transaction:
+                c.execute('ROLLBACK')
+            raise
+        finally:
+            c.close()
+
+    def renew_lock(self) -> bool:
+        """Extends the lease, returns False if the lock is no longer ours"""
+        lease_expiry = time.time() + self.lease_time
+        c = self.conn.cursor()
+        c.execute(f'''UPDATE {LOCKS_TABLE} SET {LEASE_EXPIRY_KEY}=?
+            WHERE {LOCK_TYPE_KEY}=? AND {OWNER_KEY}=? AND {LOCKED_KEY}=1''',
+            (lease_expiry, LockType.JOBS.value, self.owner))
+        renewed = c.rowcount > 0
+        c.close()
+        if renewed:
+            self.lease_expiry = lease_expiry
+        return renewed
+
+    def check_lease(self, conn: sqlite3.Connection):
+        """
+        Raises JobsLockLost unless the lock is ours and its lease didn't expire, as seen by 'conn'. Call it in the
+        write transaction of a job, so a job is never run by an instance that a standby may have taken over from
+        """
         c = conn.cursor()
-        c.execute(f"SELECT name FROM sqlite_master WHERE type='table' AND name='{LOCKS_TABLE}'")
-        if len(c.fetchall()) == 0:
-            # the table does not exist, create it
-            c.execute(f"CREATE TABLE {LOCKS_TABLE} ({LOCK_TYPE_KEY} TEXT, {LOCKED_KEY} INTEGER)")
-
-        # check if the lock is taken
-        c.execute(f"SELECT {LOCKED_KEY} FROM {LOCKS_TABLE} WHERE {LOCK_TYPE_KEY}='{LockType.JOBS.value}'")
-        res = c.fetchall()
-        if len(res) > 1:
-            # multiple locks found, abort
-            raise Exception("Multiple jobs locks found, something is wrong with the database")
-        
-        if len(res) == 0:
-            # the lock is not taken, take it
-            c.execute(f"INSERT INTO {LOCKS_TABLE} VALUES ('{LockType.JOBS.value}', 1)")
-        elif res[0][0] == 0:
-            # the lock is not taken, take it
-            c.execute(f"UPDATE {LOCKS_TABLE} SET {LOCKED_KEY}=1 WHERE {LOCK_TYPE_KEY}='{LockType.JOBS.value}'")
-        else:
-            # the lock is taken, abort
-            raise Exception("The jobs lock is already taken")
-        
+        c.execute(f'''SELECT 1 FROM {LOCKS_TABLE} WHERE {LOCK_TYPE_KEY}=? AND {OWNER_KEY}=? AND {LOCKED_KEY}=1 
+            AND {LEASE_EXPIRY_KEY}>?''', (LockType.JOBS.value, self.owner, time.time()))
+        res = c.fetchone()
         c.close()
-        conn.commit()
+        if res is None:
+            raise JobsLockLost("The jobs lock is not held by this instance")
 
     def drop_lock(self):
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute(f"UPDATE {LOCKS_TABLE} SET {LOCKED_KEY}=0 WHERE {LOCK_TYPE_KEY}='{LockType.JOBS.value}'")
+        c = self.conn.cursor()
+        c.execute(f'''UPDATE {LOCKS_TABLE} SET {LOCKED_KEY}=0, {LEASE_EXPIRY_KEY}=NULL
+            WHERE {LOCK_TYPE_KEY}=? AND {OWNER_KEY}=?''', (LockType.JOBS.value, self.owner))
         c.close()
-        conn.commit()
 
-    def __init__(self, db_path: str):
-        self.db_path = db_path
-    
-        self.is_locked = True
-        self.take_lock()
+    def get_holder(self) -> LockHolder:
+        """Returns the current holder of the lock, None if it's free"""
+        with self._lock:
+            c = self.conn.cursor()
+            c.execute(f'''SELECT {OWNER_KEY}, {PID_KEY}, {HOSTNAME_KEY}, {LEASE_EXPIRY_KEY} FROM {LOCKS_TABLE}
+                WHERE {LOCK_TYPE_KEY}=? AND {LOCKED_KEY}=1''', (LockType.JOBS.value,))
+            res = c.fetchone()
+            c.close()
+        return LockHolder(*res) if res is not None else None
+
+    def _heartbeat(self):
+        while not self._stop.wait(self.lease_time / HEARTBEATS_PER_LEASE):
+            try:
+                with self._lock:
+                    if self.is_locked:
+                        if not self.renew_lock():
+                            self.is_locked = False
+                            logging.error("The jobs lock was taken by another instance")
+                            self.on_lost()
+                    elif self.take_lock():
+                        self.is_locked = True
+                        logging.info("Took over the jobs lock")
+                        self.on_acquired()
+            except Exception as e:
+                # e.g. the database is locked for longer than the timeout, try again on the next heartbeat
+                logging.exception(f"Jobs lock heartbeat failed: {e}")
+                with self._lock:
+                    # the lease expired in the database, a standby may take it over any moment
+                    if self.is_locked and time.time() >= self.lease_expiry:
+                        self.is_locked = False
+                        logging.error("The jobs lock lease expired before it could be renewed")
+                        self.on_lost()
+
+    def start(self):
+        """Tries to take the lock (calling 'on_acquired' if it was taken), then keeps renewing or waiting for it"""
+        with self._lock:
+            self.is_locked = self.take_lock()
+            if self.is_locked:
+                self.on_acquired()
+            else:
+                holder = self.get_holder()
+                logging.warning(f"The jobs lock is held by {holder}, standing by")
+        self._thread.start()
 
     def drop(self):
-        if not self.is_locked:
+        if self.is_dropped:
             raise Exception("Multiple attempts to drop the jobs lock detected")
-        
-        self.drop_lock()
+
+        self.is_dropped = True
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        with self._lock:
+            if self.is_locked:
+                self.drop_lock()
+                self.is_locked = False
+        self.conn.close()
+
+    def __init__(self, db_path: str, lease_time: float=DEFAULT_LEASE_TIME, on_acquired: Callable[[], None]=None,
+            on_lost: Callable[[], None]=None):
+        """
+        on_acquired: called when the lock is taken (by 'start' or by the heartbeat, when taking over)
+        on_lost: called when the lease was lost (another instance took over after this one didn't renew it in time)
+        """
+        self.db_path = db_path
+        self.lease_time = lease_time
+        self.on_acquired = on_acquired or (lambda: None)
+        self.on_lost = on_lost or (lambda: None)
+        self.owner = str(uuid.uuid4())
+
+        # autocommit mode, the transactions are explicit
+        self.conn = sqlite3.connect(db_path, timeout=LOCK_DB_TIMEOUT, isolation_level=None, check_same_thread=False)
+        # serializes the use of the connection (the heartbeat thread and the callers)
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._heartbeat, name='jobs-lock-heartbeat', daemon=True)
         self.is_locked = False
+        # the lease expiry of the last successful take or renew (epoch seconds)
+        self.lease_expiry = 0
+        self.is_dropped = False
@@ -0,0 +1,186 @@
+'''
+A minimal in process metrics registry (counters, gauges and histograms) that renders the Prometheus text format,
+so a local scraper can read /metrics without a client library dependency.
+'''
+import bisect
+from collections import namedtuple
+from contextlib import contextmanager
+import math
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Tuple
+
+# latency buckets (seconds), from a fast sqlite read to a slow request
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# a metric read at scrape time from a collector: type is 'gauge' or 'counter', samples is a list of (labels, value)
+CollectedMetric = namedtuple('CollectedMetric', ['name', 'type', 'help', 'samples'])
+
+def escape_label_value(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labels: Dict[str, object]) -> str:
+    if len(labels) == 0:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label_value(value)}"' for name, value in labels.items()) + '}'
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    """A metric with a value (or a histogram) per combination of label values"""
+    TYPE = None
+
+    def _key(self, labels: Dict[str, object]) -> Tuple:
+        try:
+            if len(labels) == len(self.label_names):
+                return tuple(str(labels[name]) for name in self.label_names)
+        except KeyError:
+            pass
+        raise ValueError(f"Metric '{self.name}' expects the labels {self.label_names}, got {list(labels)}")
+
+    def _samples(self) -> Iterable[Tuple[str, Dict[str, str], float]]:
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield self.name, dict(zip(self.label_names, key)), value
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.TYPE}']
+        for name, labels, value in self._samples():
+            lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+        return lines
+
+    def __init__(self, name: str, help: str, label_names: Iterable[str]=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple, object] = {}
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def inc(self, amount: float=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    TYPE = 'gauge'
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float=1, **labels):
+        self.inc(-amount, **labels)
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        # the index of the first bucket the value fits in (le is inclusive), len(buckets) is +Inf
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # [bucket counts (not cumulative)..., sum, count]
+                state = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            state[index] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes the duration of the block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self) -> Iterable[Tuple[str, Dict[str, str], float]]:
+        with self._lock:
+            values = [(key, list(state)) for key, state in self._values.items()]
+        for key, state in values:
+            labels = dict(zip(self.label_names, key))
+            cumulative = 0
+            for bound, count in zip(list(self.buckets) + [math.inf], state[:-2]):
+                cumulative += count
+                yield f'{self.name}_bucket', {**labels, 'le': format_value(float(bound))}, cumulative
+            yield f'{self.name}_sum', labels, state[-2]
+            yield f'{self.name}_count', labels, state[-1]
+
+    def __init__(self, name: str, help: str, label_names: Iterable[str]=(), buckets: Iterable[float]=DEFAULT_BUCKETS):
+        super().__init__(name, help, label_names)
+        self.buckets = sorted(buckets)
+
+class MetricsRegistry:
+    """
+    The metrics of the process. Metrics are registered once (registering a name again returns the existing metric),
+    collectors are called at scrape time for the values that are kept elsewhere (e.g. the pools stats)
+    """
+    def _register(self, metric_class, name: str, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = metric_class(name, *args, **kwargs)
+            elif not isinstance(metric, metric_class):
+                raise ValueError(f"Metric '{name}' is already registered as a {metric.TYPE}")
+            return metric
+
+    def counter(self, name: str, help: str, label_names: Iterable[str]=()) -> Counter:
+        return self._register(Counter, name, help, label_names)
+
+    def gauge(self, name: str, help: str, label_names: Iterable[str]=()) -> Gauge:
+        return self._register(Gauge, name, help, label_names)
+
+    def histogram(self, name: str, help: str, label_names: Iterable[str]=(),
+            buckets: Iterable[float]=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram, name, help, label_names, buckets)
+
+    def add_collector(self, collector: Callable[[], List[CollectedMetric]]):
+        with self._lock:
+            self._collectors.append(collector)
+
+    def remove_collector(self, collector: Callable[[], List[CollectedMetric]]):
+        with self._lock:
+            if collector in self._collectors:
+                self._collectors.remove(collector)
+
+    def render(self) -> str:
+        """Returns all the metrics in the Prometheus text format"""
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+            collectors = list(self._collectors)
+
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        for collector in collectors:
+            for collected in collector():
+                lines.append(f'# HELP {collected.name} {collected.help}')
+                lines.append(f'# TYPE {collected.name} {collected.type}')
+                for labels, value in collected.samples:
+                    lines.append(f'{collected.name}{format_labels(labels)} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, Metric] = {}
+        self._collectors: List[Callable[[], List[CollectedMetric]]] = []
+
+# the registry of the server process
+REGISTRY = MetricsRegistry()
@@ -0,0 +1,315 @@
+'''
+An opt-in profiler of the sql statements the repo runs. It's attached to every connection the pools open: sqlite
+traces each statement it runs (set_trace_callback), the progress handler counts the virtual machine instructions and
+the connection cursors time the calls into sqlite (executing and fetching) and count the returned rows.
+The statements are aggregated by their normalized text (the literals replaced by '?'), the ones that are slower than
+a threshold are written to the slow queries log with their query plan.
+'''
+from collections import namedtuple
+from contextlib import contextmanager
+import functools
+import logging
+import pathlib
+import re
+import sqlite3
+import threading
+import time
+from typing import Dict, List
+
+DEFAULT_SLOW_QUERY_TIME = 0.1 # seconds
+# the progress handler is called every this many sqlite virtual machine instructions
+PROGRESS_HANDLER_OPS = 1000
+# the number of statements in the report, the ones with the highest total time
+REPORT_SIZE = 30
+MAX_REPORTED_STATEMENT_LENGTH = 120
+# the statements sqlite can explain
+EXPLAINED_STATEMENTS = ['SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE']
+# the sqlite3 module starts the implicit transactions (before an INSERT / UPDATE / DELETE) with this statement
+IMPLICIT_BEGIN = 'BEGIN '
+
+# route this logger to a file to keep a slow queries log (see the server '--slow-query-log' argument)
+SLOW_QUERIES_LOGGER = logging.getLogger('cb_server.slow_queries')
+
+# total_time and max_time are in seconds, ops are the (approximate) sqlite virtual machine instructions. total_time,
+# rows and ops include fetching the rows, max_time (and the slow queries log) only the executions
+StatementStats = namedtuple('StatementStats', ['statement', 'count', 'total_time', 'max_time', 'rows', 'ops'])
+
+STRING_LITERAL_RE = re.compile(r"[xX]?'(?:[^']|'')*'")
+NUMBER_LITERAL_RE = re.compile(r'\b\d+(?:\.\d+)?\b')
+IN_LIST_RE = re.compile(r'\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)', re.IGNORECASE)
+WHITESPACE_RE = re.compile(r'\s+')
+
+@functools.lru_cache(maxsize=1024)
+def normalize_statement(sql: str) -> str:
+    """The statement with its literals replaced by '?', the key its executions are aggregated by"""
+    sql = STRING_LITERAL_RE.sub('?', sql)
+    sql = NUMBER_LITERAL_RE.sub('?', sql)
+    # 'IN (?, ?, ?)' of any length is the same statement
+    sql = IN_LIST_RE.sub('IN (?, ...)', sql)
+    return WHITESPACE_RE.sub(' ', sql).strip()
+
+class StatementExecution:
+    """An execution of a statement (or a fetch of its rows), its time is the time spent in sqlite"""
+    def __init__(self, key: str, sql: str, count: int=1):
+        self.key = key
+        self.sql = sql
+        # the statement with the parameters values, set when sqlite runs it (nothing is recorded otherwise)
+        self.expanded_sql: str = None
+        # executemany runs the statement for each parameters
+        self.count = count
+        self.time = 0.0
+        self.rows = 0
+        self.ops = 0
+
+class ConnectionProfile:
+    """The profiling state of a connection (only one thread uses a connection at a time)"""
+    def on_trace(self, sql: str):
+        # the statements of the triggers are traced with the text of the statement that fired them
+        execution = self.current
+        if execution is None or (sql == IMPLICIT_BEGIN and execution.key != 'BEGIN'):
+            # not run from a cursor (e.g. an implicit BEGIN, a script), counted but not timed
+            self.profiler.count_statement(normalize_statement(sql))
+        elif execution.expanded_sql is None:
+            execution.expanded_sql = sql
+
+    def on_progress(self) -> int:
+        self.ops += PROGRESS_HANDLER_OPS
+        return 0 # continue
+
+    @contextmanager
+    def running(self, execution: StatementExecution):
+        """Times a call into sqlite made for the execution"""
+        previous = self.current
+        self.current = execution
+        ops = self.ops
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            execution.time += time.perf_counter() - start
+            execution.ops += self.ops - ops
+            self.current = previous
+
+    @contextmanager
+    def timed(self, sql: str):
+        """Times a statement that isn't run from a cursor (e.g. COMMIT)"""
+        execution = StatementExecution(normalize_statement(sql), sql)
+        try:
+            with self.running(execution):
+                yield
+        finally:
+            self.finish(execution)
+
+    def finish(self, execution: StatementExecution):
+        # not counted when sqlite didn't run it (e.g. a COMMIT without a transaction, an invalid statement)
+        if execution.expanded_sql is not None:
+            self.profiler.record(execution)
+
+    def __init__(self, profiler: 'SqlProfiler'):
+        self.profiler = profiler
+        self.cursor_factory = ProfiledCursor
+        self.current: StatementExecution = None
+        self.ops = 0
+
+class ProfiledCursor(sqlite3.Cursor):
+    """
+    The cursor of a profiled connection. An execution is recorded when 'execute' returns, the time and the rows of
+    the fetches that follow are added to its statement as they are fetched (nothing waits for the cursor to be
+    closed or garbage collected)
+    """
+    @contextmanager
+    def _executing(self, execution: StatementExecution):
+        # the rows of the previous statement aren't fetched anymore
+        self._execution = None
+        try:
+            with self._profile.running(execution):
+                yield
+        finally:
+            if self.description is None:
+                # no rows to fetch (e.g. an UPDATE), the changed rows are counted
+                execution.rows = max(self.rowcount, 0)
+            else:
+                self._execution = execution
+            self._profile.finish(execution)
+
+    def execute(self, sql: str, parameters=()):
+        with self._executing(StatementExecution(normalize_statement(sql), sql)):
+            super().execute(sql, parameters)
+        return self
+
+    def executemany(self, sql: str, seq_of_parameters):
+        seq_of_parameters = list(seq_of_parameters)
+        with self._executing(StatementExecution(normalize_statement(sql), sql, len(seq_of_parameters))):
+            super().executemany(sql, seq_of_parameters)
+        return self
+
+    @contextmanager
+    def _fetching(self):
+        fetch = StatementExecution(self._execution.key, self._execution.sql, count=0)
+        try:
+            with self._profile.running(fetch):
+                yield fetch
+        finally:
+            self._profile.profiler.record_fetch(fetch)
+
+    def fetchone(self):
+        if self._execution is None:
+            return super().fetchone()
+        with self._fetching() as fetch:
+            row = super().fetchone()
+            fetch.rows = int(row is not None)
+        if row is None:
+            self._execution = None
+        return row
+
+    def fetchmany(self, size: int=None):
+        size = size if size is not None else self.arraysize
+        if self._execution is None:
+            return super().fetchmany(size)
+        with self._fetching() as fetch:
+            rows = super().fetchmany(size)
+            fetch.rows = len(rows)
+        if len(rows) < size:
+            self._execution = None
+        return rows
+
+    def fetchall(self):
+        if self._execution is None:
+            return super().fetchall()
+        with self._fetching() as fetch:
+            rows = super().fetchall()
+            fetch.rows = len(rows)
+        self._execution = None
+        return rows
+
+    def __next__(self):
+        row = self.fetchone()
+        if row is None:
+            raise StopIteration
+        return row
+
+    def __init__(self, conn: sqlite3.Connection):
+        super().__init__(conn)
+        self._profile: ConnectionProfile = conn.profile
+        # the recorded execution whose rows are being fetched
+        self._execution: StatementExecution = None
+
+class SqlProfiler:
+    """
+    Aggregates the statements of the connections it's attached to (see 'attach'), the statements that take longer
+    than 'slow_query_time' seconds are logged to the slow queries log
+    """
+    def attach(self, conn: sqlite3.Connection):
+        """Profiles a pooled connection (its cursors are timed, see PooledConnection)"""
+        profile = ConnectionProfile(self)
+        conn.profile = profile
+        conn.set_trace_callback(profile.on_trace)
+        conn.set_progress_handler(profile.on_progress, PROGRESS_HANDLER_OPS)
+
+    def _get_stats(self, key: str) -> list:
+        # must be called with the lock held
+        stats = self._stats.get(key)
+        if stats is None:
+            # [count, total time, max time, rows, ops]
+            stats = self._stats[key] = [0, 0.0, 0.0, 0, 0]
+        return stats
+
+    def count_statement(self, key: str):
+        with self._lock:
+            self._get_stats(key)[0] += 1
+
+    def record(self, execution: StatementExecution):
+        with self._lock:
+            stats = self._get_stats(execution.key)
+            stats[0] += execution.count
+            stats[1] += execution.time
+            stats[2] = max(stats[2], execution.time)
+            stats[3] += execution.rows
+            stats[4] += execution.ops
+
+        if execution.time >= self.slow_query_time:
+            self.log_slow_query(execution)
+
+    def record_fetch(self, fetch: StatementExecution):
+        """Adds the time and the rows of a fetch to its statement, recorded when it was executed"""
+        with self._lock:
+            stats = self._get_stats(fetch.key)
+            stats[1] += fetch.time
+            stats[3] += fetch.rows
+            stats[4] += fetch.ops
+
+    def log_slow_query(self, execution: StatementExecution):
+        sql = execution.expanded_sql or execution.sql
+        SLOW_QUERIES_LOGGER.warning(f"Slow query ({execution.time * 1000:.1f} ms, {execution.rows} rows, " +
+            f"{execution.ops} ops): {sql}\n{self.explain(execution.key, sql)}")
+
+    def explain(self, key: str, sql: str) -> str:
+        """The query plan of the statement (cached by the normalized statement), on a read only connection"""
+        if key.split(' ', 1)[0].upper() not in EXPLAINED_STATEMENTS:
+            return 'no query plan'
+
+        with self._explain_lock:
+            plan = self._plans.get(key)
+            if plan is not None:
+                return plan
+            if self._closed:
+                return 'no query plan, the profiler is closed'
+
+            try:
+                if self._explain_conn is None:
+                    uri = pathlib.Path(self.db_path).absolute().as_uri() + '?mode=ro'
+                    self._explain_conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+                rows = self._explain_conn.execute(f'EXPLAIN QUERY PLAN {sql}').fetchall()
+            except sqlite3.Error as e:
+                # not cached, e.g. the database was locked
+                return f'no query plan: {e}'
+
+            # rows of (id, parent id, not used, detail), the children are indented under their parent
+            depths = {0: 0}
+            lines = []
+            for node_id, parent_id, _, detail in rows:
+                depths[node_id] = depths.get(parent_id, 0) + 1
+                lines.append('  ' * depths[node_id] + detail)
+            plan = self._plans[key] = '\n'.join(lines)
+            return plan
+
+    def get_stats(self) -> List[StatementStats]:
+        """The statements sorted by their total time, the slowest first"""
+        with self._lock:
+            stats = [StatementStats(key, *values) for key, values in self._stats.items()]
+        return sorted(stats, key=lambda s: s.total_time, reverse=True)
+
+    def format_report(self, limit: int=REPORT_SIZE) -> str:
+        stats = self.get_stats()
+        total_count = sum(s.count for s in stats)
+        total_time = sum(s.total_time for s in stats)
+        lines = [f'SQL profile: {total_count} statements ({len(stats)} distinct) in {total_time * 1000:.1f} ms',
+            f'{"count":>8} {"total ms":>10} {"avg ms":>8} {"max ms":>8} {"rows":>9} {"ops":>10}  statement']
+        for s in stats[:limit]:
+            statement = s.statement if len(s.statement) <= MAX_REPORTED_STATEMENT_LENGTH \
+                else s.statement[:MAX_REPORTED_STATEMENT_LENGTH - 3] + '...'
+            lines.append(f'{s.count:>8} {s.total_time * 1000:>10.1f} {s.total_time * 1000 / s.count:>8.2f} ' +
+                f'{s.max_time * 1000:>8.2f} {s.rows:>9} {s.ops:>10}  {statement}')
+        if len(stats) > limit:
+            lines.append(f'... {len(stats) - limit} more statements')
+        return '\n'.join(lines)
+
+    def close(self):
+        with self._explain_lock:
+            self._closed = True
+            if self._explain_conn is not None:
+                self._explain_conn.close()
+                self._explain_conn = None
+
+    def __init__(self, db_path: str, slow_query_time: float=DEFAULT_SLOW_QUERY_TIME):
+        """slow_query_time: seconds, None to disable the slow queries log"""
+        self.db_path = db_path
+        self.slow_query_time = slow_query_time if slow_query_time is not None else float('inf')
+        self._lock = threading.Lock()
+        # normalized statement -> [count, total time, max time, rows, ops]
+        self._stats: Dict[str, list] = {}
+        self._explain_lock = threading.Lock()
+        self._explain_conn: sqlite3.Connection = None
+        # normalized statement -> its query plan
+        self._plans: Dict[str, str] = {}
+        self._closed = False
@@ -0,0 +1,6 @@
+from collections import namedtuple
+
+# a scheduled transfer, times are in ISO format (next_run is None until the job is scheduled)
+ScheduledTransferInfo = namedtuple('ScheduledTransferInfo', ['id', 'userid', 'cron', 'to', 'value', 'description', 
+                                                             'handle_missed_events', 'last_run', 'last_run_status', 
+                                                             'last_run_error', 'next_run'])
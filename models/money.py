@@ -0,0 +1,34 @@
+from decimal import Decimal, InvalidOperation
+
+# money is stored and computed as integer minor units (agorot / cents), so sums are exact.
+# at the API edge amounts are decimal strings (e.g. "12.50"), a JSON float would bring the rounding back
+MINOR_UNITS = 100
+MINOR_UNIT_DIGITS = 2
+
+def to_minor_units(amount) -> int:
+    """
+    Converts an amount (a decimal string, or a number) to minor units, e.g. "12.5" -> 1250.
+    Raises ValueError if it's not a number or is more precise than a minor unit
+    """
+    if isinstance(amount, bool):
+        raise ValueError(f"Invalid amount: '{amount}'")
+    try:
+        # str() of a float is its shortest representation, so 0.1 is parsed as exactly 0.1
+        value = Decimal(str(amount).strip())
+    except InvalidOperation:
+        raise ValueError(f"Invalid amount: '{amount}'")
+    if not value.is_finite():
+        raise ValueError(f"Invalid amount: '{amount}'")
+
+    units = value * MINOR_UNITS
+    if units != units.to_integral_value():
+        raise ValueError(f"Invalid amount: '{amount}' (more than {MINOR_UNIT_DIGITS} decimal digits)")
+    return int(units)
+
+def to_decimal(units: int) -> Decimal:
+    """Converts minor units to an exact decimal amount, e.g. 1250 -> Decimal('12.50')"""
+    return Decimal(units).scaleb(-MINOR_UNIT_DIGITS)
+
+def format_amount(units: int) -> str:
+    """Formats minor units as a decimal string, e.g. 1250 -> '12.50'"""
+    return str(to_decimal(units))
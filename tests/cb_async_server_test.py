@@ -0,0 +1,203 @@
+import asyncio
+import gzip
+import json
+import os
+import tempfile
+import unittest
+from aiohttp.test_utils import TestClient, TestServer
+from cb_server.cb_async_server import DB_EXECUTOR_KEY, create_app
+from cb_server.cb_repo import TRANSACTIONS_FETCH_SIZE, Repo
+
+class AsyncServerTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.repo = Repo(os.path.join(self.temp_dir.name, 'test.db'), create=True)
+        for userid, balance in [('alice', 1000), ('bob', 0), ('carol', 0)]:
+            self.repo.add_user(userid, balance)
+        # a single database thread, so the tests can check its state between the database calls of a request
+        self.app = create_app(self.repo, db_threads=1)
+        self.client = TestClient(TestServer(self.app))
+        await self.client.start_server()
+
+    async def asyncTearDown(self):
+        await self.client.close()
+        self.repo.close()
+        self.temp_dir.cleanup()
+
+    async def transfer(self, from_userid: str, to_userid: str, value: str, description: str='rent'):
+        response = await self.client.post(f'/user/{from_userid}/transfer',
+            json={'to': to_userid, 'value': value, 'description': description})
+        self.assertEqual(response.status, 204)
+
+    async def run_on_db_thread(self, func):
+        return await asyncio.get_running_loop().run_in_executor(self.app[DB_EXECUTOR_KEY], func)
+
+    async def test_user_routes(self):
+        response = await self.client.post('/user/dave')
+        self.assertEqual(response.status, 204)
+        await self.transfer('alice', 'dave', '1.5')
+        response = await self.client.get('/user/dave/balance')
+        self.assertEqual(await response.json(), {'balance': '1.50'})
+        response = await self.client.get('/user/nobody/balance')
+        self.assertEqual(response.status, 404)
+
+        response = await self.client.post('/user/dave/transfer', json={'to': 'bob', 'value': '100'})
+        self.assertEqual(response.status, 400)
+        response = await self.client.get('/user/dave/transactions')
+        transactions = await response.json()
+        self.assertEqual([(t['userid'], t['description']) for t in transactions], [('dave', 'rent')])
+
+    async def test_batch_transfer(self):
+        response = await self.client.post('/transfers/batch', json={'transfers': [
+            {'from': 'alice', 'to': 'bob', 'value': '1', 'description': 'a'},
+            {'from': 'bob', 'to': 'carol', 'value': '0.5', 'description': 'b'}]})
+        self.assertEqual(await response.json(), {'success': True,
+            'results': [{'success': True, 'error': None}, {'success': True, 'error': None}]})
+        response = await self.client.get('/user/carol/balance')
+        self.assertEqual(await response.json(), {'balance': '0.50'})
+
+        response = await self.client.post('/transfers/batch', json={'transfers': 'all'})
+        self.assertEqual(response.status, 400)
+
+    async def test_jobs(self):
+        response = await self.client.post('/user/alice/jobs', json={'cron': '0 4 * * *', 'to': 'bob', 'value': '1.5'})
+        self.assertEqual(response.status, 201)
+        job_id = (await response.json())['id']
+        response = await self.client.post('/user/alice/jobs', json={'cron': 'never', 'to': 'bob', 'value': '1'})
+        self.assertEqual(response.status, 400)
+
+        response = await self.client.patch(f'/jobs/{job_id}', json={'value': '2', 'description': 'rent'})
+        self.assertEqual(response.status, 204)
+        response = await self.client.get(f'/jobs/{job_id}')
+        job = await response.json()
+        self.assertEqual((job['to'], job['value'], job['description']), ('bob', '2.00', 'rent'))
+        response = await self.client.get('/user/alice/jobs')
+        self.assertEqual([job['id'] for job in await response.json()], [job_id])
+
+        response = await self.client.delete(f'/jobs/{job_id}')
+        self.assertEqual(response.status, 204)
+        for method in ['GET', 'PATCH', 'DELETE']:
+            response = await self.client.request(method, f'/jobs/{job_id}', json={})
+            self.assertEqual(response.status, 404)
+
+    async def test_stats(self):
+        response = await self.client.get('/stats')
+        stats = await response.json()
+        self.assertTrue(stats['jobs_lock']['is_locked'])
+        self.assertEqual(set(stats['pools']), {'write', 'read'})
+
+    async def test_transactions_pages(self):
+        for i in range(5):
+            await self.transfer('alice', 'bob', '0.01', f'payment {i}')
+
+        descriptions = []
+        cursor = None
+        while True:
+            params = {'page_size': '2'} if cursor is None else {'page_size': '2', 'cursor': cursor}
+            response = await self.client.get('/user/bob/transactions', params=params)
+            page = await response.json()
+            descriptions += [t['description'] for t in page['transactions']]
+            cursor = page['next_cursor']
+            if cursor is None:
+                break
+        # the transfers of the same second are ordered by their id
+        self.assertEqual(sorted(descriptions), [f'payment {i}' for i in range(5)])
+
+        response = await self.client.get('/user/bob/transactions', params={'page_size': '0'})
+        self.assertEqual(response.status, 400)
+
+    async def test_streamed_export(self):
+        # more pages than the socket buffers hold, with many rows of the same second (the pages continue from
+        # (timestamp, id))
+        n_transactions = 40 * TRANSACTIONS_FETCH_SIZE + 10
+        with self.repo.pool.connection() as conn:
+            for i in range(n_transactions):
+                self.repo.force_add_transaction('bob', 1, 1700000000 + i // 100, f'payment {i}', conn=conn)
+            conn.commit()
+
+        response = await self.client.get('/user/bob/transactions', params={'format': 'jsonl'})
+        self.assertEqual(response.headers['Content-Type'], 'application/x-ndjson')
+        first_line = await response.content.readline()
+        # the read connection isn't held between the pages of the export
+        self.assertEqual(await self.run_on_db_thread(lambda: self.repo.read_pool.get_stats().in_use), 0)
+        self.assertIsNone(await self.run_on_db_thread(lambda: getattr(self.repo.read_pool._local, 'conn', None)))
+
+        lines = [first_line] + (await response.content.read()).splitlines()
+        transactions = [json.loads(line) for line in lines]
+        self.assertEqual(len(transactions), n_transactions)
+        self.assertEqual(len({t['id'] for t in transactions}), n_transactions)
+
+        response = await self.client.get('/user/bob/transactions', params={'format': 'jsonl'},
+            headers={'Accept-Encoding': 'gzip'}, auto_decompress=False)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(len(gzip.decompress(await response.read()).splitlines()), n_transactions)
+
+    async def test_conditional_get_and_compression(self):
+        response = await self.client.get('/user/bob/balance')
+        etag = response.headers['ETag']
+        self.assertTrue(etag.startswith('W/'))
+        response = await self.client.get('/user/bob/balance', headers={'If-None-Match': etag})
+        self.assertEqual(response.status, 304)
+        await self.transfer('alice', 'bob', '0.01')
+        response = await self.client.get('/user/bob/balance', headers={'If-None-Match': etag})
+        self.assertEqual(response.status, 200)
+
+        for _ in range(20):
+            await self.transfer('alice', 'bob', '0.01')
+        response = await self.client.get('/user/bob/transactions', headers={'Accept-Encoding': 'gzip'},
+            auto_decompress=False)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(len(json.loads(gzip.decompress(await response.read()))), 21)
+
+    async def test_transactions_query(self):
+        await self.transfer('alice', 'bob', '0.01')
+        await self.transfer('alice', 'carol', '0.02')
+        response = await self.client.post('/transactions/query', json={'users': ['bob', 'carol']})
+        transactions = await response.json()
+        self.assertEqual({username: len(user_transactions) for username, user_transactions in transactions.items()},
+            {'bob': 1, 'carol': 1})
+
+        response = await self.client.post('/transactions/query',
+            json={'users': {'alice': None, 'bob': '2100-01-01T00:00:00'}})
+        transactions = await response.json()
+        self.assertEqual(len(transactions['alice']), 2)
+        self.assertEqual(transactions['bob'], [])
+
+        response = await self.client.post('/transactions/query', json={'users': 'bob'})
+        self.assertEqual(response.status, 400)
+        response = await self.client.post('/transactions/query', json={'users': ['bob'], 'from_time': 'soon'})
+        self.assertEqual(response.status, 400)
+
+    async def test_changes_feed(self):
+        response = await self.client.get('/changes')
+        head = await response.json()
+        self.assertEqual(head['changes'], [])
+
+        await self.transfer('alice', 'bob', '0.01')
+        response = await self.client.get('/changes', params={'after': str(head['last_seq'])})
+        changes = await response.json()
+        self.assertEqual([(c['userid'], c['description']) for c in changes['changes']],
+            [('alice', 'rent'), ('bob', 'rent')])
+        self.assertEqual(changes['last_seq'], changes['head_seq'])
+
+        response = await self.client.get('/changes', params={'limit': '0'})
+        self.assertEqual(response.status, 400)
+
+        # a long poll is woken up by the next commit
+        long_poll = asyncio.ensure_future(self.client.get('/changes',
+            params={'after': str(changes['last_seq']), 'wait': '10'}))
+        await asyncio.sleep(0.1)
+        self.assertFalse(long_poll.done())
+        await self.transfer('alice', 'carol', '0.01', 'woken up')
+        response = await asyncio.wait_for(long_poll, 5)
+        changes = await response.json()
+        self.assertEqual([c['description'] for c in changes['changes']], ['woken up', 'woken up'])
+
+    async def test_changes_long_poll_times_out(self):
+        response = await self.client.get('/changes')
+        head = await response.json()
+        response = await self.client.get('/changes', params={'after': str(head['last_seq']), 'wait': '1'})
+        self.assertEqual((await response.json())['changes'], [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,604 @@
+from datetime import datetime, timedelta
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+from cb_server.crontab import CronParsingException
+from cb_server.cb_repo import BATCH_NOT_EXECUTED_ERROR, IDEMPOTENCY_KEY_TTL, REQUIRED_DB_VERSION, \
+    TRANSACTIONS_ID_INDEX, TRANSACTIONS_USER_TIME_INDEX, IdempotencyKeyReused, JobInfo, Repo, RepoConfig, TransferLeg
+
+def create_v2_database(db_path: str):
+    """Creates a database the way version 2 of the server did (rollback journal, no indexes)"""
+    conn = sqlite3.connect(db_path)
+    conn.executescript('''
+        CREATE TABLE user_balance (userid TEXT PRIMARY KEY, balance REAL NOT NULL);
+        CREATE TABLE user (userid TEXT PRIMARY KEY, overdraft_limit REAL NOT NULL);
+        CREATE TABLE transactions (userid TEXT NOT NULL, value REAL NOT NULL, timestamp INTEGER NOT NULL,
+            description TEXT NOT NULL, id TEXT NOT NULL);
+        CREATE TABLE version (version INTEGER NOT NULL);
+        INSERT INTO version (version) VALUES (2);
+        CREATE TABLE jobs (id TEXT PRIMARY KEY, userid TEXT NOT NULL, cron TEXT NOT NULL, action INTEGER NOT NULL,
+            action_params TEXT NOT NULL, description TEXT NOT NULL, last_run INTEGER NOT NULL,
+            last_run_status INTEGER NOT NULL, last_run_error TEXT NOT NULL, handle_missed_events INTEGER NOT NULL);
+        INSERT INTO user VALUES ('alice', 0), ('bob', 0);
+        INSERT INTO user_balance VALUES ('alice', 100.1), ('bob', 0);
+        INSERT INTO transactions VALUES ('alice', 100.1, 1700000000, 'initial deposit', 'guid-1');
+        INSERT INTO jobs VALUES ('job-1', 'alice', '0 0 1 * *', 1, '{"to": "bob", "value": 2.5, "description": ""}', 
+            'pocket money', 4102444800, 0, '', 0);
+    ''')
+    conn.commit()
+    conn.close()
+
+def insert_job(conn: sqlite3.Connection, job_info: JobInfo):
+    conn.execute(f'INSERT INTO jobs ({", ".join(JobInfo._fields)}) VALUES ({", ".join("?" * len(job_info))})', job_info)
+
+class RepoTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.temp_dir.name, 'test.db')
+        self.repos = []
+
+    def tearDown(self):
+        for repo in self.repos:
+            repo.close()
+        self.temp_dir.cleanup()
+
+    def open_repo(self, create: bool=False, **kwargs) -> Repo:
+        repo = Repo(self.db_path, create=create, **kwargs)
+        self.repos.append(repo)
+        return repo
+
+    def get_journal_mode(self) -> str:
+        conn = sqlite3.connect(self.db_path)
+        mode = conn.execute('PRAGMA journal_mode').fetchone()[0]
+        conn.close()
+        return mode
+
+    def test_new_database_uses_wal(self):
+        repo = self.open_repo(create=True)
+        self.assertEqual(self.get_journal_mode(), 'wal')
+        self.assertEqual(repo.get_database_version(), REQUIRED_DB_VERSION)
+
+    def test_migration_from_version_2(self):
+        create_v2_database(self.db_path)
+        repo = self.open_repo()
+        self.assertEqual(self.get_journal_mode(), 'wal')
+        self.assertEqual(repo.get_database_version(), REQUIRED_DB_VERSION)
+        # the amounts are converted to integer minor units
+        self.assertEqual(repo.get_user_balance('alice'), 10010)
+        transactions = repo.get_user_transactions('alice', None)
+        self.assertEqual(len(transactions), 1)
+        self.assertEqual(transactions[0][1], 10010)
+        self.assertIsInstance(transactions[0][1], int)
+        self.assertEqual(json.loads(repo.get_job('job-1').action_params)['value'], 250)
+        self.assertEqual(repo.transfer_money('alice', 'bob', 10, 'after the migration'), (True, None))
+        self.assertEqual(repo.get_user_balance_at('alice', int(time.time()) + 1), 10000)
+
+    def test_history_query_uses_the_index(self):
+        create_v2_database(self.db_path)
+        repo = self.open_repo()
+        with repo.pool.connection() as conn:
+            indexes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='index'")}
+            self.assertTrue({TRANSACTIONS_USER_TIME_INDEX, TRANSACTIONS_ID_INDEX}.issubset(indexes))
+            plan = ' '.join(row[3] for row in conn.execute('EXPLAIN QUERY PLAN SELECT timestamp FROM transactions ' + 
+                'WHERE userid=? AND timestamp>=? ORDER BY timestamp DESC', ('alice', 0)))
+            self.assertIn(TRANSACTIONS_USER_TIME_INDEX, plan)
+            self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_readers_do_not_block_on_the_writer(self):
+        repo = self.open_repo(create=True)
+        repo.add_user('alice', 100)
+        repo.add_user('bob', 0)
+
+        # hold an open write transaction while reading through the read only pool
+        with repo.pool.connection() as conn:
+            self.assertTrue(repo.transfer_money('alice', 'bob', 30, 'pending', conn=conn)[0])
+            self.assertEqual(repo.get_user_balance('alice'), 100)
+            conn.commit()
+
+        self.assertEqual(repo.get_user_balance('alice'), 70)
+        self.assertEqual(repo.get_user_balance('bob'), 30)
+
+    def test_users_transactions_in_one_query(self):
+        repo = self.open_repo(create=True)
+        for userid in ['alice', 'bob', 'carol']:
+            repo.add_user(userid, 0)
+        repo.force_add_transaction('alice', 10, 1000, 'old')
+        repo.force_add_transaction('alice', 20, 2000, 'new')
+        repo.force_add_transaction('bob', 30, 1500, 'bob')
+
+        result = repo.get_users_transactions({'alice': 1500, 'bob': None, 'carol': 0, 'dave': None})
+        self.assertEqual([t[2] for t in result['alice']], ['new'])
+        self.assertEqual([t[2] for t in result['bob']], ['bob'])
+        self.assertEqual(result['carol'], [])
+        self.assertEqual(result['dave'], [])
+        self.assertEqual(result['alice'], repo.get_user_transactions('alice', None, from_timestamp=1500))
+
+    def test_changes_feed(self):
+        create_v2_database(self.db_path)
+        repo = self.open_repo()
+        # the existing transactions are numbered by the migration
+        self.assertEqual(repo.get_last_seq(), 1)
+        repo.add_user('carol', 0)
+        repo.transfer_money('alice', 'bob', 10, 'first')
+        repo.transfer_money('alice', 'carol', 5, 'second')
+        self.assertEqual(repo.get_last_seq(), 5)
+
+        changes = repo.get_changes(1, 3)
+        self.assertEqual([c[0] for c in changes], [2, 3, 4])
+        self.assertEqual([(c[1], c[4]) for c in changes], [('alice', 'first'), ('bob', 'first'), ('alice', 'second')])
+        self.assertEqual([c[0] for c in repo.get_changes(4, 3)], [5])
+        self.assertEqual(repo.get_changes(5, 3), [])
+
+    def test_commit_wakes_up_changes_waiters(self):
+        repo = self.open_repo(create=True)
+        repo.add_user('alice', 100)
+        repo.add_user('bob', 0)
+        self.assertFalse(repo.wait_for_changes(0, 0.01))
+
+        # nothing is published before the transaction is committed
+        with repo.pool.connection() as conn:
+            repo.transfer_money('alice', 'bob', 10, 'rolled back', conn=conn)
+            conn.rollback()
+        self.assertFalse(repo.wait_for_changes(0, 0.01))
+
+        timer = threading.Timer(0.05, lambda: repo.transfer_money('alice', 'bob', 10, 'committed'))
+        timer.start()
+        self.assertTrue(repo.wait_for_changes(0, 5))
+        timer.join()
+        self.assertEqual([c[4] for c in repo.get_changes(0, 10)], ['committed', 'committed'])
+
+    def test_balance_at_matches_the_ledger(self):
+        repo = self.open_repo(create=True)
+        repo.add_user('alice', 0)
+        for timestamp, value in [(1000, 10), (2000, -3), (3000, 7)]:
+            repo.force_add_transaction('alice', value, timestamp, 'history')
+        repo.force_add_transaction('bob', 1, 1000, 'another user')
+        # the balance that matches the history above
+        with repo.pool.connection() as conn:
+            conn.execute("UPDATE user_balance SET balance=14 WHERE userid='alice'")
+            conn.commit()
+
+        def expected_balance(timestamp: int):
+            ledger = repo.get_user_transactions('alice', None, from_timestamp=timestamp + 1)
+            return repo.get_user_balance('alice') - sum(t[1] for t in ledger)
+
+        times = [0, 999, 1000, 1500, 2000, 2999, 3000, 10 ** 10]
+        # no snapshots, walking back from the current balance
+        for timestamp in times:
+            self.assertEqual(repo.get_user_balance_at('alice', timestamp), expected_balance(timestamp))
+
+        repo.checkpoint_balances()
+        # a snapshot was taken, a transaction is imported into the past (the current balance already includes it) and
+        # a new transfer is made
+        repo.force_add_transaction('alice', 100, 1500, 'imported')
+        repo.add_user('bob', 0)
+        repo.transfer_money('alice', 'bob', 4, 'new transfer')
+        for timestamp in times + [1499, 1500]:
+            self.assertEqual(repo.get_user_balance_at('alice', timestamp), expected_balance(timestamp))
+
+    def test_transactions_pages(self):
+        repo = self.open_repo(create=True)
+        repo.add_user('alice', 0)
+        # several transactions share each second, the pages must not split or repeat them
+        for i in range(20):
+            repo.force_add_transaction('alice', i, 1000 + i // 4, f'transaction {i}')
+        everything = repo.get_user_transactions('alice', None)
+
+        pages = []
+        after = None
+        while True:
+            page = repo.get_user_transactions_page('alice', 3, after)
+            if len(page) == 0:
+                break
+            pages.append(page)
+            after = (page[-1][0], page[-1][3])
+        paged = [t for page in pages for t in page]
+        self.assertEqual(len(pages), 7)
+        self.assertEqual(sorted(paged), sorted(everything))
+        self.assertEqual(paged, list(repo.iter_user_transactions('alice', batch_size=7)))
+        self.assertEqual(len(list(repo.iter_user_transactions('alice', from_timestamp=1004))), 4)
+
+    def test_history_imported_after_a_checkpoint(self):
+        repo = self.open_repo(create=True)
+        repo.add_user('alice', 100)
+        repo.checkpoint_balances()
+        now = int(time.time())
+        # the way tools/import_user.py imports the history, the balance doesn't change
+        repo.force_add_transaction('alice', 50, now - 1000, 'imported')
+        self.assertEqual(repo.get_user_balance('alice'), 100)
+        self.assertEqual(repo.get_user_balance_at('alice', now), 100)
+        self.assertEqual(repo.get_user_balance_at('alice', now - 1001), 50)
+
+    def run_missed_job(self, batch_catch_up: bool):
+        self.db_path = os.path.join(self.temp_dir.name, f'batch_{batch_catch_up}.db')
+        repo = self.open_repo(create=True, config=RepoConfig(batch_catch_up=batch_catch_up))
+        repo.add_user('alice', 35)
+        repo.add_user('bob', 0)
+        # an hourly job that last ran 6 hours ago, there are only funds for 3 of its runs
+        last_run = int((datetime.now() - timedelta(hours=6)).replace(minute=0, second=0).timestamp())
+        job_info = JobInfo('job-1', 'alice', '0 * * * *', 1, json.dumps({'to': 'bob', 'value': 10, 'description': 'rent'}),
+            'rent', last_run, 0, '', 1)
+        with repo.pool.connection() as conn:
+            insert_job(conn, job_info)
+            conn.commit()
+            repo.process_job(job_info, conn=conn)
+            job_row = conn.execute('SELECT last_run_status, last_run_error FROM jobs').fetchone()
+
+        return repo, job_row
+
+    def test_batched_catch_up(self):
+        repo, job_row = self.run_missed_job(batch_catch_up=True)
+        expected_repo, expected_job_row = self.run_missed_job(batch_catch_up=False)
+
+        self.assertEqual(job_row, expected_job_row)
+        self.assertEqual(job_row, (-1, 'Insufficient funds'))
+        for userid in ['alice', 'bob']:
+            self.assertEqual(repo.get_user_balance(userid), expected_repo.get_user_balance(userid))
+            descriptions = [t[2] for t in repo.get_user_transactions(userid, None)]
+            self.assertEqual(sorted(descriptions), sorted(t[2] for t in expected_repo.get_user_transactions(userid, None)))
+            self.assertEqual(len(descriptions), 3)
+            self.assertTrue(all(d.startswith('rent (catching up to ') for d in descriptions))
+        self.assertEqual(repo.get_user_balance('alice'), 5)
+
+    def test_jobs_added_through_a_standby_are_scheduled_by_the_active_instance(self):
+        config = RepoConfig(jobs_lease_time=0.3)
+        active = self.open_repo(create=True, config=config)
+        active.add_user('alice', 100)
+        active.add_user('bob', 0)
+        standby = self.open_repo(config=config)
+        self.assertTrue(active.jobs_lock.is_locked)
+        self.assertFalse(standby.jobs_lock.is_locked)
+
+        job_id = standby.add_job('alice', '0 4 * * *', 'bob', 10, 'rent')
+        deadline = time.time() + 5
+        while active.job_scheduler.get_job_count() == 0 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(active.job_scheduler.get_job_count(), 1)
+
+        # and the jobs deleted through it are unscheduled
+        standby.delete_job(job_id)
+        deadline = time.time() + 5
+        while active.job_scheduler.get_job_count() == 1 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(active.job_scheduler.get_job_count(), 0)
+
+    def test_jobs_are_not_run_without_the_lease(self):
+        for batch_catch_up in [True, False]:
+            self.db_path = os.path.join(self.temp_dir.name, f'lease_{batch_catch_up}.db')
+            repo = self.open_repo(create=True, config=RepoConfig(batch_catch_up=batch_catch_up))
+            repo.add_user('alice', 100)
+            repo.add_user('bob', 0)
+            # missed runs to catch up on, and the run that is due now
+            last_run = int((datetime.now() - timedelta(hours=3)).timestamp())
+            job_info = JobInfo('job-1', 'alice', '0 * * * *', 1, json.dumps({'to': 'bob', 'value': 10}), 'rent',
+                last_run, 0, '', 1)
+            with repo.pool.connection() as conn:
+                insert_job(conn, job_info)
+                # a standby took over, while this instance didn't notice yet
+                conn.execute("UPDATE locks SET owner='another'")
+                conn.commit()
+            self.assertTrue(repo.jobs_lock.is_locked)
+            repo.run_job('job-1')
+
+            self.assertEqual(repo.get_user_balance('bob'), 0)
+            self.assertEqual(repo.get_job('job-1').last_run, last_run)
+
+    def test_missed_runs_are_skipped_without_enumerating_them(self):
+        repo = self.open_repo(create=True)
+        repo.add_user('alice', 100)
+        repo.add_user('bob', 0)
+        # a minutely job that didn't run for a day, without handle_missed_events it runs once
+        last_run = int((datetime.now() - timedelta(days=1)).timestamp())
+        job_info = JobInfo('job-1', 'alice', '* * * * *', 1, json.dumps({'to': 'bob', 'value': 10}), 'allowance',
+            last_run, 0, '', 0)
+        cron = repo.get_compiled_job('job-1', 0, '* * * * *', job_info.action_params).cron
+        with repo.pool.connection() as conn:
+            insert_job(conn, job_info)
+            conn.commit()
+            with mock.patch.object(cron, 'get_runs_between', side_effect=AssertionError('runs were enumerated')):
+                repo.process_job(job_info, conn=conn)
+
+        self.assertEqual(repo.get_user_balance('bob'), 10)
+        self.assertEqual(len(repo.get_user_transactions('bob', None)), 1)
+
+    def test_due_jobs_are_run_by_the_scheduler(self):
+        repo = self.open_repo(create=True)
+        repo.add_user('alice', 100)
+        repo.add_user('bob', 0)
+        # the job missed its last run a minute ago, so it's due as soon as it's scheduled
+        last_run = int(datetime.now().timestamp()) - 120
+        job_info = JobInfo('job-1', 'alice', '* * * * *', 1, json.dumps({'to': 'bob', 'value': 10}), 'allowance', 
+            last_run, 0, '', 0)
+        with repo.pool.connection() as conn:
+            insert_job(conn, job_info)
+            conn.commit()
+        self.assertIsNone(repo.job_scheduler.get_next())
+        repo.update_jobs()
+
+        self.assertTrue(repo.wait_for_changes(0, 5))
+        self.assertEqual(repo.get_user_balance('bob'), 10)
+        # the next run is the next minute, it's scheduled right after the transfer is committed
+        deadline = time.time() + 5
+        while repo.job_scheduler.get_next() is None and time.time() < deadline:
+            time.sleep(0.01)
+        next_run, job_id = repo.job_scheduler.get_next()
+        self.assertEqual(job_id, 'job-1')
+        self.assertGreater(next_run, datetime.now().timestamp())
+        self.assertLessEqual(next_run, datetime.now().timestamp() + 60)
+        with repo.pool.connection() as conn:
+            self.assertEqual(conn.execute('SELECT next_run FROM jobs').fetchone()[0], next_run)
+            conn.execute("DELETE FROM jobs")
+            conn.commit()
+        repo.update_jobs()
+        self.assertIsNone(repo.job_scheduler.get_next())
+
+    def test_job_that_last_ran_a_second_before_its_run_is_not_rescheduled_in_a_loop(self):
+        repo = self.open_repo(create=True)
+        repo.add_user('alice', 100)
+        repo.add_user('bob', 0)
+        # added (or changed) at hh:mm:59, process_job skips the run at the next minute
+        minute = int(datetime.now().timestamp()) // 60 * 60
+        job_info = JobInfo('job-1', 'alice', '* * * * *', 1, json.dumps({'to': 'bob', 'value': 10}), 'allowance',
+            minute - 1, 0, '', 0)
+        with repo.pool.connection() as conn:
+            insert_job(conn, job_info)
+            conn.commit()
+        cron = repo.get_compiled_job('job-1', 0, '* * * * *', job_info.action_params).cron
+        self.assertEqual(repo.get_job_next_run(cron, minute - 1), minute + 60)
+        # a job is never rescheduled to the run it was just run for (or an earlier one)
+        self.assertEqual(repo.get_job_next_run(cron, minute - 600, after=minute), minute + 60)
+
+        repo.update_jobs()
+        time.sleep(0.5)
+        # at most the runs of the minutes that started since (if the test ran at the end of a minute)
+        self.assertLessEqual(repo.get_jobs_stats().executed, 2)
+        next_run, _ = repo.job_scheduler.get_next()
+        self.assertGreater(next_run, datetime.now().timestamp())
+
+    def test_failed_reschedule_keeps_the_job_scheduled(self):
+        repo = self.open_repo(create=True)
+        repo.add_user('alice', 100)
+        repo.add_user('bob', 0)
+        job_id = repo.add_job('alice', '0 4 * * *', 'bob', 10, 'rent')
+        # as if it was due at its next run
+        due_time = repo.get_job(job_id).next_run
+        locked = sqlite3.OperationalError('database is locked')
+
+        with mock.patch('cb_server.cb_repo.JOB_RETRY_DELAY', 0):
+            # the scheduler popped the job, the reschedule is retried while the database is locked
+            repo.job_scheduler.remove(job_id)
+            with mock.patch.object(repo, 'reschedule_job', side_effect=[locked, locked, None]):
+                repo.run_job(job_id, due_time=due_time)
+            self.assertEqual(repo.get_jobs_stats().retries, 2)
+
+            # the job is put back at the run it was due at when the reschedule keeps failing
+            repo.job_scheduler.remove(job_id)
+            with mock.patch.object(repo, 'reschedule_job', side_effect=locked):
+                repo.run_job(job_id, due_time=due_time)
+            self.assertEqual(repo.job_scheduler.get_next(), (due_time, job_id))
+
+        repo.run_job(job_id, due_time=due_time)
+        next_run, _ = repo.job_scheduler.get_next()
+        self.assertGreater(next_run, due_time)
+        # the run wasn't due yet, so nothing was transferred
+        self.assertEqual(repo.get_user_balance('bob'), 0)
+
+    def test_jobs_crud(self):
+        repo = self.open_repo(create=True)
+        repo.add_user('alice', 100)
+        repo.add_user('bob', 0)
+        with self.assertRaises(CronParsingException):
+            repo.add_job('alice', '0 8 * *', 'bob', 5, 'allowance')
+        job_id = repo.add_job('alice', '0 8 * * 1', 'bob', 5, 'allowance')
+        self.assertEqual(repo.job_scheduler.get_next()[1], job_id)
+        self.assertEqual([j.id for j in repo.get_user_jobs('alice')], [job_id])
+
+        # the parsed job is cached until the job is changed
+        job_info = repo.get_job(job_id)
+        compiled = repo.get_compiled_job(job_info.id, job_info.row_version, job_info.cron, job_info.action_params)
+        self.assertIs(repo.get_compiled_job(job_info.id, job_info.row_version, job_info.cron, job_info.action_params), 
+            compiled)
+        self.assertTrue(repo.update_job(job_id, cron_line='30 9 * * *', value=7))
+        job_info = repo.get_job(job_id)
+        self.assertEqual((job_info.cron, job_info.row_version), ('30 9 * * *', 1))
+        compiled = repo.get_compiled_job(job_info.id, job_info.row_version, job_info.cron, job_info.action_params)
+        self.assertEqual(compiled.cron.compile().minutes, [30])
+        self.assertEqual(compiled.action_params, {'to': 'bob', 'value': 7, 'description': 'allowance'})
+        self.assertEqual(repo.job_scheduler.get_next()[0], job_info.next_run)
+
+        self.assertTrue(repo.delete_job(job_id))
+        self.assertFalse(repo.delete_job(job_id))
+        self.assertFalse(repo.update_job(job_id, value=1))
+        self.assertIsNone(repo.get_job(job_id))
+        self.assertIsNone(repo.job_scheduler.get_next())
+
+    def test_balance_cache(self):
+        repo = self.open_repo(create=True)
+        repo.add_user('alice', 100)
+        repo.add_user('bob', 0)
+
+        self.assertEqual(repo.get_user_balance('alice'), 100)
+        self.assertEqual(repo.get_user_balance('alice'), 100)
+        stats = repo.get_balance_cache_stats()
+        self.assertEqual((stats.hits, stats.misses), (1, 1))
+
+        # our own writes update the cached balances in place
+        self.assertEqual(repo.get_user_balance('bob'), 0)
+        self.assertEqual(repo.transfer_money('alice', 'bob', 30, 'rent'), (True, None))
+        self.assertEqual(repo.get_user_balance('alice'), 70)
+        self.assertEqual(repo.get_user_balance('bob'), 30)
+        stats = repo.get_balance_cache_stats()
+        self.assertEqual((stats.size, stats.misses, stats.invalidations), (2, 2, 0))
+
+        # writes that don't touch the balances keep the cache
+        repo.add_job('alice', '0 0 1 * *', 'bob', 1, 'monthly', False)
+        self.assertEqual(repo.get_user_balance('alice'), 70)
+        self.assertEqual(repo.get_balance_cache_stats().invalidations, 0)
+
+        # a balance written by another connection drops the cache
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("UPDATE user_balance SET balance=5 WHERE userid='alice'")
+        conn.commit()
+        conn.close()
+        self.assertEqual(repo.get_user_balance('alice'), 5)
+        self.assertEqual(repo.get_balance_cache_stats().invalidations, 1)
+        self.assertEqual(repo.transfer_money('alice', 'bob', 10, 'rent'), (False, 'Insufficient funds'))
+
+    def test_user_generation(self):
+        repo = self.open_repo(create=True)
+        repo.add_user('alice', 100)
+        repo.add_user('bob', 0)
+        repo.add_user('carol', 0)
+        alice, bob, carol = (repo.get_user_generation(userid) for userid in ['alice', 'bob', 'carol'])
+        self.assertEqual(repo.get_user_generation('alice'), alice)
+
+        # a transfer changes the generation of both its users only
+        repo.transfer_money('alice', 'bob', 10, 'rent')
+        self.assertNotEqual(repo.get_user_generation('alice'), alice)
+        self.assertNotEqual(repo.get_user_generation('bob'), bob)
+        self.assertEqual(repo.get_user_generation('carol'), carol)
+
+        # so does a transaction that doesn't change the balance
+        carol = repo.get_user_generation('carol')
+        repo.force_add_transaction('carol', 5, 1700000000, 'imported')
+        self.assertNotEqual(repo.get_user_generation('carol'), carol)
+
+        # and a batch whose legs cancel out for a user
+        bob = repo.get_user_generation('bob')
+        self.assertTrue(repo.transfer_many([TransferLeg('alice', 'bob', 5), TransferLeg('bob', 'carol', 5)])[0])
+        self.assertEqual(repo.get_user_balance('bob'), 10)
+        self.assertNotEqual(repo.get_user_generation('bob'), bob)
+
+        # and the writes of another repo (e.g. the import tool)
+        alice = repo.get_user_generation('alice')
+        self.open_repo().force_add_transaction('alice', 5, 1700000000, 'imported')
+        self.assertNotEqual(repo.get_user_generation('alice'), alice)
+
+        # the generations are not reused after a restart
+        alice = repo.get_user_generation('alice')
+        self.repos.remove(repo)
+        repo.close()
+        repo = self.open_repo()
+        self.assertGreaterEqual(repo.get_user_generation('alice'), alice)
+        repo.transfer_money('alice', 'bob', 10, 'rent')
+        self.assertGreater(repo.get_user_generation('alice'), alice)
+
+    def test_sql_profile(self):
+        repo = self.open_repo(create=True, config=RepoConfig(profile_sql=True, slow_query_time=None))
+        repo.add_user('alice', 100)
+        repo.add_user('bob', 0)
+        for _ in range(3):
+            self.assertTrue(repo.transfer_money('alice', 'bob', 10, 'rent')[0])
+        self.assertEqual(len(repo.get_user_transactions('alice', 2)), 2)
+
+        stats = repo.get_sql_stats()
+        self.assertEqual(stats, sorted(stats, key=lambda s: s.total_time, reverse=True))
+        commit = next(s for s in stats if s.statement == 'COMMIT')
+        self.assertGreaterEqual(commit.count, 3)
+        transactions = [s for s in stats if s.statement.startswith('SELECT') and 'LIMIT' in s.statement]
+        self.assertEqual(sum(s.rows for s in transactions), 2)
+        # not profiled by default
+        self.assertEqual(self.open_repo().get_sql_stats(), [])
+
+    def test_concurrent_transfers_conserve_money(self):
+        repo = self.open_repo(create=True)
+        users = [f'user{i}' for i in range(4)]
+        for userid in users:
+            repo.add_user(userid, 50)
+
+        results = []
+        def transfer(n: int):
+            for i in range(50):
+                from_userid, to_userid = users[(n + i) % len(users)], users[(n + i + 1) % len(users)]
+                results.append(repo.transfer_money(from_userid, to_userid, 7, 'stress')[0])
+
+        threads = [threading.Thread(target=transfer, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        conn = sqlite3.connect(self.db_path)
+        balances = dict(conn.execute('SELECT userid, balance FROM user_balance').fetchall())
+        ledger = dict(conn.execute('SELECT userid, SUM(value) FROM transactions GROUP BY userid').fetchall())
+        n_transactions = conn.execute('SELECT COUNT(*) FROM transactions').fetchone()[0]
+        conn.close()
+        # no update was lost: the money is conserved, every balance matches its ledger and no overdraft was taken
+        self.assertEqual(sum(balances.values()), 50 * len(users))
+        self.assertEqual(n_transactions, results.count(True) * 2)
+        for userid in users:
+            self.assertEqual(balances[userid], 50 + ledger.get(userid, 0))
+            self.assertGreaterEqual(balances[userid], 0)
+            self.assertEqual(repo.get_user_balance(userid), balances[userid])
+
+    def test_failed_transfer_changes_nothing(self):
+        repo = self.open_repo(create=True)
+        repo.add_user('alice', 10)
+        repo.add_user('bob', 0)
+        self.assertEqual(repo.transfer_money('alice', 'bob', 11, 'too much'), (False, 'Insufficient funds'))
+        self.assertEqual(repo.transfer_money('carol', 'bob', 1, 'x'), 
+            (False, "Transfer failed: transferring user 'carol' not found"))
+        self.assertEqual(repo.transfer_money('alice', 'carol', 1, 'x'), 
+            (False, "Transfer failed: target user 'carol' not found"))
+        self.assertEqual(repo.read_user_balance('alice'), 10)
+        self.assertEqual(repo.get_user_transactions('alice', 10), [])
+
+    def test_transfer_many(self):
+        repo = self.open_repo(create=True)
+        for userid, balance in [('mom', 30), ('kid1', 0), ('kid2', 0)]:
+            repo.add_user(userid, balance)
+        self.assertEqual(repo.get_user_balance('kid1'), 0)
+
+        # kid1 passes on money it receives in the same batch, only the net effect is checked
+        legs = [TransferLeg('mom', 'kid1', 20, 'allowance'), TransferLeg('kid1', 'kid2', 15, 'share'),
+            TransferLeg('mom', 'kid2', 10, 'allowance')]
+        self.assertEqual(repo.transfer_many(legs), (True, [(True, None)] * 3))
+        self.assertEqual([repo.get_user_balance(userid) for userid in ['mom', 'kid1', 'kid2']], [0, 5, 25])
+        self.assertEqual(len(repo.get_user_transactions('kid2', 10)), 2)
+
+        # all or nothing
+        legs = [TransferLeg('kid2', 'kid1', 5, 'ok'), TransferLeg('kid1', 'mom', 20, 'too much'),
+            TransferLeg('kid1', 'nobody', 1, 'missing')]
+        success, results = repo.transfer_many(legs)
+        self.assertFalse(success)
+        self.assertEqual(results, [(False, BATCH_NOT_EXECUTED_ERROR), (False, 'Insufficient funds'),
+            (False, "Transfer failed: target user 'nobody' not found")])
+        self.assertEqual([repo.read_user_balance(userid) for userid in ['mom', 'kid1', 'kid2']], [0, 5, 25])
+
+    def test_idempotent_transfers(self):
+        repo = self.open_repo(create=True)
+        repo.add_user('alice', 100)
+        repo.add_user('bob', 0)
+
+        self.assertEqual(repo.transfer_money('alice', 'bob', 30, 'rent', idempotency_key='key-1'), (True, None))
+        # a retry returns the first result without transferring again
+        self.assertEqual(repo.transfer_money('alice', 'bob', 30, 'rent', idempotency_key='key-1'), (True, None))
+        self.assertEqual(repo.get_user_balance('bob'), 30)
+        self.assertEqual(len(repo.get_user_transactions('bob', 10)), 1)
+        # so does a failed one
+        self.assertEqual(repo.transfer_money('alice', 'bob', 500, 'car', idempotency_key='key-2'), 
+            (False, 'Insufficient funds'))
+        self.assertEqual(repo.transfer_money('alice', 'bob', 500, 'car', idempotency_key='key-2'), 
+            (False, 'Insufficient funds'))
+        with self.assertRaises(IdempotencyKeyReused):
+            repo.transfer_money('alice', 'bob', 5, 'other', idempotency_key='key-1')
+        # keys are per user
+        self.assertEqual(repo.transfer_money('bob', 'alice', 5, 'change', idempotency_key='key-1'), (True, None))
+
+        # an expired key is a new request
+        with repo.pool.connection() as conn:
+            conn.execute('UPDATE idempotency_keys SET created=created-?', (IDEMPOTENCY_KEY_TTL,))
+            conn.commit()
+        self.assertEqual(repo.transfer_money('alice', 'bob', 30, 'rent', idempotency_key='key-1'), (True, None))
+        self.assertEqual(repo.get_user_balance('bob'), 55)
+        repo.prune_idempotency_keys()
+        with repo.pool.connection() as conn:
+            self.assertEqual(conn.execute('SELECT COUNT(*) FROM idempotency_keys').fetchone()[0], 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+from decimal import Decimal
+import os
+import tempfile
+import unittest
+from aiohttp.test_utils import TestServer
+from cb_bot.cb_server_connection import CBServerConnection
+from cb_bot.cb_user_mapper import UserMapper
+from cb_server.cb_async_server import create_app
+from cb_server.cb_repo import Repo
+
+class ServerConnectionTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.repo = Repo(os.path.join(self.temp_dir.name, 'test.db'), create=True)
+        self.repo.add_user('alice', 1000)
+        self.repo.add_user('bob', 0)
+        mapper_path = os.path.join(self.temp_dir.name, 'users.csv')
+        with open(mapper_path, 'w') as f:
+            f.write('discord_user_id,cb_user_id,is_admin\n1,alice,no\n2,bob,no\n')
+        self.server = TestServer(create_app(self.repo))
+        await self.server.start_server()
+        self.connection = CBServerConnection(str(self.server.make_url('')).rstrip('/'), UserMapper(mapper_path),
+            pool_limit=5)
+
+    async def asyncTearDown(self):
+        await self.connection.close()
+        await self.server.close()
+        self.repo.close()
+        self.temp_dir.cleanup()
+
+    async def test_requests_share_the_session(self):
+        stats = self.connection.get_pool_stats()
+        self.assertEqual((stats.limit, stats.requests, stats.sessions_opened), (5, 0, 0))
+
+        await self.connection.open()
+        session = self.connection.session
+        await self.connection.do_money_transfer('1', '2', Decimal('1.5'), 'rent')
+        for _ in range(3):
+            self.assertEqual(await self.connection.get_user_balance('2'), Decimal('1.5'))
+        self.assertIs(self.connection.session, session)
+
+        # the requests after the first one are sent on its kept-alive connection
+        stats = self.connection.get_pool_stats()
+        self.assertEqual((stats.limit, stats.limit_per_host), (5, 0))
+        self.assertEqual((stats.requests, stats.connections_created, stats.connections_reused), (4, 1, 3))
+        self.assertEqual(stats.sessions_opened, 1)
+
+        await self.connection.close()
+        self.assertIsNone(self.connection.session)
+        self.assertTrue(session.closed)
+        self.assertEqual(self.connection.get_pool_stats().limit, 5)
+
+        # a request after 'close' opens a new session
+        self.assertEqual(await self.connection.get_user_balance('1'), Decimal('8.5'))
+        stats = self.connection.get_pool_stats()
+        self.assertEqual((stats.requests, stats.connections_created, stats.sessions_opened), (5, 2, 2))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import gzip
+import json
+import os
+import tempfile
+import unittest
+from cb_server import cb_server
+from cb_server.cb_repo import Repo
+
+class ServerTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.repo = Repo(os.path.join(self.temp_dir.name, 'test.db'), create=True)
+        for userid, balance in [('alice', 1000), ('bob', 0), ('carol', 0)]:
+            self.repo.add_user(userid, balance)
+        cb_server.repo = self.repo
+        self.client = cb_server.app.test_client()
+
+    def tearDown(self):
+        cb_server.repo = None
+        self.repo.close()
+        self.temp_dir.cleanup()
+
+    def transfer(self, from_userid: str, to_userid: str, value: str):
+        response = self.client.post(f'/user/{from_userid}/transfer',
+            json={'to': to_userid, 'value': value, 'description': 'rent'})
+        self.assertEqual(response.status_code, 204)
+
+    def test_conditional_get(self):
+        response = self.client.get('/user/bob/balance')
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+        self.assertTrue(etag.startswith('W/'))
+        self.assertIn('no-cache', response.headers['Cache-Control'])
+
+        response = self.client.get('/user/bob/balance', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+        self.assertEqual(response.headers['ETag'], etag)
+
+        self.transfer('alice', 'bob', '1.5')
+        response = self.client.get('/user/bob/balance', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json(), {'balance': '1.50'})
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_batch_transfer_changes_the_etag_of_every_user_in_it(self):
+        self.transfer('alice', 'bob', '0.05')
+        response = self.client.get('/user/bob/transactions')
+        etag = response.headers['ETag']
+        self.assertEqual(len(response.get_json()), 1)
+
+        # bob receives and passes on the same amount, his balance doesn't change but his history does
+        response = self.client.post('/transfers/batch', json={'transfers': [
+            {'from': 'alice', 'to': 'bob', 'value': '0.05', 'description': 'a'},
+            {'from': 'bob', 'to': 'carol', 'value': '0.05', 'description': 'b'}]})
+        self.assertTrue(response.get_json()['success'])
+        response = self.client.get('/user/bob/transactions', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.get_json()), 3)
+
+    def test_large_responses_are_compressed(self):
+        for _ in range(20):
+            self.transfer('alice', 'bob', '0.01')
+
+        response = self.client.get('/user/bob/transactions', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertEqual(len(json.loads(gzip.decompress(response.data))), 20)
+
+        # not when the client doesn't accept it, or when the body is small
+        response = self.client.get('/user/bob/transactions')
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(len(response.get_json()), 20)
+        response = self.client.get('/user/bob/balance', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+
+        # a 304 has no body to compress
+        etag = response.headers['ETag']
+        response = self.client.get('/user/bob/balance', headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertNotIn('Content-Encoding', response.headers)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+from cb_server.connection_pool import ConnectionPool, PoolClosed, PoolTimeout
+
+class ConnectionPoolTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.temp_dir.name, 'test.db')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_connections_are_reused(self):
+        pool = ConnectionPool(self.db_path, max_size=2)
+        with pool.connection() as conn:
+            first = conn
+        with pool.connection() as conn:
+            self.assertIs(conn, first)
+
+        stats = pool.get_stats()
+        self.assertEqual(stats.checkouts, 2)
+        self.assertEqual(stats.connects, 1)
+        self.assertEqual(stats.in_use, 0)
+        self.assertEqual(stats.idle, 1)
+        pool.close()
+
+    def test_nested_checkout_uses_the_same_connection(self):
+        pool = ConnectionPool(self.db_path, max_size=1)
+        with pool.connection() as outer:
+            with pool.connection() as inner:
+                self.assertIs(inner, outer)
+        self.assertEqual(pool.get_stats().checkouts, 1)
+        pool.close()
+
+    def test_open_transaction_is_rolled_back_on_checkin(self):
+        pool = ConnectionPool(self.db_path, max_size=1)
+        with pool.connection() as conn:
+            conn.execute('CREATE TABLE t (x INTEGER)')
+            conn.commit()
+            conn.execute('INSERT INTO t VALUES (1)')
+        with pool.connection() as conn:
+            self.assertFalse(conn.in_transaction)
+            self.assertEqual(conn.execute('SELECT COUNT(*) FROM t').fetchone()[0], 0)
+        pool.close()
+
+    def test_writers_queue_on_the_write_lock(self):
+        pool = ConnectionPool(self.db_path, max_size=2, pragmas={'busy_timeout': 100})
+        with pool.connection() as conn:
+            conn.execute('CREATE TABLE t (x INTEGER)')
+            conn.commit()
+        taken = threading.Event()
+        release = threading.Event()
+
+        def write():
+            with pool.connection() as conn:
+                conn.begin_immediate()
+                conn.execute('INSERT INTO t VALUES (1)')
+                taken.set()
+                release.wait()
+                conn.commit()
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        taken.wait()
+        with pool.connection() as conn:
+            # the lock is held until the other transaction ends
+            with self.assertRaisesRegex(sqlite3.OperationalError, 'database is locked'):
+                conn.begin_immediate()
+            release.set()
+            writer.join()
+            conn.begin_immediate()
+            conn.execute('INSERT INTO t VALUES (2)')
+            conn.rollback()
+            # a rolled back transaction releases the lock too
+            conn.begin_immediate()
+            self.assertEqual(conn.execute('SELECT COUNT(*) FROM t').fetchone()[0], 1)
+            conn.commit()
+        pool.close()
+
+    def test_exhausted_pool_times_out(self):
+        pool = ConnectionPool(self.db_path, max_size=1, timeout=0.1)
+        taken = threading.Event()
+        release = threading.Event()
+
+        def hold_connection():
+            with pool.connection():
+                taken.set()
+                release.wait()
+
+        holder = threading.Thread(target=hold_connection)
+        holder.start()
+        taken.wait()
+        with self.assertRaises(PoolTimeout):
+            with pool.connection():
+                pass
+        release.set()
+        holder.join()
+
+        stats = pool.get_stats()
+        self.assertEqual(stats.timeouts, 1)
+        self.assertEqual(stats.waits, 0)
+        pool.close()
+
+    def test_waiting_for_a_returned_connection(self):
+        pool = ConnectionPool(self.db_path, max_size=1, timeout=5)
+        taken = threading.Event()
+
+        def hold_connection():
+            with pool.connection():
+                taken.set()
+                threading.Event().wait(0.05)
+
+        holder = threading.Thread(target=hold_connection)
+        holder.start()
+        taken.wait()
+        with pool.connection():
+            pass
+        holder.join()
+
+        stats = pool.get_stats()
+        self.assertEqual(stats.waits, 1)
+        self.assertGreater(stats.wait_time, 0)
+        self.assertEqual(stats.connects, 1)
+        pool.close()
+
+    def test_closed_pool(self):
+        pool = ConnectionPool(self.db_path)
+        with pool.connection():
+            pass
+        pool.close()
+        self.assertEqual(pool.get_stats().size, 0)
+        with self.assertRaises(PoolClosed):
+            with pool.connection():
+                pass
+
+if __name__ == '__main__':
+    unittest.main()
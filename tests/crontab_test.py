@@ -61,5 +61,29 @@ class CronTabTests(unittest.TestCase):
         cron.from_line('5 0 * 8 *')
         self.assertEqual(cron.get_next_run(datetime(2024, 1, 31, 0, 49, 0)), datetime(2024, 8, 1, 0, 5, 0))
 
+    def get_runs_iteratively(self, cron: CronTab, start: datetime, end: datetime):
+        runs = []
+        next_run = cron.get_next_run(start)
+        while next_run < end:
+            runs.append(next_run)
+            next_run = cron.get_next_run(next_run)
+        return runs
+
+    def test_get_runs_between(self):
+        cron = CronTab()
+        start = datetime(2023, 12, 30, 22, 30, 0)
+        end = datetime(2024, 3, 2, 1, 0, 0)
+        # dense (over a shorter range, croniter is slow), sparse, both day fields (either matches) and a leap day
+        for line, line_end in [('* * * * *', datetime(2024, 1, 1, 2, 0, 0)), ('5 0 * 8 *', end), ('0 12 13 * 5', end),
+                ('30 1-3,22 29 2 *', end), ('0,30 * * 1,2 1-5', end)]:
+            cron.from_line(line)
+            self.assertEqual(cron.get_runs_between(start, line_end), self.get_runs_iteratively(cron, start, line_end), line)
+
+        # both edges are exclusive
+        cron.from_line('0 * * * *')
+        self.assertEqual(cron.get_runs_between(datetime(2024, 1, 1, 10), datetime(2024, 1, 1, 12)), 
+            [datetime(2024, 1, 1, 11)])
+        self.assertEqual(cron.get_runs_between(datetime(2024, 1, 1, 10, 1), datetime(2024, 1, 1, 10, 59)), [])
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
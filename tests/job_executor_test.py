@@ -0,0 +1,61 @@
+import threading
+import time
+import unittest
+from cb_server.job_executor import PartitionedExecutor
+
+class PartitionedExecutorTests(unittest.TestCase):
+    def setUp(self):
+        self.executor = PartitionedExecutor(workers=4)
+        self.events = []
+        self.events_lock = threading.Lock()
+
+    def tearDown(self):
+        self.executor.close()
+
+    def task(self, name: str, duration: float=0):
+        def run():
+            with self.events_lock:
+                self.events.append(('start', name))
+            time.sleep(duration)
+            with self.events_lock:
+                self.events.append(('end', name))
+        return run
+
+    def wait_for(self, n_executed: int):
+        deadline = time.time() + 5
+        while self.executor.get_stats().executed < n_executed and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_disjoint_accounts_run_concurrently(self):
+        self.executor.submit({'alice', 'bob'}, self.task('slow', 0.2))
+        self.executor.submit({'carol'}, self.task('fast'))
+        self.wait_for(2)
+        # the fast task didn't wait for the slow one
+        self.assertLess(self.events.index(('end', 'fast')), self.events.index(('end', 'slow')))
+
+    def test_shared_accounts_keep_their_order(self):
+        self.executor.submit({'alice', 'bob'}, self.task('first', 0.1))
+        self.executor.submit({'bob', 'carol'}, self.task('second'))
+        # shares no account with 'first', but must not overtake 'second' that shares 'carol' with it
+        self.executor.submit({'carol'}, self.task('third'))
+        self.executor.submit({'dave'}, self.task('unrelated'))
+        self.wait_for(4)
+        self.assertEqual([name for event, name in self.events if event == 'end' and name != 'unrelated'], 
+            ['first', 'second', 'third'])
+        self.assertLess(self.events.index(('end', 'first')), self.events.index(('start', 'second')))
+
+        stats = self.executor.get_stats()
+        self.assertEqual((stats.queued, stats.running, stats.executed, stats.failed), (0, 0, 4, 0))
+        self.assertGreaterEqual(stats.max_time, 0.1)
+
+    def test_failed_task_releases_its_accounts(self):
+        def fail():
+            raise Exception("failed on purpose")
+        self.executor.submit({'alice'}, fail)
+        self.executor.submit({'alice'}, self.task('after'))
+        self.wait_for(2)
+        self.assertEqual(self.events, [('start', 'after'), ('end', 'after')])
+        self.assertEqual(self.executor.get_stats().failed, 1)
+
+if __name__ == '__main__':
+    unittest.main()
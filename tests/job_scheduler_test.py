@@ -0,0 +1,44 @@
+import threading
+import time
+import unittest
+from cb_server.job_scheduler import JobScheduler
+
+class JobSchedulerTests(unittest.TestCase):
+    def setUp(self):
+        self.fired = []
+        self.fired_event = threading.Event()
+        self.scheduler = JobScheduler(self.on_due)
+
+    def tearDown(self):
+        self.scheduler.close()
+
+    def on_due(self, job_ids):
+        self.fired.extend(job_ids)
+        self.fired_event.set()
+
+    def test_jobs_fire_in_order(self):
+        now = time.time()
+        self.scheduler.schedule('later', now + 0.1)
+        self.scheduler.schedule('sooner', now + 0.05)
+        self.scheduler.schedule('never', now + 3600)
+        self.scheduler.start()
+        deadline = time.time() + 5
+        while len(self.fired) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.fired, ['sooner', 'later'])
+        self.assertEqual(self.scheduler.get_next()[1], 'never')
+
+    def test_rescheduled_and_removed_jobs(self):
+        self.scheduler.start()
+        now = time.time()
+        self.scheduler.schedule('moved', now + 3600)
+        self.scheduler.schedule('removed', now + 0.01)
+        self.scheduler.remove('removed')
+        # moving a job earlier wakes up the scheduler
+        self.scheduler.schedule('moved', now + 0.05)
+        self.assertTrue(self.fired_event.wait(5))
+        self.assertEqual(self.fired, ['moved'])
+        self.assertIsNone(self.scheduler.get_next())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+from cb_server.jobs_lock import JobsLock, JobsLockLost
+
+class JobsLockTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.temp_dir.name, 'test.db')
+        self.locks = []
+
+    def tearDown(self):
+        for lock in self.locks:
+            if not lock.is_dropped:
+                lock.drop()
+        self.temp_dir.cleanup()
+
+    def start_lock(self, lease_time: float=0.3) -> JobsLock:
+        acquired = threading.Event()
+        lost = threading.Event()
+        lock = JobsLock(self.db_path, lease_time=lease_time, on_acquired=acquired.set, on_lost=lost.set)
+        lock.acquired, lock.lost = acquired, lost
+        self.locks.append(lock)
+        lock.start()
+        return lock
+
+    def crash(self, lock: JobsLock):
+        """stops the heartbeat without releasing the lock, like a killed process"""
+        lock._stop.set()
+        lock._thread.join()
+
+    def test_live_lock_is_not_taken_over(self):
+        active = self.start_lock()
+        self.assertTrue(active.is_locked)
+        self.assertTrue(active.acquired.is_set())
+        holder = active.get_holder()
+        self.assertEqual((holder.owner, holder.pid), (active.owner, os.getpid()))
+
+        standby = self.start_lock()
+        self.assertFalse(standby.is_locked)
+        # the active instance keeps renewing the lease
+        time.sleep(1)
+        self.assertFalse(standby.is_locked)
+        self.assertFalse(active.lost.is_set())
+
+    def test_standby_takes_over_after_a_crash(self):
+        active = self.start_lock()
+        standby = self.start_lock()
+        self.crash(active)
+        self.assertTrue(standby.acquired.wait(5))
+        self.assertTrue(standby.is_locked)
+        self.assertEqual(standby.get_holder().owner, standby.owner)
+
+    def test_released_lock_is_taken_on_start(self):
+        first = self.start_lock()
+        first.drop()
+        second = self.start_lock(lease_time=30)
+        self.assertTrue(second.is_locked)
+
+    def test_lost_lease(self):
+        active = self.start_lock()
+        # another instance took over (e.g. this one was paused for longer than the lease)
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("UPDATE locks SET owner='another'")
+        conn.commit()
+        conn.close()
+        self.assertTrue(active.lost.wait(5))
+        self.assertFalse(active.is_locked)
+
+    def test_lease_expires_while_renewing_fails(self):
+        active = self.start_lock()
+        # e.g. another instance holds the database for longer than the busy timeout
+        with mock.patch.object(active, 'renew_lock', side_effect=sqlite3.OperationalError('database is locked')):
+            self.assertTrue(active.lost.wait(5))
+            self.assertFalse(active.is_locked)
+        self.assertGreaterEqual(time.time(), active.lease_expiry)
+        with self.assertRaises(JobsLockLost):
+            active.check_lease(active.conn)
+
+    def test_lock_of_an_older_version(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('CREATE TABLE locks (type TEXT, locked INTEGER)')
+        # left behind by a crashed instance, it has no lease
+        conn.execute("INSERT INTO locks VALUES ('jobs', 1)")
+        conn.commit()
+        conn.close()
+        self.assertTrue(self.start_lock().is_locked)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import unittest
+from cb_server.metrics import CollectedMetric, MetricsRegistry
+
+class MetricsTests(unittest.TestCase):
+    def test_counters_and_gauges(self):
+        registry = MetricsRegistry()
+        requests = registry.counter('requests_total', 'Requests', ['route'])
+        in_flight = registry.gauge('in_flight', 'In flight')
+        requests.inc(route='/a')
+        requests.inc(2, route='/a')
+        requests.inc(route='/b "x"')
+        in_flight.inc()
+        in_flight.inc()
+        in_flight.dec()
+
+        lines = registry.render().splitlines()
+        self.assertIn('# TYPE requests_total counter', lines)
+        self.assertIn('requests_total{route="/a"} 3', lines)
+        self.assertIn('requests_total{route="/b \\"x\\""} 1', lines)
+        self.assertIn('in_flight 1', lines)
+
+        # registering again returns the same metric, another type is an error
+        self.assertIs(registry.counter('requests_total', 'Requests', ['route']), requests)
+        with self.assertRaises(ValueError):
+            registry.gauge('requests_total', 'Requests')
+        with self.assertRaises(ValueError):
+            requests.inc(method='GET')
+
+    def test_histogram_buckets_are_cumulative(self):
+        registry = MetricsRegistry()
+        latency = registry.histogram('latency_seconds', 'Latency', ['route'], buckets=[0.1, 1])
+        for value in [0.05, 0.1, 0.5, 3]:
+            latency.observe(value, route='/a')
+
+        lines = registry.render().splitlines()
+        self.assertIn('latency_seconds_bucket{route="/a",le="0.1"} 2', lines)
+        self.assertIn('latency_seconds_bucket{route="/a",le="1.0"} 3', lines)
+        self.assertIn('latency_seconds_bucket{route="/a",le="+Inf"} 4', lines)
+        self.assertIn('latency_seconds_sum{route="/a"} 3.65', lines)
+        self.assertIn('latency_seconds_count{route="/a"} 4', lines)
+
+    def test_collectors(self):
+        registry = MetricsRegistry()
+        collector = lambda: [CollectedMetric('pool_connections', 'gauge', 'Connections', [({'pool': 'read'}, 2)])]
+        registry.add_collector(collector)
+        self.assertIn('pool_connections{pool="read"} 2', registry.render().splitlines())
+
+        registry.remove_collector(collector)
+        self.assertNotIn('pool_connections', registry.render())
+
+if __name__ == '__main__':
+    unittest.main()
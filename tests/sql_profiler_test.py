@@ -0,0 +1,92 @@
+import os
+import tempfile
+import unittest
+from cb_server.connection_pool import ConnectionPool
+from cb_server.sql_profiler import SLOW_QUERIES_LOGGER, SqlProfiler, normalize_statement
+
+class SqlProfilerTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.temp_dir.name, 'test.db')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def get_stats(self, profiler: SqlProfiler) -> dict:
+        return {stats.statement: stats for stats in profiler.get_stats()}
+
+    def test_normalize_statement(self):
+        self.assertEqual(normalize_statement("SELECT *  FROM t\n WHERE a='it''s' AND b=12.5 AND c IS NULL"),
+            'SELECT * FROM t WHERE a=? AND b=? AND c IS NULL')
+        self.assertEqual(normalize_statement('SELECT * FROM t1 WHERE a IN (?, ?,?) AND b in (1, 2)'),
+            'SELECT * FROM t1 WHERE a IN (?, ...) AND b IN (?, ...)')
+
+    def test_statements_are_aggregated(self):
+        profiler = SqlProfiler(self.db_path, slow_query_time=None)
+        pool = ConnectionPool(self.db_path, max_size=1, on_connect=profiler.attach)
+        with pool.connection() as conn:
+            conn.execute('CREATE TABLE t (x INTEGER)')
+            conn.execute('CREATE TRIGGER t_insert AFTER INSERT ON t BEGIN SELECT 1; END')
+            conn.executemany('INSERT INTO t VALUES (?)', [(i,) for i in range(10)])
+            conn.commit()
+            cursor = conn.cursor()
+            for x in [1, 2, 3]:
+                cursor.execute('SELECT x FROM t WHERE x >= ?', (x,))
+                cursor.fetchall()
+            self.assertEqual(conn.execute('SELECT COUNT(*) FROM t').fetchone()[0], 10)
+            self.assertEqual(len(list(conn.execute('SELECT x FROM t'))), 10)
+        pool.close()
+
+        stats = self.get_stats(profiler)
+        self.assertEqual(stats['INSERT INTO t VALUES (?)'].count, 10)
+        self.assertEqual(stats['INSERT INTO t VALUES (?)'].rows, 10)
+        # the implicit transaction of the inserts
+        self.assertEqual(stats['BEGIN'].count, 1)
+        self.assertEqual(stats['COMMIT'].count, 1)
+        select = stats['SELECT x FROM t WHERE x >= ?']
+        self.assertEqual(select.count, 3)
+        self.assertEqual(select.rows, 9 + 8 + 7)
+        self.assertGreater(select.total_time, 0)
+        self.assertGreaterEqual(select.total_time, select.max_time)
+        self.assertEqual(stats['SELECT COUNT(*) FROM t'].count, 1)
+        self.assertEqual(stats['SELECT x FROM t'].rows, 10)
+        # checking in a connection without a transaction doesn't run a rollback
+        self.assertNotIn('ROLLBACK', stats)
+        self.assertIn('SELECT x FROM t WHERE x >= ?', profiler.format_report())
+
+    def test_executions_are_recorded_before_the_cursor_is_dropped(self):
+        profiler = SqlProfiler(self.db_path, slow_query_time=None)
+        pool = ConnectionPool(self.db_path, max_size=1, on_connect=profiler.attach)
+        with pool.connection() as conn:
+            conn.execute('CREATE TABLE t (x INTEGER)')
+            conn.executemany('INSERT INTO t VALUES (?)', [(i,) for i in range(10)])
+            conn.commit()
+            cursor = conn.execute('SELECT x FROM t')
+            self.assertEqual(self.get_stats(profiler)['SELECT x FROM t'].rows, 0)
+            cursor.fetchone()
+            cursor.fetchmany(2)
+            select = self.get_stats(profiler)['SELECT x FROM t']
+            self.assertEqual((select.count, select.rows), (1, 3))
+            # the rows of a statement stop being counted once the cursor runs another one
+            cursor.execute('SELECT COUNT(*) FROM t')
+            self.assertEqual(self.get_stats(profiler)['SELECT x FROM t'].rows, 3)
+            cursor.close()
+        pool.close()
+
+    def test_slow_queries_are_logged_with_their_plan(self):
+        profiler = SqlProfiler(self.db_path, slow_query_time=0)
+        pool = ConnectionPool(self.db_path, max_size=1, on_connect=profiler.attach)
+        with pool.connection() as conn:
+            conn.execute('CREATE TABLE t (x INTEGER PRIMARY KEY, y TEXT)')
+            conn.commit()
+            with self.assertLogs(SLOW_QUERIES_LOGGER, 'WARNING') as logs:
+                conn.execute('SELECT y FROM t WHERE x=?', (7,)).fetchall()
+        pool.close()
+        profiler.close()
+
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('SELECT y FROM t WHERE x=7', logs.output[0])
+        self.assertIn('SEARCH t USING INTEGER PRIMARY KEY', logs.output[0])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,6 +5,7 @@ import os
 from typing import Dict, List
 
 from cb_server.cb_repo import Repo
+from models.money import format_amount, to_minor_units
 
 class Transaction():
 
@@ -21,9 +22,9 @@ class Transaction():
         raise Exception(f'Could not parse date {date}')
     
 
-    def _parse_amount(self, amount: str) -> float:
-        "Parse an amount string into a float"
-        return float(amount.strip())
+    def _parse_amount(self, amount: str) -> int:
+        "Parse an amount string into minor units"
+        return to_minor_units(amount.strip())
 
     def __init__(self, date: str, amount: str, description: str) -> None:
         self.date: datetime.datetime = self._parse_date(date)
@@ -31,9 +32,9 @@ class Transaction():
         self.description = description
 
     def __repr__(self) -> str:
-        return f'Transaction({self.date}, {self.amount}, {self.description})'
+        return f'Transaction({self.date}, {format_amount(self.amount)}, {self.description})'
     
-    def get_amount(self) -> float:
+    def get_amount(self) -> int:
         return self.amount
 
 class CSVMapper():
@@ -78,7 +79,7 @@ def parse_command_line_args():
     import argparse
 
     parser = argparse.ArgumentParser(description='Import new user from a CSV file')
-    parser.add_argument('-b', '--adjust_balance', type=float, help='Adjust balance', required=False)
+    parser.add_argument('-b', '--adjust_balance', type=to_minor_units, help='Adjust balance', required=False)
     parser.add_argument('-c', '--create', action='store_true', help='Create a new database', required=False)
     parser.add_argument('username', type=str, help='Username to be used in the database')
     parser.add_argument('database_path', type=str, help='Path to the database')
@@ -106,7 +107,7 @@ def read_csv_file(path: str) -> List[List[str]]:
         return l
 
 def main(config: Configuration):
-    print(f'Importing user {config.username} with balance {config.balance} to database {config.database_path}')
+    print(f'Importing user {config.username} with balance {format_amount(config.balance) if config.balance is not None else None} to database {config.database_path}')
     # read csv file
     csv_data = read_csv_file(config.csv_file_path)
     print(csv_data[0:3]) # print first 3 lines XXX debug
@@ -135,7 +136,7 @@ def main(config: Configuration):
 
     # add user to database
     balance = config.balance if config.balance is not None else sum([t.amount for t in transactions])
-    print(f'Adding user {config.username} with balance {balance}')
+    print(f'Adding user {config.username} with balance {format_amount(balance)}')
 
     is_save_confirmation = False
     while not is_save_confirmation: